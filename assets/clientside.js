@@ -0,0 +1,160 @@
+/*
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (assets/clientside.js)
+April 19, 2023
+
+clientside.js: Clientside callbacks of the dashboard (only used when the SLEEP_CLIENTSIDE environment variable is set to
+1, see sleep.py)
+
+The server sends each figure once, built from every row within the bounds of the efficiency slider. Dragging the slider
+then filters the figure in the browser, keeping the same rows as utils.filt_vals would on the server: the points of the
+strip chart are filtered directly (and the mean of each smoking status is computed again from the points kept), and
+the cells of the density contour plot are averaged again from the counts and sums of the slices of sleep efficiency
+within the range (see contour_figure_data in sleep.py).
+*/
+
+// typed arrays matching the dtypes plotly uses to encode numeric arrays in base64
+var TYPED_ARRAYS = {
+    f8: Float64Array, f4: Float32Array, i4: Int32Array, u4: Uint32Array, i2: Int16Array, u2: Uint16Array,
+    i1: Int8Array, u1: Uint8Array
+};
+
+// attributes of a trace that hold one value per point
+var POINT_ATTRS = ['x', 'y', 'z', 'customdata', 'ids', 'text', 'hovertext'];
+
+/* Turns the values of a trace attribute into a plain array (decoding it if plotly encoded it in base64)
+Args:
+    values: the values of the attribute
+Returns:
+    the values as a plain array (or as they were if they are not an array)
+*/
+function decodeValues(values) {
+    if (!values || Array.isArray(values) || values.bdata === undefined) {
+        return values;
+    }
+
+    var binary = atob(values.bdata);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+
+    if (values.dtype === 'i8') {
+        return Array.from(new BigInt64Array(bytes.buffer), Number);
+    }
+    return Array.from(new TYPED_ARRAYS[values.dtype](bytes.buffer));
+}
+
+/* Keeps the points of every trace of a figure whose value of an attribute is within a range (bounds included)
+Args:
+    figure (object): the figure built by the server
+    range (array of two numbers): the range of interest
+    key (str): the attribute holding the values compared with the range
+Returns:
+    the filtered figure
+*/
+function filterFigure(figure, range, key) {
+    if (!figure) {
+        return window.dash_clientside.no_update;
+    }
+
+    var data = figure.data.map(function (trace) {
+        var keep = decodeValues(trace[key]).map(function (value) {
+            return value >= range[0] && value <= range[1];
+        });
+
+        var filtered = Object.assign({}, trace);
+        POINT_ATTRS.forEach(function (attr) {
+            var values = decodeValues(trace[attr]);
+            if (Array.isArray(values) && values.length === keep.length) {
+                filtered[attr] = values.filter(function (value, i) {
+                    return keep[i];
+                });
+            }
+        });
+
+        return filtered;
+    });
+
+    return Object.assign({}, figure, {data: data});
+}
+
+/* Moves the mean marks of a filtered figure (the traces whose meta names the trace they summarize) to the mean of the
+   points kept along the x-axis, with their standard deviation and number of points
+Args:
+    figure (object): the filtered figure
+Returns:
+    the figure with its mean marks updated
+*/
+function updateMeans(figure) {
+    var data = figure.data.map(function (trace) {
+        if (!trace.meta || trace.meta.mean_of === undefined) {
+            return trace;
+        }
+
+        var points = figure.data.find(function (other) {
+            return !other.meta && other.name === trace.meta.mean_of;
+        });
+        var values = points ? points.x : [];
+        var n = values.length;
+        if (!n) {
+            return Object.assign({}, trace, {x: [], y: [], customdata: []});
+        }
+
+        var mean = values.reduce(function (total, value) { return total + value; }, 0) / n;
+        var squares = values.reduce(function (total, value) { return total + (value - mean) * (value - mean); }, 0);
+        var sd = n > 1 ? Math.sqrt(squares / (n - 1)) : null;
+        return Object.assign({}, trace, {
+            x: [mean], y: [trace.meta.mean_of], customdata: [[n, sd]],
+            error_x: Object.assign({}, trace.error_x, {array: [sd]})
+        });
+    });
+
+    return Object.assign({}, figure, {data: data});
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    sleep: {
+        // the strip chart shows the sleep efficiencies along its x-axis, with the mean of each smoking status
+        filter_strip: function (figure, range) {
+            if (!figure) {
+                return window.dash_clientside.no_update;
+            }
+            return updateMeans(filterFigure(figure, range, 'x'));
+        },
+
+        // the density contour plot averages the sleep efficiencies of the rows in each cell of its grid
+        filter_contour: function (data, range) {
+            if (!data) {
+                return window.dash_clientside.no_update;
+            }
+
+            // add up the counts and sums of the half steps of sleep efficiency within the range
+            var cells = data.shape[0] * data.shape[1];
+            var counts = new Array(cells).fill(0);
+            var sums = new Array(cells).fill(0);
+            data.steps.forEach(function (step, i) {
+                if (step >= 2 * range[0] && step <= 2 * range[1]) {
+                    for (var j = 0; j < cells; j++) {
+                        counts[j] += data.counts[i][j];
+                        sums[j] += data.sums[i][j];
+                    }
+                }
+            });
+
+            // average each cell (empty cells are left blank), one row of the grid per bin along the y-axis
+            var z = [];
+            for (var row = 0; row < data.shape[0]; row++) {
+                z.push([]);
+                for (var col = 0; col < data.shape[1]; col++) {
+                    var j = row * data.shape[1] + col;
+                    z[row].push(counts[j] > 0 ? sums[j] / counts[j] : null);
+                }
+            }
+
+            var trace = Object.assign({}, data.figure.data[0], {z: z});
+            return Object.assign({}, data.figure, {data: [trace]});
+        }
+    }
+});
@@ -0,0 +1,373 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (benchmarks.py)
+April 19, 2023
+
+benchmarks.py: Micro-benchmarks for the performance-sensitive parts of the dashboard
+
+Run "python benchmarks.py <benchmark>" from the root of the repository, e.g. "python benchmarks.py forest"
+"""
+# import statements
+import argparse
+import os
+import itertools
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import utils
+import random_forest_assets as rf
+
+
+def time_calls(func, repeats, setup=None):
+    """ Times repeated calls to a function
+    Args:
+        func (function): function of interest, called without arguments
+        repeats (int): number of times the function gets called
+        setup (function): called without arguments before each call, outside of the timed section (None to skip)
+    Returns:
+        latencies (np.array): duration of each call (in seconds)
+    """
+    latencies = np.empty(repeats)
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        latencies[i] = time.perf_counter() - start
+
+    return latencies
+
+
+def bench_forest_inference(df, repeats=200, batch_rows=100000):
+    """ Compares the latency of sklearn's RandomForestRegressor.predict with that of the flattened forest inference
+        engine, for a single row (the dashboard case) and for a large batch, and checks that both agree exactly
+    Args:
+        df (pd.DataFrame): cleaned sleep data used to train the regressor
+        repeats (int): number of single-row predictions timed
+        batch_rows (int): number of rows in the batch prediction
+    Returns:
+        results (dict): median latency (in seconds) of each engine for each case
+    """
+    # retrieve the multi-output regressor of the sleep quality predictor and its flattened version
+    random_forest_reg = rf.get_model(rf.TARGET_COLS, df)
+    flat_forest = rf.get_flat_model(rf.TARGET_COLS, df)
+
+    # draw a large batch of inputs by resampling the training rows
+    df_sleep, x_feat_list = utils.get_x_feat(df)
+    x = df_sleep.loc[:, x_feat_list].values.astype(float)
+    batch = x[np.random.default_rng(0).integers(0, len(x), batch_rows)]
+    row = batch[:1]
+
+    # the flattened engine must reproduce sklearn's predictions exactly, whether it traverses the trees with NumPy
+    # (small inputs) or tree by tree (large batches)
+    for rows in [1, rf.FLAT_MAX_ROWS, batch_rows]:
+        if not np.array_equal(random_forest_reg.predict(batch[:rows]), rf.predict_flat(flat_forest, batch[:rows])):
+            raise AssertionError('the flattened forest does not match sklearn for {} rows'.format(rows))
+
+    results = {'sklearn single row': np.median(time_calls(lambda: random_forest_reg.predict(row), repeats)),
+               'flat single row': np.median(time_calls(lambda: rf.predict_flat(flat_forest, row), repeats)),
+               'sklearn batch': np.median(time_calls(lambda: random_forest_reg.predict(batch), 3)),
+               'flat batch': np.median(time_calls(lambda: rf.predict_flat(flat_forest, batch), 3))}
+
+    return results
+
+
+def parse_times_legacy(df_sleep):
+    """ The string-splitting version of utils.parse_times that the datetime version replaced, kept as a reference
+    Args:
+        df_sleep (pd.DataFrame): a data frame containing sleep statistics for test subjects
+    Returns:
+        df_sleep (pd.DataFrame): a newer version of the data frame with the parsed times
+    """
+    for col in ['Bedtime', 'Wakeup time']:
+        df_sleep[col] = df_sleep[col].astype(str)
+        df_sleep[col] = df_sleep[col].str.split().str[1]
+        df_sleep[col] = df_sleep[col].str[:2].astype(float) + df_sleep[col].str[3:5].astype(float) / 60
+
+    return df_sleep
+
+
+def bench_parse_times(filename, rows_list=(1000000, 10000000)):
+    """ Compares the throughput and peak memory of the legacy and datetime versions of utils.parse_times on large
+        inputs, and checks that both parse the times exactly the same way
+    Args:
+        filename (str): CSV file with the sleep data, whose raw bedtimes and wakeup times get resampled
+        rows_list (list of int): numbers of rows parsed
+    Returns:
+        results (dict): maps each number of rows and version to its duration (in seconds), throughput (in rows per
+                        second) and peak memory (in MiB)
+    """
+    raw = pd.read_csv(filename, usecols=['Bedtime', 'Wakeup time'])
+
+    results = {}
+    for rows in rows_list:
+        sample = raw.iloc[np.random.default_rng(0).integers(0, len(raw), rows)].reset_index(drop=True)
+
+        parsed = {}
+        for version, parse in [('legacy', parse_times_legacy), ('datetime', utils.parse_times)]:
+            # time a call, then measure its peak memory separately since tracing allocations slows it down
+            start = time.perf_counter()
+            parsed[version] = parse(sample.copy())
+            duration = time.perf_counter() - start
+
+            df_sleep = sample.copy()
+            tracemalloc.start()
+            parse(df_sleep)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del df_sleep
+
+            results['{} rows {}'.format(rows, version)] = {'seconds': duration, 'rows_per_second': rows / duration,
+                                                           'peak_mib': peak / 2 ** 20}
+
+        for col in ['Bedtime', 'Wakeup time']:
+            if not np.array_equal(parsed['legacy'][col].values, parsed['datetime'][col].values, equal_nan=True):
+                raise AssertionError('the parsed {} column does not match the legacy version'.format(col))
+        del parsed
+
+    return results
+
+
+def bench_ingestion(filename, rows=1000000, chunksizes=(10000, 100000)):
+    """ Compares the peak resident memory of reading a large CSV file whole (read_file + parse_times) with streaming it
+        into a column store chunk by chunk (ingest_file), each in a fresh process
+    Args:
+        filename (str): CSV file with the sleep data, whose rows get resampled into the large file
+        rows (int): number of rows of the large file
+        chunksizes (list of int): numbers of rows per chunk of the streaming ingestion
+    Returns:
+        results (dict): maps each case (including importing the modules only) to its duration (in seconds) and peak
+                        resident memory (in MiB)
+    """
+    # script run by each fresh process, which prints its timing and peak memory as JSON (the peak is read from VmHWM,
+    # which unlike ru_maxrss does not carry over the memory of the parent process through fork and exec, so this
+    # benchmark only runs on Linux)
+    script = ('import json, sys, time\n'
+              'import utils\n'
+              'start = time.perf_counter()\n'
+              'if sys.argv[2] == "whole":\n'
+              '    utils.parse_times(utils.read_file(sys.argv[1]))\n'
+              'elif sys.argv[2] != "import":\n'
+              '    utils.ingest_file(sys.argv[1], sys.argv[3], int(sys.argv[2]))\n'
+              'seconds = time.perf_counter() - start\n'
+              'with open("/proc/self/status") as infile:\n'
+              '    peak = [int(line.split()[1]) for line in infile if line.startswith("VmHWM:")][0]\n'
+              'print(json.dumps({"seconds": seconds, "peak_mib": peak / 1024}))')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        big_file = os.path.join(tmp_dir, 'big.csv')
+        raw = pd.read_csv(filename)
+        raw.iloc[np.random.default_rng(0).integers(0, len(raw), rows)].to_csv(big_file, index=False)
+        del raw
+
+        # importing the modules alone sets the floor of the peak memory
+        for case in ['import', 'whole'] + [str(chunksize) for chunksize in chunksizes]:
+            store_dir = os.path.join(tmp_dir, 'store-' + case)
+            output = subprocess.run([sys.executable, '-c', script, big_file, case, store_dir], capture_output=True,
+                                    text=True, check=True).stdout
+            name = {'import': 'import only', 'whole': 'read whole file'}.get(case, 'chunks of {} rows'.format(case))
+            results[name] = json.loads(output.strip().splitlines()[-1])
+
+    return results
+
+
+def callback_inputs():
+    """ Builds a realistic matrix of inputs for every Dash callback of sleep.py
+    Returns:
+        inputs (dict): maps the name of each callback to a list of argument tuples
+    """
+    # variables offered by the dropdowns of the dashboard
+    scatter_stats = ['Sleep duration', 'Sleep efficiency', 'REM sleep percentage', 'Awakenings',
+                     'Caffeine consumption 24 hrs before sleeping (mg)', 'Age', 'Bedtime']
+    contour_stats = ['Sleep duration', 'Awakenings', 'Alcohol consumption 24 hrs before sleeping (oz)', 'Age',
+                     'Gender', 'Smoking status']
+    three_dim_stats = ['Age', 'Awakenings', 'Sleep efficiency', 'Smoking status', 'Bedtime']
+    slider_ranges = [[50, 100], [60, 90], [75, 85]]
+
+    # random (but reproducible) users of the sleep quality predictor
+    rng = np.random.default_rng(0)
+    predictor_inputs = [(int(rng.integers(0, 101)), float(rng.integers(0, 97)) / 4, float(rng.integers(0, 97)) / 4,
+                         int(rng.integers(0, 5)), int(rng.integers(0, 201)), int(rng.integers(0, 6)),
+                         int(rng.integers(0, 6)), str(rng.choice(['Biological Male', 'Biological Female'])),
+                         str(rng.choice(['Yes', 'No']))) for _ in range(50)]
+
+    inputs = {'make_sleep_scatter (no trend line)': [([], ind, dep) for ind, dep in
+                                                     itertools.permutations(scatter_stats[:4], 2)],
+              'make_sleep_scatter (OLS trend line)': [(['Show Trend Line'], ind, dep) for ind, dep in
+                                                      itertools.permutations(scatter_stats[:4], 2)],
+              'show_sleep_gender_violin_plot': [(genders, stat) for genders in [['Male', 'Female'], ['Male']]
+                                                for stat in scatter_stats],
+              'show_sleep_gender_histogram': [(genders, stat) for genders in [['Male', 'Female'], ['Female']]
+                                              for stat in scatter_stats],
+              'show_efficiency_contour': [(stat1, stat2, slider) for stat1, stat2 in
+                                          itertools.combinations(contour_stats, 2) for slider in slider_ranges],
+              'show_sleep_strip': [(slider,) for slider in slider_ranges],
+              'plot_eff_forest': [(focus_col,) for focus_col in rf.TARGET_COLS],
+              'plot_sleep_hygiene': [(awakenings, caffeine, alcohol, exercise) for awakenings in [0, 3, 10]
+                                     for caffeine in [0, 200, 1000] for alcohol in [0, 5] for exercise in [1, 7]],
+              'plot_three_dim_scatter': [combo for combo in itertools.permutations(three_dim_stats, 3)][:20],
+              'calc_sleep_reg': predictor_inputs}
+
+    return inputs
+
+
+def bench_callbacks(repeats=3):
+    """ Calls every Dash callback of sleep.py directly (without starting the server) over a matrix of inputs and
+        measures its latency percentiles and peak memory
+    Args:
+        repeats (int): number of times each input of the matrix is passed to its callback
+    Returns:
+        results (dict): maps the name of each callback to its 'p50', 'p95' and 'p99' latencies (in seconds) and its
+                        'peak_mib' (peak memory allocated during a single call, in MiB)
+    """
+    # importing the dashboard loads the data and models, but does not start the server
+    import sleep
+
+    results = {}
+    for name, args_list in callback_inputs().items():
+        callback = getattr(sleep, name.split()[0])
+
+        # time every input of the matrix (after one warm-up call), emptying the prediction cache before each call so
+        # that the predictions are actually computed instead of served from the cache
+        callback(*args_list[0])
+        latencies = np.concatenate([time_calls(lambda: callback(*args), repeats, setup=utils.PREDICTION_CACHE.clear)
+                                    for args in args_list])
+
+        # measure the peak memory of a call separately, since tracing allocations slows the calls down
+        peak = 0
+        tracemalloc.start()
+        for args in args_list:
+            utils.PREDICTION_CACHE.clear()
+            tracemalloc.reset_peak()
+            callback(*args)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        results[name] = {'p50': p50, 'p95': p95, 'p99': p99, 'peak_mib': peak / 2 ** 20}
+
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """ Finds the callbacks whose median latency regressed past a threshold compared with a saved baseline
+    Args:
+        results (dict): benchmark results of interest (see bench_callbacks)
+        baseline (dict): benchmark results saved earlier
+        threshold (float): largest tolerated relative slowdown of the median latency (e.g. 0.25 for 25%)
+    Returns:
+        regressions (list of str): descriptions of the callbacks that regressed
+    """
+    regressions = []
+    for name, stats in results.items():
+        if name in baseline and stats['p50'] > baseline[name]['p50'] * (1 + threshold):
+            regressions.append('{}: p50 went from {:.2f} ms to {:.2f} ms'.format(
+                name, baseline[name]['p50'] * 1e3, stats['p50'] * 1e3))
+
+    return regressions
+
+
+def bench_cold_start(repeats=3):
+    """ Measures how long a fresh process takes to import the dashboard and to answer its first sleep quality
+        prediction, with and without preloading the data and models at import time
+    Args:
+        repeats (int): number of fresh processes started for each case
+    Returns:
+        results (dict): median import and first prediction time (in seconds) of each case
+    """
+    # script run by each fresh process, which prints its timings as JSON
+    script = ('import json, time\n'
+              'start = time.perf_counter()\n'
+              'import sleep\n'
+              'imported = time.perf_counter()\n'
+              'sleep.calc_sleep_reg(30, 23, 7, 1, 50, 0, 3, "Biological Male", "No")\n'
+              'print(json.dumps({"import": imported - start, "first prediction": time.perf_counter() - imported}))')
+
+    results = {}
+    for preload in ['0', '1']:
+        timings = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                    env=dict(os.environ, SLEEP_PRELOAD=preload)).stdout
+            timings.append(json.loads(output.strip().splitlines()[-1]))
+
+        case = 'preloaded' if preload == '1' else 'lazy'
+        for step in ['import', 'first prediction']:
+            results['{} {}'.format(case, step)] = np.median([timing[step] for timing in timings])
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the sleep efficiency dashboard')
+    parser.add_argument('benchmark', choices=['forest', 'callbacks', 'coldstart', 'parsing', 'ingestion'],
+                        help='benchmark to run')
+    parser.add_argument('--data', default='data/Sleep_Efficiency.csv', help='CSV file with the sleep data')
+    parser.add_argument('--repeats', type=int, default=3, help='number of calls per callback input')
+    parser.add_argument('--save-baseline', help='JSON file the callback results are saved to')
+    parser.add_argument('--baseline', help='JSON file with saved callback results to compare against')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 10000000],
+                        help='numbers of rows parsed by the parsing benchmark (the first one is used by the '
+                             'ingestion benchmark)')
+    parser.add_argument('--chunksizes', type=int, nargs='+', default=[10000, 100000],
+                        help='numbers of rows per chunk compared by the ingestion benchmark')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='largest tolerated relative slowdown of a callback compared with the baseline')
+    args = parser.parse_args()
+
+    if args.benchmark == 'callbacks':
+        results = bench_callbacks(args.repeats)
+        print('{:<40} {:>10} {:>10} {:>10} {:>10}'.format('callback', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'peak MiB'))
+        for name, stats in results.items():
+            print('{:<40} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                name, stats['p50'] * 1e3, stats['p95'] * 1e3, stats['p99'] * 1e3, stats['peak_mib']))
+
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as outfile:
+                json.dump(results, outfile, indent=2)
+
+        # fail if any callback got slower than the baseline allows
+        if args.baseline:
+            with open(args.baseline) as infile:
+                regressions = compare_to_baseline(results, json.load(infile), args.threshold)
+            for regression in regressions:
+                print('REGRESSION', regression)
+            if regressions:
+                sys.exit(1)
+
+    if args.benchmark == 'coldstart':
+        for case, duration in bench_cold_start(args.repeats).items():
+            print('{:<30} {:>8.3f} s'.format(case, duration))
+
+    if args.benchmark == 'parsing':
+        print('{:<26} {:>10} {:>14} {:>10}'.format('case', 'seconds', 'rows/s', 'peak MiB'))
+        for case, stats in bench_parse_times(args.data, args.rows).items():
+            print('{:<26} {:>10.2f} {:>14,.0f} {:>10.1f}'.format(case, stats['seconds'], stats['rows_per_second'],
+                                                                 stats['peak_mib']))
+
+    if args.benchmark == 'ingestion':
+        print('{:<26} {:>10} {:>10}'.format('case', 'seconds', 'peak MiB'))
+        for case, stats in bench_ingestion(args.data, args.rows[0], args.chunksizes).items():
+            print('{:<26} {:>10.2f} {:>10.1f}'.format(case, stats['seconds'], stats['peak_mib']))
+
+    if args.benchmark == 'forest':
+        # read in and clean the sleep data
+        efficiency = utils.read_sleep_data(args.data)
+
+        results = bench_forest_inference(efficiency)
+        for case, latency in results.items():
+            print('{:<20} {:>12.1f} us'.format(case, latency * 1e6))
+        print('single row speedup: {:.1f}x, batch speedup: {:.1f}x'.format(
+            results['sklearn single row'] / results['flat single row'],
+            results['sklearn batch'] / results['flat batch']))
+
+
+if __name__ == '__main__':
+    main()
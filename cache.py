@@ -0,0 +1,103 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (cache.py)
+April 19, 2023
+
+cache.py: A small thread-safe least-recently-used cache shared by the dashboard's memoized computations
+"""
+# import statements
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ A bounded mapping that evicts its least recently used entries and counts its hits and misses
+
+    The cache can be bounded by a number of entries, by a total size (as measured by the sizeof function), or both
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        """ Creates an empty cache
+        Args:
+            maxsize (int): maximum number of entries kept in the cache (None for no limit)
+            maxbytes (int): maximum total size of the entries kept in the cache (None for no limit)
+            sizeof (function): computes the size of a value (only needed if maxbytes is given)
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Looks up a value, marking it as the most recently used one
+        Args:
+            key (hashable): key of the value of interest
+            default: value returned if the key is not in the cache
+        Returns:
+            the cached value, or default if the key is not in the cache
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """ Stores a value, evicting the least recently used entries if the cache grows past its bounds
+        Args:
+            key (hashable): key of the value
+            value: value to be cached
+        """
+        size = self.sizeof(value) if self.sizeof is not None else 0
+
+        # values that could never fit in the cache are not stored at all
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+
+            # evict the least recently used entries until the cache is within its bounds again
+            while (self.maxsize is not None and len(self._entries) > self.maxsize) or \
+                    (self.maxbytes is not None and self.nbytes > self.maxbytes):
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        """ Removes every entry from the cache (the hit and miss counters are kept)
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ Summarizes how well the cache is doing
+        Returns:
+            stats (dict): number of hits, misses and evictions, current number of entries and size, and hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                     'entries': len(self._entries), 'bytes': self.nbytes,
+                     'hit_rate': self.hits / lookups if lookups else 0.0}
+
+        return stats
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,200 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (column_store.py)
+April 19, 2023
+
+column_store.py: A columnar on-disk store for cleaned data frames that can be memory-mapped back in without parsing
+
+A store is a directory holding one raw binary file per column plus a meta.json file describing the columns. Numeric and
+datetime columns are written as is; text columns are written as integer codes into a list of categories kept in
+meta.json. Rows can be appended chunk by chunk, and a store is only readable once it was closed (meta.json is written
+last), so a half-written store is never mistaken for a complete one.
+"""
+# import statements
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# name of the column holding the index of the data frame
+INDEX_COL = '__index__'
+
+# name of the file describing the columns of a store
+META_FILE = 'meta.json'
+
+
+def _is_text(series):
+    """ Checks whether a column holds text (stored as codes into a list of categories)
+    Args:
+        series (pd.Series): column of interest
+    Returns:
+        bool: True if the column holds text
+    """
+    return not (pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype) or
+                pd.api.types.is_datetime64_dtype(series.dtype))
+
+
+class ColumnStoreWriter:
+    """ Writes a data frame into a column store, one chunk of rows at a time
+    """
+
+    def __init__(self, store_dir):
+        """ Starts an empty store
+        Args:
+            store_dir (str): directory of the store (created if needed)
+        """
+        self.store_dir = store_dir
+        self.rows = 0
+        self.columns = None
+        self._codes = {}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, position):
+        return os.path.join(self.store_dir, '{}.bin'.format(position))
+
+    def _widen(self, position, old_dtype, new_dtype, block_rows=1000000):
+        """ Rewrites the rows of a column written so far with a wider data type, one block of rows at a time
+        Args:
+            position (int): position of the column
+            old_dtype (np.dtype): data type the rows were written with
+            new_dtype (np.dtype): data type of interest
+            block_rows (int): number of rows converted at once
+        """
+        if not self.rows:
+            return
+
+        path = self._path(position)
+        old_values = np.memmap(path, dtype=old_dtype, mode='r', shape=(self.rows,))
+        with open(path + '.tmp', 'wb') as outfile:
+            for start in range(0, self.rows, block_rows):
+                old_values[start:start + block_rows].astype(new_dtype).tofile(outfile)
+        del old_values
+        os.replace(path + '.tmp', path)
+
+    def append(self, df):
+        """ Appends the rows of a data frame (which must have the same columns as the first chunk) to the store
+        Args:
+            df (pd.DataFrame): rows of interest
+        """
+        # an empty chunk adds nothing (and pd.read_csv may have guessed the wrong data types for its columns)
+        if not len(df) and self.columns is not None:
+            return
+
+        df = df.reset_index(names=INDEX_COL)
+
+        # describe the columns from the first chunk holding rows
+        if self.columns is None or not self.rows:
+            self.columns = [{'name': col, 'text': _is_text(df[col]), 'dtype': str(df[col].dtype),
+                             'categories': []} for col in df.columns]
+            self._codes = {}
+        elif [col['name'] for col in self.columns] != list(df.columns):
+            raise ValueError('the columns of the chunk do not match the columns of the store')
+
+        for position, col in enumerate(self.columns):
+            series = df[col['name']]
+            if col['text'] != _is_text(series):
+                raise ValueError('column {} holds text in some chunks only'.format(col['name']))
+
+            if col['text']:
+                # map the values of the chunk to codes, extending the categories with the values never seen before
+                codes_of = self._codes.setdefault(position, {})
+                chunk_codes, uniques = pd.factorize(series.to_numpy(dtype=object))
+                mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+                mapping[-1] = -1
+                for i, value in enumerate(uniques):
+                    if value not in codes_of:
+                        codes_of[value] = len(col['categories'])
+                        col['categories'].append(str(value))
+                    mapping[i] = codes_of[value]
+                values = mapping[chunk_codes]
+            else:
+                # a column read as integers in the earlier chunks may hold floats in this one (like pd.read_csv would
+                # infer over the whole file), in which case the rows written so far get widened
+                dtype = np.result_type(np.dtype(col['dtype']), series.dtype)
+                if dtype != np.dtype(col['dtype']):
+                    self._widen(position, np.dtype(col['dtype']), dtype)
+                    col['dtype'] = str(dtype)
+                values = np.ascontiguousarray(series.to_numpy(dtype=col['dtype']))
+
+            with open(self._path(position), 'ab') as outfile:
+                values.tofile(outfile)
+
+        self.rows += len(df)
+
+    def close(self, extra_meta=None):
+        """ Finishes the store by writing its description, which makes it readable
+        Args:
+            extra_meta (dict): additional information saved along with the description (e.g. the source's fingerprint)
+        """
+        meta = {'rows': self.rows, 'columns': self.columns or [], 'extra': extra_meta or {}}
+
+        tmp_path = os.path.join(self.store_dir, META_FILE + '.tmp')
+        with open(tmp_path, 'w') as outfile:
+            json.dump(meta, outfile)
+        os.replace(tmp_path, os.path.join(self.store_dir, META_FILE))
+
+
+def write_store(df, store_dir, extra_meta=None):
+    """ Writes a whole data frame into a column store
+    Args:
+        df (pd.DataFrame): data frame of interest
+        store_dir (str): directory of the store
+        extra_meta (dict): additional information saved along with the description of the store
+    """
+    writer = ColumnStoreWriter(store_dir)
+    writer.append(df)
+    writer.close(extra_meta)
+
+
+def read_meta(store_dir):
+    """ Reads the description of a column store
+    Args:
+        store_dir (str): directory of the store
+    Returns:
+        meta (dict): description of the store, or None if the store does not exist or was never closed
+    """
+    path = os.path.join(store_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as infile:
+        meta = json.load(infile)
+
+    return meta
+
+
+def read_store(store_dir):
+    """ Reads a column store back into a data frame, memory-mapping its numeric columns instead of copying them
+    Args:
+        store_dir (str): directory of the store
+    Returns:
+        df (pd.DataFrame): the data frame that was written into the store
+    """
+    meta = read_meta(store_dir)
+    if meta is None:
+        raise FileNotFoundError('no complete column store in ' + store_dir)
+
+    data = {}
+    for position, col in enumerate(meta['columns']):
+        dtype = np.dtype(np.int32) if col['text'] else np.dtype(col['dtype'])
+        path = os.path.join(store_dir, '{}.bin'.format(position))
+
+        # empty files cannot be memory-mapped
+        if meta['rows']:
+            # keep the mapping, but hand plain arrays to pandas
+            values = np.memmap(path, dtype=dtype, mode='r', shape=(meta['rows'],)).view(np.ndarray)
+        else:
+            values = np.empty(0, dtype=dtype)
+
+        if col['text']:
+            # turn the codes back into text (code -1 marks a missing value)
+            categories = np.array(col['categories'] + [None], dtype=object)
+            values = pd.Series(categories[values], dtype=object).astype(col['dtype']).values
+
+        data[col['name']] = values
+
+    index = data.pop(INDEX_COL)
+    df = pd.DataFrame(data, index=pd.Index(index), copy=False)
+
+    return df
@@ -0,0 +1,200 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (data_cube.py)
+April 19, 2023
+
+data_cube.py: A pre-aggregated data cube answering cohort counts, means and variances without going over the rows
+
+The rows of the cleaned sleep data are grouped into the cells of a few low-cardinality dimensions (gender, smoking
+status, awakenings, exercise days and binned sleep efficiency and age). Each cell keeps its number of rows and the
+count, sum and sum of squares of every numeric column, so the count, mean and variance of any cohort made of whole cells
+only takes arithmetic over the cells. Only the cells holding rows are kept, and appending rows merges their cells into
+the cube without going over the rows already in it.
+
+Numeric dimensions are binned by their half steps in units of their bin width (see utils.half_steps): a range whose
+bounds are multiples of the bin width, e.g. any range of whole sleep efficiencies, selects exactly the rows whose value
+lies within it.
+"""
+# import statements
+import numpy as np
+import pandas as pd
+import utils
+
+# dimensions of the cube, mapped to the width of their bins (None for the text dimensions, whose cells hold one value)
+DIMENSIONS = {'Gender': None, 'Smoking status': None, 'Awakenings': 1, 'Exercise frequency (in days per week)': 1,
+              'Sleep efficiency': 1, 'Age': 10}
+
+# key of the rows missing a numeric dimension (never within a range)
+MISSING_KEY = np.iinfo(np.int64).min
+
+
+def _aggregate(keys, rows, counts, sums, sumsq):
+    """ Adds up the statistics of the rows (or cells) sharing the same key
+    Args:
+        keys (np.array): key of each row, one column per dimension
+        rows (np.array): number of rows behind each row (1 for actual rows)
+        counts (np.array): number of values of each measure behind each row, one column per measure
+        sums (np.array): sum of each measure behind each row
+        sumsq (np.array): sum of the squares of each measure behind each row
+    Returns:
+        the unique keys, and the rows, counts, sums and sums of squares of each of them
+    """
+    # number the distinct keys in lexicographic order, through a single integer per key when the number of possible
+    # keys fits in one (much faster than sorting the keys as rows)
+    ids = np.zeros(len(keys), dtype=np.int64)
+    possible = 1
+    for column in keys.T:
+        codes, uniques = pd.factorize(column, sort=True)
+        possible *= max(len(uniques), 1)
+        ids = ids * len(uniques) + codes
+    if possible < 2 ** 62:
+        first, inverse = np.unique(ids, return_index=True, return_inverse=True)[1:]
+        cells = keys[first]
+    else:
+        cells, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+
+    def add_up(values):
+        return np.column_stack([np.bincount(inverse, weights=column, minlength=len(cells)) for column in values.T]) \
+            if values.shape[1] else np.zeros((len(cells), 0))
+
+    return cells, np.bincount(inverse, weights=rows, minlength=len(cells)), add_up(counts), add_up(sums), add_up(sumsq)
+
+
+class DataCube:
+    """ Counts, sums and sums of squares of the numeric columns of a data frame over the cells of a few dimensions
+    """
+
+    def __init__(self, dimensions=None):
+        """ Starts an empty cube
+        Args:
+            dimensions (dict): dimensions of the cube mapped to the width of their bins (see DIMENSIONS)
+        """
+        self.dimensions = dict(DIMENSIONS if dimensions is None else dimensions)
+        self.measures = None
+        self.categories = {dim: [] for dim, width in self.dimensions.items() if width is None}
+        self.keys = np.empty((0, len(self.dimensions)), dtype=np.int64)
+        self.rows = np.empty(0)
+        self.counts = self.sums = self.sumsq = None
+        self._codes = {dim: {} for dim in self.categories}
+
+    def _row_keys(self, df):
+        """ Finds the cell of each row of a data frame
+        Args:
+            df (pd.DataFrame): rows of interest
+        Returns:
+            keys (np.array): key of each row, one column per dimension
+        """
+        keys = np.empty((len(df), len(self.dimensions)), dtype=np.int64)
+        for position, (dim, width) in enumerate(self.dimensions.items()):
+            if width is None:
+                # map the values to codes, extending the categories with the values never seen before (-1 if missing)
+                codes_of = self._codes[dim]
+                chunk_codes, uniques = pd.factorize(df[dim])
+                mapping = np.empty(len(uniques) + 1, dtype=np.int64)
+                mapping[-1] = -1
+                for i, value in enumerate(uniques):
+                    if value not in codes_of:
+                        codes_of[value] = len(self.categories[dim])
+                        self.categories[dim].append(value)
+                    mapping[i] = codes_of[value]
+                keys[:, position] = mapping[chunk_codes]
+            else:
+                values = df[dim].to_numpy(dtype=float) / width
+                missing = np.isnan(values)
+                keys[:, position] = utils.half_steps(np.where(missing, 0, values))
+                keys[missing, position] = MISSING_KEY
+
+        return keys
+
+    def append(self, df):
+        """ Adds the rows of a data frame (which must have the same numeric columns as the first one) to the cube
+        Args:
+            df (pd.DataFrame): rows of interest
+        """
+        # measure every numeric column of the first rows
+        if self.measures is None:
+            self.measures = list(df.select_dtypes(include='number').columns)
+            self.counts, self.sums, self.sumsq = (np.empty((0, len(self.measures))) for _ in range(3))
+        if not len(df):
+            return
+
+        values = df[self.measures].to_numpy(dtype=float)
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0)
+
+        # group the new rows into cells, then merge them with the cells already in the cube
+        cells = _aggregate(self._row_keys(df), np.ones(len(df)), present, values, values ** 2)
+        self.keys, self.rows, self.counts, self.sums, self.sumsq = _aggregate(
+            np.concatenate([self.keys, cells[0]]), np.concatenate([self.rows, cells[1]]),
+            *(np.concatenate([old, new]) for old, new in zip([self.counts, self.sums, self.sumsq], cells[2:])))
+
+    def select(self, filters=None):
+        """ Finds the cells of a cohort
+        Args:
+            filters (dict): maps dimensions to the values of interest, either a list of values for a text dimension or a
+                            range [min, max] (bounds included, multiples of the bin width) for a numeric dimension
+        Returns:
+            mask (np.array): True for the cells of the cohort
+        """
+        mask = np.ones(len(self.keys), dtype=bool)
+        for dim, values in (filters or {}).items():
+            position = list(self.dimensions).index(dim)
+            width = self.dimensions[dim]
+            if width is None:
+                codes = [self._codes[dim][value] for value in values if value in self._codes[dim]]
+                mask &= np.isin(self.keys[:, position], codes)
+            else:
+                lo, hi = np.ceil(2 * values[0] / width), np.floor(2 * values[1] / width)
+                mask &= (self.keys[:, position] >= lo) & (self.keys[:, position] <= hi)
+
+        return mask
+
+    def stats(self, measure, filters=None, by=None):
+        """ Computes the number of rows, count, mean and variance of a measure over a cohort, optionally per value (or
+            bin) of a dimension
+        Args:
+            measure (str): numeric column of interest
+            filters (dict): the cohort of interest (see select), every row if None
+            by (str): dimension splitting the cohort into groups (None for a single group)
+        Returns:
+            stats (dict): the number of 'rows', the 'count' of values of the measure, their 'mean' and (sample) 'var',
+                          or a dict mapping each group (each text value, or the lower bound of each bin, in increasing
+                          order of code or bin) to those statistics if by is given
+        """
+        mask = self.select(filters)
+        column = self.measures.index(measure)
+
+        if by is None:
+            groups = np.zeros(np.count_nonzero(mask), dtype=np.int64)
+            labels = [None]
+        else:
+            position = list(self.dimensions).index(by)
+            keys = self.keys[mask, position]
+            width = self.dimensions[by]
+            if width is None:
+                valid = keys >= 0
+                groups, labels = keys, self.categories[by]
+            else:
+                valid = keys != MISSING_KEY
+                bins = keys // 2
+                labels = np.unique(bins[valid])
+                groups = np.searchsorted(labels, bins)
+                labels = (labels * width).tolist()
+            mask[np.flatnonzero(mask)[~valid]] = False
+            groups = groups[valid]
+
+        # add up the selected cells of each group
+        totals = [np.bincount(groups, weights=stat, minlength=len(labels))
+                  for stat in (self.rows[mask], self.counts[mask, column], self.sums[mask, column],
+                               self.sumsq[mask, column])]
+
+        stats = {}
+        for i, label in enumerate(labels):
+            rows, count, total, total_sq = (stat[i] for stat in totals)
+            mean = total / count if count else np.nan
+            var = max(total_sq - count * mean ** 2, 0) / (count - 1) if count > 1 else np.nan
+            stats[label] = {'rows': int(rows), 'count': int(count), 'mean': mean, 'var': var}
+
+        return stats[None] if by is None else stats
@@ -0,0 +1,480 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (datastore.py)
+April 19, 2023
+
+datastore.py: Lazily loaded data and models shared by the dashboard's callbacks
+
+Nothing is read or trained when this module is imported. Each piece of state is built the first time a callback needs
+it, or all at once by preload(), which a prefork server can call in its parent process so that the forked workers share
+the data and models copy-on-write instead of each loading their own.
+
+New sleep records can be appended to the loaded data with append_rows(), which updates the state built so far
+incrementally instead of building it again (see append_rows for the random forest regressors).
+
+The state lives in immutable snapshots (see Snapshot). Changing the data never modifies a snapshot: a new snapshot is
+built on the side and then swapped in as a whole, so a request served by pin_requests() reads the same snapshot from
+start to end. Setting the SLEEP_HOT_RELOAD environment variable to 1 (see sleep.py) watches DATA_FILE and reloads it in
+a background thread whenever it changes (see watch), logging how long each piece of state took to build.
+"""
+# import statements
+import contextlib
+import copy
+import logging
+import os
+import threading
+import time
+import pandas as pd
+import utils
+import random_forest_assets as rf
+from data_cube import DataCube
+
+# CSV file containing the sleep data shown by the dashboard
+DATA_FILE = os.environ.get('SLEEP_DATA_FILE', 'data/Sleep_Efficiency.csv')
+
+# the random forest regressors are fully retrained once the rows appended since they were last trained from scratch
+# outnumber this fraction of the rows they were trained on, or once the mean of one of their features or targets over
+# every row drifted by more than this many standard deviations from its mean over the rows they were trained on
+# (configured through the SLEEP_REBUILD_FRACTION and SLEEP_DRIFT_THRESHOLD environment variables)
+REBUILD_FRACTION = float(os.environ.get('SLEEP_REBUILD_FRACTION', 0.25))
+DRIFT_THRESHOLD = float(os.environ.get('SLEEP_DRIFT_THRESHOLD', 0.1))
+
+# number of seconds between two checks of DATA_FILE by the file watcher (configured through the SLEEP_RELOAD_INTERVAL
+# environment variable)
+RELOAD_INTERVAL = float(os.environ.get('SLEEP_RELOAD_INTERVAL', 5))
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    """ One version of the sleep data and of everything derived from it
+
+    Each piece of state is built the first time it is needed (only once, even if several threads ask for it at the same
+    time) and never changes afterwards, so whoever holds a snapshot keeps a consistent view of the data
+    """
+
+    def __init__(self, state=None, source=None):
+        """ Starts a snapshot
+        Args:
+            state (dict): pieces of state already built, keyed by their name
+            source (tuple): fingerprint of the version of DATA_FILE the sleep data was read from (see _fingerprint),
+                            recorded when the sleep data is read if None
+        """
+        self._state = dict(state or {})
+        self._lock = threading.RLock()
+        self.source = source
+
+    def get(self, name, build):
+        """ Retrieves a piece of state, building it the first time it is needed
+        Args:
+            name (str): name of the piece of state
+            build (function): builds the piece of state (called without arguments, and reading the other pieces of
+                              state from this snapshot whichever snapshot is the latest)
+        Returns:
+            the piece of state
+        """
+        # fast path: the state was already built
+        if name in self._state:
+            return self._state[name]
+
+        with self._lock:
+            if name not in self._state:
+                with pinned(self):
+                    self._state[name] = build()
+
+        return self._state[name]
+
+    def built(self, name):
+        """ Checks whether a piece of state was already built
+        Args:
+            name (str): name of the piece of state
+        Returns:
+            bool: True if the piece of state was built
+        """
+        return name in self._state
+
+
+# the latest snapshot, the snapshot it replaced (whose regressors are only released once it is replaced too, so that
+# requests still reading it never have to load them again) and the snapshot pinned by each thread
+_SNAPSHOT = Snapshot()
+_RETIRED = None
+_LOCAL = threading.local()
+
+# serializes the changes of the data (reloads and appends), which never block the requests
+_SWAP_LOCK = threading.Lock()
+
+# process running the file watcher, and the event stopping it
+_WATCHER = {'pid': None, 'stop': None}
+_WATCHER_LOCK = threading.Lock()
+
+
+def current():
+    """ Retrieves the snapshot read by the current thread: the snapshot pinned for it, or else the latest one
+    Returns:
+        snapshot (Snapshot): the snapshot of interest
+    """
+    snapshot = getattr(_LOCAL, 'snapshot', None)
+
+    return snapshot if snapshot is not None else _SNAPSHOT
+
+
+@contextlib.contextmanager
+def pinned(snapshot=None):
+    """ Makes the current thread read the same snapshot until the end of the with statement
+    Args:
+        snapshot (Snapshot): the snapshot of interest (defaults to the one currently read by the thread)
+    Yields:
+        snapshot (Snapshot): the pinned snapshot
+    """
+    previous = getattr(_LOCAL, 'snapshot', None)
+    _LOCAL.snapshot = snapshot if snapshot is not None else current()
+    try:
+        yield _LOCAL.snapshot
+    finally:
+        _LOCAL.snapshot = previous
+
+
+def _get(name, build):
+    """ Retrieves a piece of state from the snapshot read by the current thread (see Snapshot.get)
+    Args:
+        name (str): name of the piece of state
+        build (function): builds the piece of state (called without arguments)
+    Returns:
+        the piece of state
+    """
+    return current().get(name, build)
+
+
+def _load_efficiency():
+    """ Reads in the sleep data, performs basic cleaning (memory-mapping the cleaned data cached by an earlier process,
+        unless the file changed since) and encodes its binary categorical columns once for every callback and regressor
+    Returns:
+        efficiency (pd.DataFrame): the cleaned sleep data, with the bedtimes and wakeup times in military time and the
+                                   columns in utils.ENCODED_COLS
+    """
+    # remember which version of the file the snapshot holds, before reading it (so that a change made while the file is
+    # read gets reloaded afterwards)
+    current().source = _fingerprint()
+
+    return utils.read_sleep_data(DATA_FILE)
+
+
+def efficiency():
+    """ Retrieves the cleaned sleep data shown by the dashboard (shared by every callback, so it must not be modified)
+    Returns:
+        efficiency (pd.DataFrame): the cleaned sleep data, with the bedtimes and wakeup times in military time and the
+                                   columns in utils.ENCODED_COLS
+    """
+    return _get('efficiency', _load_efficiency)
+
+
+def regression_table():
+    """ Retrieves the regression table of every numeric column of the sleep data, behind the scatter plot's trend line
+    Returns:
+        table (dict): the regression table (see utils.regression_table)
+    """
+    return _get('regression_table', lambda: utils.regression_table(efficiency()))
+
+
+def range_index():
+    """ Retrieves the range index of the sleep data, which answers the efficiency slider's filters by binary search
+    Returns:
+        index (dict): the range index of the sleep data (see utils.range_index)
+    """
+    return _get('range_index', lambda: utils.range_index(efficiency()))
+
+
+def _build_data_cube():
+    """ Aggregates the sleep data into a data cube
+    Returns:
+        cube (DataCube): the counts, sums and sums of squares of the numeric columns over the cells of the cube
+    """
+    cube = DataCube()
+    cube.append(efficiency())
+
+    return cube
+
+
+def data_cube():
+    """ Retrieves the data cube of the sleep data, which answers the cohort counts, means and variances of the charts
+    Returns:
+        cube (DataCube): the data cube of the sleep data (see data_cube.py)
+    """
+    return _get('data_cube', _build_data_cube)
+
+
+def distributions():
+    """ Retrieves the summaries of the distribution of every numeric column per gender, behind the violin plot and
+        histogram
+    Returns:
+        summaries (dict): the distribution summaries of the sleep data (see utils.distribution_summaries)
+    """
+    return _get('distributions', lambda: utils.distribution_summaries(efficiency(), 'Gender'))
+
+
+def hygiene_index():
+    """ Retrieves the average and sorted values of each dimension of the sleep hygiene radar chart
+    Returns:
+        index (dict): the hygiene index of the sleep data (see utils.hygiene_index)
+    """
+    return _get('hygiene_index', lambda: utils.hygiene_index(efficiency()))
+
+
+def predictor_model():
+    """ Retrieves the flattened multi-output random forest regressor behind the sleep quality predictor (training it
+        only if it was never persisted)
+    Returns:
+        flat_forest (dict): the flattened regressor (see rf.flatten_forest)
+    """
+    return _get('predictor_model', lambda: rf.get_flat_model(rf.TARGET_COLS, efficiency()))
+
+
+def feature_importance_figures():
+    """ Retrieves the feature importance bar charts of the regressors predicting each sleep quality statistic
+    Returns:
+        figs (dict): maps each sleep quality statistic to its feature importance bar chart
+    """
+    return _get('feature_importance_figures', lambda: rf.feature_importance_figures(efficiency(), rf.TARGET_COLS))
+
+
+def preload():
+    """ Builds every piece of state of the snapshot read by the current thread right away (e.g. in the parent process
+        of a prefork server)
+    Returns:
+        timings (dict): number of seconds spent building each piece of state (0 for those already built)
+    """
+    timings = {}
+    for accessor in [efficiency, regression_table, range_index, data_cube, distributions, hygiene_index,
+                     predictor_model, feature_importance_figures]:
+        start = time.perf_counter()
+        accessor()
+        timings[accessor.__name__] = time.perf_counter() - start
+
+    return timings
+
+
+def _swap(snapshot):
+    """ Makes a snapshot the latest one, releasing the regressors of the snapshot retired by the previous swap (the
+        caller holds _SWAP_LOCK)
+    Args:
+        snapshot (Snapshot): the new snapshot
+    """
+    global _SNAPSHOT, _RETIRED
+
+    retired, _RETIRED = _RETIRED, _SNAPSHOT
+    _SNAPSHOT = snapshot
+
+    # forget the regressors of the older data, unless the newer snapshots have the same data
+    if retired is not None and retired.built('efficiency'):
+        old_df = retired.get('efficiency', None)
+        versions = {rf.dataset_hash(kept.get('efficiency', None)) for kept in (_RETIRED, _SNAPSHOT)
+                    if kept.built('efficiency')}
+        if rf.dataset_hash(old_df) not in versions:
+            for focus_col in [rf.TARGET_COLS] + rf.TARGET_COLS:
+                rf.release_models(focus_col, old_df)
+
+
+def reload():
+    """ Builds a new snapshot from DATA_FILE in the calling thread, then swaps it in (requests keep reading the latest
+        snapshot in the meantime, so none of them waits for the reload)
+    Returns:
+        timings (dict): number of seconds spent building each piece of state (see preload)
+    """
+    with _SWAP_LOCK:
+        start = time.perf_counter()
+        snapshot = Snapshot()
+        with pinned(snapshot):
+            timings = preload()
+        _swap(snapshot)
+
+    logger.info('reloaded %s (%d rows) in %.2f s: %s', DATA_FILE, len(snapshot.get('efficiency', None)),
+                time.perf_counter() - start,
+                ', '.join('{} {:.2f} s'.format(name, seconds) for name, seconds in timings.items()))
+
+    return timings
+
+
+def _fingerprint():
+    """ Identifies the current version of DATA_FILE without reading it
+    Returns:
+        fingerprint (tuple): size and modification time of the file (None if the file is missing, e.g. while it is
+                             being replaced)
+    """
+    try:
+        stat = os.stat(DATA_FILE)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _watch(interval, stop):
+    """ Reloads DATA_FILE whenever it differs from the version the latest snapshot was read from, until stop is set (run
+        by the file watcher's thread)
+    Args:
+        interval (float): number of seconds between two checks of the file
+        stop (threading.Event): event stopping the watcher
+    """
+    pending = failed = None
+    while not stop.wait(interval):
+        # a snapshot that did not read the sleep data yet will read the latest version of the file when it needs it
+        fingerprint = _fingerprint()
+        snapshot = current()
+        if fingerprint is None or not snapshot.built('efficiency') or fingerprint in (snapshot.source, failed):
+            pending = None
+            continue
+
+        # only reload once the file stopped changing for a whole interval, so that a half-written file is never read
+        if fingerprint != pending:
+            pending = fingerprint
+            continue
+
+        pending = None
+        try:
+            reload()
+        except Exception:
+            # keep serving the latest snapshot until the file changes again
+            failed = fingerprint
+            logger.exception('reloading %s failed, the dashboard keeps showing the data loaded before', DATA_FILE)
+
+
+def watch(interval=RELOAD_INTERVAL):
+    """ Starts watching DATA_FILE from a background thread of the current process (only once per process), reloading it
+        whenever it changes (see reload)
+    Args:
+        interval (float): number of seconds between two checks of the file
+    Returns:
+        stop (threading.Event): event stopping the watcher once set
+    """
+    with _WATCHER_LOCK:
+        if _WATCHER['pid'] != os.getpid():
+            stop = threading.Event()
+            threading.Thread(target=_watch, args=(interval, stop), name='sleep-data-watcher', daemon=True).start()
+            _WATCHER.update(pid=os.getpid(), stop=stop)
+
+    return _WATCHER['stop']
+
+
+def pin_requests(server, watch_file=False):
+    """ Makes every request served by a Flask server read a single snapshot (the latest one when the request comes in),
+        so that a callback never mixes the data of two snapshots
+    Args:
+        server (flask.Flask): the server of interest
+        watch_file (bool): whether each process serving requests watches DATA_FILE (see watch), starting when it serves
+                           its first request (threads do not survive the fork of a prefork server's workers)
+    """
+    def pin():
+        if watch_file:
+            watch()
+        _LOCAL.snapshot = _SNAPSHOT
+
+    def unpin(exception=None):
+        _LOCAL.snapshot = None
+
+    server.before_request(pin)
+    server.teardown_request(unpin)
+
+
+def _update_forests(old, df_old, df, new_rows):
+    """ Updates the random forest regressors that were already loaded for the appended rows: extended with trees fitted
+        on the new rows (see rf.extend_model), or trained from scratch on every row past REBUILD_FRACTION or
+        DRIFT_THRESHOLD
+    Args:
+        old (Snapshot): snapshot of the sleep data before the rows were appended
+        df_old (pd.DataFrame): sleep data before the rows were appended
+        df (pd.DataFrame): sleep data with the appended rows
+        new_rows (pd.DataFrame): the appended rows (cleaned)
+    Returns:
+        state (dict): the updated pieces of state
+        action (str): 'extended', 'rebuilt', or None if no regressor was loaded
+    """
+    focus_cols = []
+    if old.built('predictor_model'):
+        focus_cols.append(rf.TARGET_COLS)
+    if old.built('feature_importance_figures'):
+        focus_cols += rf.TARGET_COLS
+    if not focus_cols:
+        return {}, None
+
+    # the rows the regressors were last trained on from scratch, and the rows appended since
+    cols = utils.FEATURE_COLS + rf.TARGET_COLS
+    base = old.get('forest_base', None) if old.built('forest_base') else None
+    base = base or {'rows': len(df_old), 'table': utils.regression_table(df_old, cols),
+                    'appended': utils.regression_table(df_old.iloc[:0], cols)}
+    appended = utils.merge_regression_tables(base['appended'], utils.regression_table(new_rows, cols))
+    drift = utils.mean_shift(base['table'], utils.merge_regression_tables(base['table'], appended))
+
+    if appended['n'] > REBUILD_FRACTION * base['rows'] or drift > DRIFT_THRESHOLD:
+        # train every regressor again on all the rows (see rf.get_model)
+        action = 'rebuilt'
+        forest_base = {'rows': len(df), 'table': utils.regression_table(df, cols),
+                       'appended': utils.regression_table(df.iloc[:0], cols)}
+    else:
+        action = 'extended'
+        for focus_col in focus_cols:
+            rf.extend_model(focus_col, df_old, df, new_rows)
+        forest_base = dict(base, appended=appended)
+
+    state = {'forest_base': forest_base}
+    if old.built('predictor_model'):
+        state['predictor_model'] = rf.get_flat_model(rf.TARGET_COLS, df)
+    if old.built('feature_importance_figures'):
+        state['feature_importance_figures'] = rf.feature_importance_figures(df, rf.TARGET_COLS)
+
+    return state, action
+
+
+def append_rows(raw_rows):
+    """ Appends new sleep records to the sleep data, cleaned like the rows of DATA_FILE, and updates the state built so
+        far from the new rows only: the regression table, range index, data cube and hygiene index are merged with the
+        summaries of the new rows, and the random forest regressors are extended with trees fitted on the new rows
+        (unless too many rows were appended, or the data drifted too far, since they were last trained from scratch,
+        see REBUILD_FRACTION and DRIFT_THRESHOLD). The distribution summaries (quartiles and density curves) are built
+        again from every row the next time they are needed. The new rows are only kept in memory: reloading DATA_FILE
+        (see reload) replaces them with the rows of the file.
+    Args:
+        raw_rows (pd.DataFrame): new rows, with the columns and formats of DATA_FILE
+    Returns:
+        counts (dict): number of rows read, kept and dropped (because of NA values), and how the regressors were updated
+                       ('forests': 'extended', 'rebuilt', or None if none was loaded)
+    """
+    with _SWAP_LOCK:
+        start_time = time.perf_counter()
+        old = _SNAPSHOT
+        with pinned(old):
+            df_old = efficiency()
+        new_rows = utils.clean_rows(raw_rows)
+        counts = {'rows_read': len(raw_rows), 'rows_kept': len(new_rows), 'rows_dropped': len(raw_rows) - len(new_rows),
+                  'forests': None}
+        if not len(new_rows):
+            return counts
+
+        # number the new rows after the rows already loaded
+        start = df_old.index.max() + 1 if len(df_old) else 0
+        new_rows.index = new_rows.index - new_rows.index.min() + start
+        df = pd.concat([df_old, new_rows])
+
+        # the distribution summaries are left out, to be built again from every row the next time they are needed
+        state = {'efficiency': df}
+        if old.built('regression_table'):
+            table = old.get('regression_table', None)
+            state['regression_table'] = utils.merge_regression_tables(table,
+                                                                      utils.regression_table(new_rows, table['cols']))
+        if old.built('range_index'):
+            state['range_index'] = utils.extend_range_index(old.get('range_index', None), new_rows)
+        if old.built('data_cube'):
+            cube = copy.deepcopy(old.get('data_cube', None))
+            cube.append(new_rows)
+            state['data_cube'] = cube
+        if old.built('hygiene_index'):
+            state['hygiene_index'] = utils.extend_hygiene_index(old.get('hygiene_index', None), new_rows)
+
+        forest_state, counts['forests'] = _update_forests(old, df_old, df, new_rows)
+        state.update(forest_state)
+        _swap(Snapshot(state, source=old.source))
+
+    logger.info('appended %d rows (%d dropped) in %.2f s, forests %s', counts['rows_kept'], counts['rows_dropped'],
+                time.perf_counter() - start_time, counts['forests'])
+
+    return counts
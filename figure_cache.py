@@ -0,0 +1,80 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (figure_cache.py)
+April 19, 2023
+
+figure_cache.py: Memoization of the dashboard's figure callbacks
+
+The figures of the Sleep Statistics tab only depend on their inputs and on the sleep data, so each response is kept as
+serialized JSON, keyed by the callback, its normalized inputs and the version of the sleep data. The cache is bounded
+by the total size of the JSON it holds (SLEEP_FIGURE_CACHE_MB environment variable, 64 MiB by default) and evicts the
+least recently used figures first.
+"""
+# import statements
+import functools
+import json
+import os
+import plotly
+import random_forest_assets as rf
+import datastore
+from cache import LRUCache
+
+# serialized responses of the memoized callbacks, bounded by their total length
+FIGURE_CACHE = LRUCache(maxsize=None, maxbytes=int(float(os.environ.get('SLEEP_FIGURE_CACHE_MB', 64)) * 2 ** 20),
+                        sizeof=len)
+
+
+def _normalize(value):
+    """ Normalizes a callback input so that equivalent inputs look exactly the same (the order in which the boxes of a
+        checklist were ticked does not matter, and neither does 50 versus 50.0 for a slider)
+    Args:
+        value: input of interest (a dropdown value, a checklist's values or a range slider's values)
+    Returns:
+        the normalized (hashable) input
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted(_normalize(item) for item in value))
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+
+    return value
+
+
+def dataset_version():
+    """ Identifies the version of the sleep data behind the figures
+    Returns:
+        version (str): hexadecimal digest of the sleep data (see rf.dataset_hash)
+    """
+    return rf.dataset_hash(datastore.efficiency())
+
+
+def memoize(func):
+    """ Wraps a figure callback so that its responses are served from FIGURE_CACHE when possible
+    Args:
+        func (function): callback of interest, which must only depend on its inputs and on the sleep data
+    Returns:
+        wrapper (function): the memoized callback, which returns the response as plain JSON-compatible objects
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = (func.__name__, dataset_version(), tuple(_normalize(arg) for arg in args))
+
+        # build and serialize the response the first time these inputs are seen
+        text = FIGURE_CACHE.get(key)
+        if text is None:
+            text = json.dumps(func(*args), cls=plotly.utils.PlotlyJSONEncoder)
+            FIGURE_CACHE.put(key, text)
+
+        return json.loads(text)
+
+    return wrapper
+
+
+def prewarm(calls):
+    """ Builds the responses of common callback inputs ahead of time
+    Args:
+        calls (list of tuples): the callbacks (unwrapped) and argument tuples of interest
+    """
+    for func, args in calls:
+        memoize(func)(*args)
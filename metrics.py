@@ -0,0 +1,246 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (metrics.py)
+April 19, 2023
+
+metrics.py: Per-callback timing instrumentation for the dashboard, exposed in the Prometheus text format on /metrics
+
+Every callback registered through an instrumented app records its number of calls, a latency histogram, its number of
+exceptions and a histogram of the size of its responses. Caches registered with register_cache report their hits,
+misses, evictions and size as well. Setting the SLEEP_METRICS environment variable to 0 turns the
+instrumentation off. Metrics are kept per process, so each worker of a multi-process server reports its own.
+"""
+# import statements
+import bisect
+import functools
+import os
+import threading
+import time
+import flask
+from dash.exceptions import PreventUpdate
+
+# whether callbacks get instrumented at all
+ENABLED = os.environ.get('SLEEP_METRICS', '1') != '0'
+
+# upper bounds of the latency histogram buckets (in seconds)
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# upper bounds of the response size histogram buckets (in bytes)
+SIZE_BUCKETS = [1000, 10000, 100000, 300000, 1000000, 3000000, 10000000]
+
+# statistics recorded for each callback, keyed by the callback's name
+_STATS = {}
+_LOCK = threading.Lock()
+
+# caches (see cache.LRUCache) whose statistics are reported, keyed by the name they are reported under
+_CACHES = {}
+
+
+def _new_stats():
+    """ Creates the empty statistics of a callback
+    Returns:
+        stats (dict): number of calls and exceptions, and the bucket counts, sum and count of each histogram
+    """
+    stats = {'calls': 0, 'exceptions': 0,
+             'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'latency_sum': 0.0,
+             'size_buckets': [0] * (len(SIZE_BUCKETS) + 1), 'size_sum': 0, 'size_count': 0}
+
+    return stats
+
+
+def observe_call(name, latency, failed):
+    """ Records one call of a callback
+    Args:
+        name (str): name of the callback
+        latency (float): duration of the call (in seconds)
+        failed (bool): whether the call raised an exception
+    """
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+    with _LOCK:
+        stats = _STATS.setdefault(name, _new_stats())
+        stats['calls'] += 1
+        stats['exceptions'] += failed
+        stats['latency_buckets'][bucket] += 1
+        stats['latency_sum'] += latency
+
+
+def observe_response(name, size):
+    """ Records the size of a callback's response
+    Args:
+        name (str): name of the callback
+        size (int): size of the response body (in bytes)
+    """
+    bucket = bisect.bisect_left(SIZE_BUCKETS, size)
+    with _LOCK:
+        stats = _STATS.setdefault(name, _new_stats())
+        stats['size_buckets'][bucket] += 1
+        stats['size_sum'] += size
+        stats['size_count'] += 1
+
+
+def timed(name, func):
+    """ Wraps a callback so that each of its calls gets recorded
+    Args:
+        name (str): name the callback is reported under
+        func (function): the callback itself
+    Returns:
+        wrapper (function): the instrumented callback
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # let the response hook know which callback produced the response
+        if flask.has_request_context():
+            flask.g.sleep_callback = name
+
+        start = time.perf_counter()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            # Dash uses this exception to skip an update, it is not an error
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_call(name, time.perf_counter() - start, failed)
+
+    return wrapper
+
+
+def _record_response_size(response):
+    """ Records the size of the response of the callback that handled the current request (a Flask after_request hook)
+    Args:
+        response (flask.Response): response about to be sent
+    Returns:
+        response (flask.Response): the same response, untouched
+    """
+    name = flask.g.get('sleep_callback')
+    if name is not None:
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = len(response.get_data())
+        if size is not None:
+            observe_response(name, size)
+
+    return response
+
+
+def register_cache(name, cache):
+    """ Reports the statistics of a cache along with the callback metrics
+    Args:
+        name (str): name the cache is reported under
+        cache (LRUCache): cache of interest
+    """
+    _CACHES[name] = cache
+
+
+def _cache_lines():
+    """ Formats the statistics of every registered cache in the Prometheus text format
+    Returns:
+        lines (list of str): the lines of the cache metrics
+    """
+    # metric name, type, help text and statistic of each cache metric
+    cache_metrics = [('sleep_cache_hits_total', 'counter', 'Number of lookups answered by each cache.', 'hits'),
+                     ('sleep_cache_misses_total', 'counter', 'Number of lookups missed by each cache.', 'misses'),
+                     ('sleep_cache_evictions_total', 'counter', 'Number of entries evicted from each cache.',
+                      'evictions'),
+                     ('sleep_cache_entries', 'gauge', 'Number of entries held by each cache.', 'entries'),
+                     ('sleep_cache_bytes', 'gauge', 'Size of the entries held by each cache.', 'bytes')]
+    snapshot = {name: cache.stats() for name, cache in sorted(_CACHES.items())}
+
+    lines = []
+    for metric, kind, description, stat in cache_metrics:
+        lines += ['# HELP {} {}'.format(metric, description), '# TYPE {} {}'.format(metric, kind)]
+        lines += ['{}{{cache="{}"}} {}'.format(metric, name, stats[stat]) for name, stats in snapshot.items()]
+
+    return lines
+
+
+def _histogram_lines(metric, name, buckets, counts, total, count):
+    """ Formats a histogram in the Prometheus text format
+    Args:
+        metric (str): name of the metric
+        name (str): name of the callback (the value of the metric's callback label)
+        buckets (list of float): upper bounds of the buckets
+        counts (list of int): number of observations in each bucket (plus one for the observations past the last bound)
+        total (float): sum of the observations
+        count (int): number of observations
+    Returns:
+        lines (list of str): the lines of the histogram
+    """
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(buckets + ['+Inf'], counts):
+        cumulative += bucket_count
+        lines.append('{}_bucket{{callback="{}",le="{}"}} {}'.format(metric, name, bound, cumulative))
+    lines.append('{}_sum{{callback="{}"}} {}'.format(metric, name, total))
+    lines.append('{}_count{{callback="{}"}} {}'.format(metric, name, count))
+
+    return lines
+
+
+def render():
+    """ Formats every recorded statistic in the Prometheus text format
+    Returns:
+        text (str): the metrics page
+    """
+    # copy the statistics so that callbacks are not blocked while the page is formatted
+    with _LOCK:
+        snapshot = {name: dict(stats, latency_buckets=list(stats['latency_buckets']),
+                               size_buckets=list(stats['size_buckets'])) for name, stats in _STATS.items()}
+
+    calls = ['# HELP sleep_callback_calls_total Number of calls of each Dash callback.',
+             '# TYPE sleep_callback_calls_total counter']
+    exceptions = ['# HELP sleep_callback_exceptions_total Number of calls of each Dash callback that raised.',
+                  '# TYPE sleep_callback_exceptions_total counter']
+    latency = ['# HELP sleep_callback_latency_seconds Time spent in each Dash callback.',
+               '# TYPE sleep_callback_latency_seconds histogram']
+    size = ['# HELP sleep_callback_response_bytes Size of the responses of each Dash callback.',
+            '# TYPE sleep_callback_response_bytes histogram']
+    for name, stats in sorted(snapshot.items()):
+        calls.append('sleep_callback_calls_total{{callback="{}"}} {}'.format(name, stats['calls']))
+        exceptions.append('sleep_callback_exceptions_total{{callback="{}"}} {}'.format(name, stats['exceptions']))
+        latency += _histogram_lines('sleep_callback_latency_seconds', name, LATENCY_BUCKETS,
+                                    stats['latency_buckets'], stats['latency_sum'], stats['calls'])
+        size += _histogram_lines('sleep_callback_response_bytes', name, SIZE_BUCKETS, stats['size_buckets'],
+                                 stats['size_sum'], stats['size_count'])
+
+    text = '\n'.join(calls + exceptions + latency + size + _cache_lines()) + '\n'
+
+    return text
+
+
+def instrument_app(app):
+    """ Makes every callback registered on a Dash app from now on record its metrics, and serves the metrics on the
+        /metrics route of the app's Flask server (does nothing if the instrumentation is turned off)
+    Args:
+        app (Dash): the Dash app, before its callbacks are registered
+    Returns:
+        app (Dash): the same app
+    """
+    if not ENABLED:
+        return app
+
+    register = app.callback
+
+    # register an instrumented version of each callback, but hand the original function back to the caller so it can
+    # still be called directly (e.g. by the benchmarks)
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+
+        def instrument(func):
+            decorator(timed(func.__name__, func))
+            return func
+
+        return instrument
+
+    app.callback = callback
+
+    # serve the metrics and record the size of each callback response
+    app.server.add_url_rule('/metrics', 'metrics',
+                            lambda: flask.Response(render(), mimetype='text/plain; version=0.0.4'))
+    app.server.after_request(_record_response_size)
+
+    return app
@@ -7,21 +7,63 @@ April 19, 2023
 random_forest_assets.py: Generic functions associated with random forest regressors and feature importance metrics
 """
 # import statements
+import copy
+import hashlib
+import json
+import os
+import pickle
+import weakref
 import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
 import numpy as np
 import plotly.express as px
 import utils
 
+# the sleep quality statistics predicted by the sleep quality predictor (a single multi-output regressor is trained on
+# all of them at once)
+TARGET_COLS = ['Sleep efficiency', 'REM sleep percentage', 'Deep sleep percentage']
 
-def forest_reg(focus_col, df):
+# hyperparameters shared by every random forest regressor behind the dashboard (the fixed seed makes retraining
+# reproducible, so a persisted model can always be rebuilt bit-for-bit from the same data)
+FOREST_PARAMS = {'n_estimators': 100, 'random_state': 0}
+
+# directory where fitted random forest regressors are persisted between runs of the dashboard
+MODEL_DIR = os.environ.get('SLEEP_MODEL_DIR', 'models')
+
+# fitted random forest regressors that are already loaded into memory, keyed by their model key
+_MODELS = {}
+
+# flattened versions of the loaded regressors used for fast inference, keyed by their model key
+_FLAT_MODELS = {}
+
+# largest number of rows traversed through the flattened trees with vectorized NumPy code; past this size, the
+# per-step overhead of NumPy outweighs the compiled traversal of each tree, so larger batches look up their leaves tree
+# by tree instead
+FLAT_MAX_ROWS = 256
+
+# dataset hashes that were already computed, keyed by the id of the data frame they belong to
+_DATASET_HASHES = {}
+
+
+def forest_reg(focus_col, df, params=None):
     """ Builds a random forest regressor model that predicts a y-variable
+
+    If a list of y-variables is passed, a single multi-output regressor is fitted on all of them together, which
+    predicts every y-variable with one pass through the trees
+
     Args:
-        focus_col (str): name of the y-variable of interest
+        focus_col (str or list of str): name(s) of the y-variable(s) of interest
         df (pd.DataFrame): dataframe of interest that contains data used to train the regressor
+        params (dict): hyperparameters of the regressor (defaults to FOREST_PARAMS)
     Returns:
-        random_forest_reg: fitted random forest regressor that predicts the y-variable based on the inputted data set
+        random_forest_reg: fitted random forest regressor that predicts the y-variable(s) based on the inputted data set
     """
+    # sklearn takes a while to import, so it is only imported once a regressor actually has to be trained
+    from sklearn.ensemble import RandomForestRegressor
+
+    # fall back on the hyperparameters shared by the whole dashboard
+    if params is None:
+        params = FOREST_PARAMS
+
     # retrieve the x features for the random forest regressor
     df, x_feat_list = utils.get_x_feat(df)
 
@@ -30,7 +72,7 @@ def forest_reg(focus_col, df):
     y = df.loc[:, focus_col].values
 
     # initialize a random forest regressor
-    random_forest_reg = RandomForestRegressor()
+    random_forest_reg = RandomForestRegressor(**params)
 
     # fit the data extracted from the data frame
     random_forest_reg.fit(x, y)
@@ -38,6 +80,281 @@ def forest_reg(focus_col, df):
     return random_forest_reg
 
 
+def dataset_hash(df):
+    """ Computes a fingerprint of a cleaned data frame so models trained on it can be identified later on
+
+    The hash is remembered for as long as the data frame is alive, so the data frame is assumed not to be modified in
+    place after it was first hashed
+
+    Args:
+        df (pd.DataFrame): cleaned data frame containing the data used to train the regressors
+    Returns:
+        digest (str): hexadecimal SHA-256 digest of the data frame's index, columns and values
+    """
+    # reuse the hash if this exact data frame was already hashed
+    entry = _DATASET_HASHES.get(id(df))
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+
+    # hash the values and index of every row as well as the column names
+    sha = hashlib.sha256()
+    sha.update(json.dumps(list(df.columns)).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest = sha.hexdigest()
+
+    # remember the hash (the weak reference makes sure a recycled id is never mistaken for this data frame)
+    _DATASET_HASHES[id(df)] = (weakref.ref(df), digest)
+
+    return digest
+
+
+def model_key(focus_col, df, params=None):
+    """ Builds the key identifying the random forest regressor trained on a data set with certain hyperparameters
+    Args:
+        focus_col (str or list of str): name(s) of the y-variable(s) of interest
+        df (pd.DataFrame): dataframe of interest that contains data used to train the regressor
+        params (dict): hyperparameters of the regressor (defaults to FOREST_PARAMS)
+    Returns:
+        key (str): key of the model, which changes whenever the data, the y-variable or the hyperparameters change
+    """
+    # fall back on the hyperparameters shared by the whole dashboard
+    if params is None:
+        params = FOREST_PARAMS
+
+    # combine the y-variable, the hyperparameters and the fingerprint of the data into one digest
+    settings = json.dumps({'target': focus_col, 'params': params}, sort_keys=True)
+    key = hashlib.sha256((settings + dataset_hash(df)).encode()).hexdigest()[:16]
+
+    return key
+
+
+def get_model(focus_col, df, params=None):
+    """ Retrieves the random forest regressor predicting a y-variable, training it only if it was never trained before
+
+    Models are first looked up in memory, then in MODEL_DIR, and are only fitted (and then persisted to MODEL_DIR) when
+    neither contains a model for the same data, y-variable and hyperparameters
+
+    Args:
+        focus_col (str or list of str): name(s) of the y-variable(s) of interest
+        df (pd.DataFrame): dataframe of interest that contains data used to train the regressor
+        params (dict): hyperparameters of the regressor (defaults to FOREST_PARAMS)
+    Returns:
+        random_forest_reg: fitted random forest regressor that predicts the y-variable(s) based on the inputted data set
+    """
+    # reuse the model if it was already loaded
+    key = model_key(focus_col, df, params)
+    if key in _MODELS:
+        return _MODELS[key]
+
+    path = os.path.join(MODEL_DIR, key + '.pkl')
+    if os.path.exists(path):
+        # load the model persisted by an earlier run
+        with open(path, 'rb') as infile:
+            random_forest_reg = pickle.load(infile)
+    else:
+        # train the model once and persist it (writing to a temporary file first so that other processes never load
+        # a partially written model)
+        random_forest_reg = forest_reg(focus_col, df, params)
+
+        # predictions made by an earlier version of the regressor must not be served anymore
+        utils.PREDICTION_CACHE.clear()
+        os.makedirs(MODEL_DIR, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as outfile:
+            pickle.dump(random_forest_reg, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    _MODELS[key] = random_forest_reg
+
+    return random_forest_reg
+
+
+def extend_model(focus_col, df_old, df, new_rows, params=None):
+    """ Makes the random forest regressor of a data set that grew by new rows out of the regressor of the rows it had
+        before, by fitting additional trees on the new rows only (warm start) instead of fitting every tree again
+
+    The number of trees added is proportional to the share of new rows, so that every row weighs about as much in the
+    extended forest. The trees of the earlier regressor are shared with it, not modified. The extended regressor is
+    registered in memory for the grown data set (see get_model) but never persisted, since fitting it depends on the
+    order in which the rows arrived: a process that starts on the grown data set trains its regressor from scratch.
+
+    Args:
+        focus_col (str or list of str): name(s) of the y-variable(s) of interest
+        df_old (pd.DataFrame): data set before the new rows were added
+        df (pd.DataFrame): data set with the new rows
+        new_rows (pd.DataFrame): the new rows
+        params (dict): hyperparameters of the regressor (defaults to FOREST_PARAMS)
+    Returns:
+        random_forest_reg: the extended random forest regressor
+    """
+    old_reg = get_model(focus_col, df_old, params)
+    random_forest_reg = copy.copy(old_reg)
+    random_forest_reg.estimators_ = list(old_reg.estimators_)
+
+    if len(new_rows):
+        new_trees = max(1, round(len(old_reg.estimators_) * len(new_rows) / max(len(df_old), 1)))
+
+        # fit the additional trees on the new rows (warm start keeps the trees that were already fitted)
+        new_rows, x_feat_list = utils.get_x_feat(new_rows)
+        random_forest_reg.set_params(warm_start=True, n_estimators=len(old_reg.estimators_) + new_trees)
+        random_forest_reg.fit(new_rows.loc[:, x_feat_list].values, new_rows.loc[:, focus_col].values)
+        random_forest_reg.set_params(warm_start=False)
+
+    _MODELS[model_key(focus_col, df, params)] = random_forest_reg
+
+    return random_forest_reg
+
+
+def release_models(focus_col, df, params=None):
+    """ Forgets the random forest regressor of a data set that is not used anymore (e.g. after rows were appended to it)
+        and its flattened version, so that they can be freed (a persisted copy stays in MODEL_DIR)
+    Args:
+        focus_col (str or list of str): name(s) of the y-variable(s) of interest
+        df (pd.DataFrame): dataframe the regressor was trained on
+        params (dict): hyperparameters of the regressor (defaults to FOREST_PARAMS)
+    """
+    key = model_key(focus_col, df, params)
+    _MODELS.pop(key, None)
+    _FLAT_MODELS.pop(key, None)
+
+
+def load_models(df, focus_cols, params=None):
+    """ Loads (or trains once) the random forest regressors for several y-variables, typically at startup
+    Args:
+        df (pd.DataFrame): dataframe of interest that contains data used to train the regressors
+        focus_cols (list of str): names of the y-variables of interest
+        params (dict): hyperparameters of the regressors (defaults to FOREST_PARAMS)
+    Returns:
+        models (dict): maps each y-variable to its fitted random forest regressor
+    """
+    models = {focus_col: get_model(focus_col, df, params) for focus_col in focus_cols}
+
+    return models
+
+
+def flatten_forest(random_forest_reg):
+    """ Converts a fitted random forest regressor into contiguous arrays describing every node of every tree
+
+    The nodes of all trees are concatenated, so the children of a node are global positions in the arrays
+
+    Args:
+        random_forest_reg (RandomForestRegressor): fitted random forest regressor
+    Returns:
+        flat_forest (dict): the arrays 'feature', 'threshold', 'left', 'right', 'is_leaf' (one entry per node), 'value'
+                            (one row per node and one column per y-variable) and 'roots' (one entry per tree), the
+                            number of 'outputs', and the fitted 'trees' (used for large batches)
+    """
+    features, thresholds, lefts, rights, leaves, values, roots = [], [], [], [], [], [], []
+    offset = 0
+    for estimator in random_forest_reg.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+
+        # leaves get a dummy feature and children so every array can safely be indexed with any node
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        lefts.append(np.where(is_leaf, 0, tree.children_left) + offset)
+        rights.append(np.where(is_leaf, 0, tree.children_right) + offset)
+        leaves.append(is_leaf)
+        values.append(tree.value[:, :, 0])
+        roots.append(offset)
+
+        offset += tree.node_count
+
+    flat_forest = {'feature': np.ascontiguousarray(np.concatenate(features), dtype=np.intp),
+                   'threshold': np.ascontiguousarray(np.concatenate(thresholds), dtype=np.float64),
+                   'left': np.ascontiguousarray(np.concatenate(lefts), dtype=np.intp),
+                   'right': np.ascontiguousarray(np.concatenate(rights), dtype=np.intp),
+                   'is_leaf': np.concatenate(leaves),
+                   'value': np.ascontiguousarray(np.concatenate(values), dtype=np.float64),
+                   'roots': np.array(roots, dtype=np.intp),
+                   'outputs': random_forest_reg.n_outputs_,
+                   'trees': list(random_forest_reg.estimators_)}
+
+    return flat_forest
+
+
+def predict_flat(flat_forest, x):
+    """ Predicts y-variable(s) by traversing every tree of a flattened random forest regressor at once
+
+    For small inputs (such as the single row of the dashboard), every (row, tree) pair moves down one level per step,
+    and pairs that reached a leaf drop out of the following steps. Larger inputs look up their leaves tree by tree.
+    Either way, the predictions are identical to those of RandomForestRegressor.predict: the inputs are compared in
+    float32 like sklearn does, and the trees are added up in the same order before being averaged
+
+    Args:
+        flat_forest (dict): flattened random forest regressor (see flatten_forest)
+        x (np.array): one row of x features, or a 2D array with one row per prediction
+    Returns:
+        y_pred (np.array): one prediction per row (with one column per y-variable for multi-output regressors)
+    """
+    # sklearn's trees split on float32 features
+    x = np.asarray(x, dtype=np.float32)
+    if x.ndim == 1:
+        x = x.reshape(1, -1)
+
+    feature = flat_forest['feature']
+    threshold = flat_forest['threshold']
+    left = flat_forest['left']
+    right = flat_forest['right']
+    is_leaf = flat_forest['is_leaf']
+    value = flat_forest['value']
+    roots = flat_forest['roots']
+    n_trees = len(roots)
+
+    y_pred = np.zeros((len(x), flat_forest['outputs']))
+    if len(x) <= FLAT_MAX_ROWS:
+        # current node of every (row, tree) pair and the position of the pair's row in the flattened inputs
+        flat_x = x.ravel()
+        nodes = np.tile(roots, len(x))
+        row_starts = np.repeat(np.arange(len(x)) * x.shape[1], n_trees)
+        active = np.flatnonzero(~is_leaf[nodes])
+
+        # move the pairs that have not reached a leaf yet down one level at a time
+        while active.size:
+            current = nodes[active]
+            go_left = flat_x[row_starts[active] + feature[current]] <= threshold[current]
+            current = np.where(go_left, left[current], right[current])
+            nodes[active] = current
+            active = active[~is_leaf[current]]
+
+        # add up the leaf values tree by tree (the same order as sklearn, so the sums match to the last bit)
+        leaf_values = value[nodes].reshape(len(x), n_trees, -1)
+        for tree in range(n_trees):
+            y_pred += leaf_values[:, tree]
+    else:
+        # look up the leaf of every row tree by tree with the trees' compiled traversal (skipping the input validation
+        # and thread dispatch of RandomForestRegressor.predict) and add up the leaf values in the same order as sklearn
+        x = np.ascontiguousarray(x)
+        for tree, estimator in enumerate(flat_forest['trees']):
+            y_pred += value[estimator.apply(x, check_input=False) + roots[tree]]
+
+    y_pred /= n_trees
+
+    # single-output regressors return a 1D array, just like sklearn
+    if flat_forest['outputs'] == 1:
+        y_pred = y_pred[:, 0]
+
+    return y_pred
+
+
+def get_flat_model(focus_col, df, params=None):
+    """ Retrieves the flattened version of the random forest regressor predicting a y-variable (see get_model)
+    Args:
+        focus_col (str or list of str): name(s) of the y-variable(s) of interest
+        df (pd.DataFrame): dataframe of interest that contains data used to train the regressor
+        params (dict): hyperparameters of the regressor (defaults to FOREST_PARAMS)
+    Returns:
+        flat_forest (dict): flattened random forest regressor (see flatten_forest)
+    """
+    # flatten the regressor only the first time it is needed
+    key = model_key(focus_col, df, params)
+    if key not in _FLAT_MODELS:
+        _FLAT_MODELS[key] = flatten_forest(get_model(focus_col, df, params))
+
+    return _FLAT_MODELS[key]
+
+
 def plot_feat_import_rf_reg(feat_list, feat_import, sort=True, limit=None):
     """ plots feature importance values in a horizontal bar chart
 
@@ -67,3 +384,26 @@ def plot_feat_import_rf_reg(feat_list, feat_import, sort=True, limit=None):
                  template='plotly_dark', height=600)
 
     return fig
+
+
+def feature_importance_figures(df, focus_cols):
+    """ Builds the feature importance bar chart of the random forest regressor predicting each y-variable of interest
+
+    The regressors come from the model registry (see get_model), so they are only trained if they were never persisted
+
+    Args:
+        df (pd.DataFrame): dataframe of interest that contains data used to train the regressors
+        focus_cols (list of str): names of the y-variables of interest
+    Returns:
+        figs (dict): maps each y-variable to the feature importance bar chart (px.bar) of its regressor
+    """
+    # retrieve the names of the x features used by the regressors
+    df_sleep, x_feat_list = utils.get_x_feat(df)
+
+    figs = {}
+    for focus_col in focus_cols:
+        # plot the importance of each feature in determining the y-variable
+        random_forest_reg = get_model(focus_col, df)
+        figs[focus_col] = plot_feat_import_rf_reg(x_feat_list, random_forest_reg.feature_importances_)
+
+    return figs
@@ -0,0 +1,140 @@
+"""
+Colbe Chang, Jocelyn Ju, Jethro R. Lee, Michelle Wang, and Ceara Zhang
+DS3500
+Final Project: Sleep Efficiency Dashboard (score_batch.py)
+April 19, 2023
+
+score_batch.py: Scores large files of users with the sleep quality predictor from the command line
+
+The input CSV uses the same columns and formats as data/Sleep_Efficiency.csv (its sleep quality columns are not
+needed). It is read in chunks, and the predicted sleep efficiency, REM sleep percentage and deep sleep percentage of
+each chunk are appended to the output CSV before the next chunk is read, so memory use does not grow with the size of
+the file. Users with missing inputs get empty predictions.
+
+Example: python score_batch.py users.csv predictions.csv --chunksize 50000 --workers 4
+"""
+# import statements
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import utils
+import random_forest_assets as rf
+
+# columns of the input CSV (after renaming) that the sleep quality predictor needs
+INPUT_COLS = ['Age', 'Bedtime', 'Wakeup time', 'Awakenings', 'Caffeine consumption 24 hrs before sleeping (mg)',
+              'Alcohol consumption 24 hrs before sleeping (oz)', 'Exercise frequency (in days per week)', 'Gender',
+              'Smoking status']
+
+# names of the predicted columns in the output CSV
+OUTPUT_COLS = ['Predicted ' + target for target in rf.TARGET_COLS]
+
+# flattened regressor used by the current (worker) process
+_FLAT_FOREST = None
+
+
+def _init_worker(flat_forest):
+    """ Stores the flattened regressor in a worker process so that it is only sent to each worker once
+    Args:
+        flat_forest (dict): flattened multi-output random forest regressor (see rf.flatten_forest)
+    """
+    global _FLAT_FOREST
+    _FLAT_FOREST = flat_forest
+
+
+def score_chunk(chunk):
+    """ Predicts the sleep efficiency, REM sleep percentage and deep sleep percentage of a chunk of users
+    Args:
+        chunk (pd.DataFrame): raw rows of the input CSV
+    Returns:
+        scored (pd.DataFrame): the ID of each user (if the input has one) followed by their predictions
+    """
+    # clean the chunk the same way as the sleep data the regressor was trained on
+    chunk = chunk.rename(columns=utils.RENAMED_COLS)
+    chunk = utils.parse_times(chunk)
+
+    # users with missing inputs cannot be scored
+    complete = chunk[INPUT_COLS].notna().all(axis=1).values
+
+    # encode every complete row at once and predict all three statistics in one pass through the trees
+    y_pred = np.full((len(chunk), len(OUTPUT_COLS)), np.nan)
+    if complete.any():
+        users = chunk.loc[complete, INPUT_COLS]
+        data = utils.build_features(*[users[col].values for col in INPUT_COLS])
+        y_pred[complete] = rf.predict_flat(_FLAT_FOREST, data)
+
+    scored = pd.DataFrame(y_pred, columns=OUTPUT_COLS, index=chunk.index)
+    if 'ID' in chunk.columns:
+        scored.insert(0, 'ID', chunk['ID'].values)
+
+    return scored
+
+
+def score_file(input_file, output_file, flat_forest, chunksize=50000, workers=1):
+    """ Scores every user of a CSV file chunk by chunk, appending the predictions of each chunk to the output file
+    Args:
+        input_file (str): CSV file with one user per row
+        output_file (str): CSV file the predictions are written to (overwritten if it exists)
+        flat_forest (dict): flattened multi-output random forest regressor (see rf.flatten_forest)
+        chunksize (int): number of users read, scored and written at once
+        workers (int): number of processes scoring chunks in parallel (1 scores them in this process)
+    Returns:
+        n_rows (int): number of users scored
+    """
+    # the time columns are parsed by utils.parse_times, everything else is read as is
+    chunks = pd.read_csv(input_file, chunksize=chunksize)
+    n_rows = 0
+
+    with open(output_file, 'w', newline='') as outfile:
+        header = True
+
+        if workers <= 1:
+            _init_worker(flat_forest)
+            for chunk in chunks:
+                scored = score_chunk(chunk)
+                scored.to_csv(outfile, header=header, index=False)
+                header = False
+                n_rows += len(scored)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(flat_forest,)) as executor:
+                # only keep a couple of chunks per worker in flight so memory stays flat, and write the chunks out in
+                # the order they were read
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(score_chunk, chunk))
+                    if len(pending) >= 2 * workers:
+                        scored = pending.popleft().result()
+                        scored.to_csv(outfile, header=header, index=False)
+                        header = False
+                        n_rows += len(scored)
+
+                while pending:
+                    scored = pending.popleft().result()
+                    scored.to_csv(outfile, header=header, index=False)
+                    header = False
+                    n_rows += len(scored)
+
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a CSV file of users with the sleep quality predictor')
+    parser.add_argument('input_file', help='CSV file with one user per row (same columns as the sleep data)')
+    parser.add_argument('output_file', help='CSV file the predictions are written to')
+    parser.add_argument('--data', default='data/Sleep_Efficiency.csv', help='CSV file the regressor is trained on')
+    parser.add_argument('--chunksize', type=int, default=50000, help='number of users scored at once')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes scoring chunks in parallel')
+    args = parser.parse_args()
+
+    # load (or train once) the multi-output regressor of the sleep quality predictor
+    efficiency = utils.read_sleep_data(args.data)
+    flat_forest = rf.get_flat_model(rf.TARGET_COLS, efficiency)
+
+    n_rows = score_file(args.input_file, args.output_file, flat_forest, args.chunksize, args.workers)
+    print('Scored', n_rows, 'users into', args.output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,27 +5,53 @@ Final Project: Sleep Efficiency Dashboard (sleep.py)
 April 19, 2023
 
 sleep.py: runs the general code for the dashboard
+
+The dashboard is built by create_app(). Importing this module builds the layout and registers the callbacks, but the
+data and models are only loaded when a callback first needs them (see datastore.py), or right away if the
+SLEEP_PRELOAD environment variable is set to 1. The Flask server is exposed as "server" for WSGI servers, e.g.
+"SLEEP_PRELOAD=1 gunicorn --preload sleep:server" loads everything once in the parent process so that the forked
+workers share it.
+
+The figures of the Sleep Statistics tab are memoized (see figure_cache.py). Setting the SLEEP_FIGURE_PREWARM environment
+variable to 1 builds the figures of the most common inputs at startup. Setting the SLEEP_CLIENTSIDE environment variable
+to 1 moves the filtering of the strip chart and density contour plot by the efficiency slider to the browser (see
+assets/clientside.js): the server sends their figures once per dropdown choice, and dragging the slider no longer
+reaches the server. Setting the SLEEP_HOT_RELOAD environment variable to 1 reloads the data and models in the background
+whenever the data file changes, while every request keeps reading the version of the data it started with (see
+datastore.py).
 """
 # import statements
-from dash import Dash, html, dcc, Input, Output
+import logging
+import os
+from dash import Dash, html, dcc, Input, Output, ClientsideFunction
 import plotly.express as px
-import seaborn as sns
 import numpy as np
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 import utils
 import random_forest_assets as rf
+import metrics
+import datastore
+import figure_cache
+
+# bounds of the sleep efficiency slider, which also bound the rows sent to the browser when filtering it clientside
+EFFICIENCY_SLIDER_RANGE = [50, 100]
 
-# read in the file as a dataframe and perform basic cleaning
-EFFICIENCY = utils.read_file('data/Sleep_Efficiency.csv')
+# number of rows above which the scatter plots switch to their level-of-detail mode, which draws a sample of the rows
+# with WebGL, and number of points each of them draws in that mode (configured through the SLEEP_LOD_ROWS,
+# SLEEP_SCATTER_POINTS and SLEEP_SCATTER_3D_POINTS environment variables)
+LOD_ROWS = int(os.environ.get('SLEEP_LOD_ROWS', 50000))
+SCATTER_POINT_BUDGET = int(os.environ.get('SLEEP_SCATTER_POINTS', 20000))
+SCATTER_3D_POINT_BUDGET = int(os.environ.get('SLEEP_SCATTER_3D_POINTS', 10000))
 
-# parse the bedtime and wakeup times and convert them to military times
-EFFICIENCY = utils.parse_times(EFFICIENCY)
+# colors of the genders in the violin plot and histogram
+GENDER_COLORS = {'Female': 'sienna', 'Male': 'blue'}
 
-app = Dash(__name__)
+# stores holding the figures filtered in the browser by the efficiency slider (only in the layout in clientside mode)
+CLIENTSIDE_STORES = [dcc.Store(id='contour-figure'), dcc.Store(id='strip-figure')]
 
-# layout for the dashboard
-app.layout = html.Div([
+# layout for the dashboard (building the components is cheap, the data they show is only loaded by the callbacks)
+LAYOUT = html.Div([
     dcc.Tabs([
 
         # create a tab with the sleep statistic graphs
@@ -165,7 +191,8 @@ app.layout = html.Div([
                         html.Div([
                             html.P('Adjust the sleep efficiency percentages presented on the two plots below',
                                    style={'textAlign': 'left'}),
-                            dcc.RangeSlider(50, 100, 1, value=[50, 100], id='efficiency-slider',
+                            dcc.RangeSlider(*EFFICIENCY_SLIDER_RANGE, 1, value=EFFICIENCY_SLIDER_RANGE,
+                                            id='efficiency-slider',
                                             tooltip={'placement': 'bottom', 'always_visible': True}, marks=None)
                         ], style={'background-color': 'indigo'}
                         ),
@@ -531,15 +558,44 @@ app.layout = html.Div([
     ], style={'font-family': 'Courier New', 'background-color': 'black'})])
 
 
-@app.callback(
-    Output('sleep-scatter', 'figure'),
-    Output('sleep-qual-title', 'children'),
-    Input('scatter-trend-line', 'value'),
-    Input('sleep-stat-ind', 'value'),
-    Input('sleep-stat-dep', 'value')
-)
+def sample_title(n_sampled, n_total):
+    """ Tells how many rows a plot in level-of-detail mode draws
+    Args:
+        n_sampled (int): number of rows drawn
+        n_total (int): number of rows that could have been drawn
+    Returns:
+        title (str): the note shown above the plot
+    """
+    return 'Showing a sample of {:,} of {:,} points'.format(n_sampled, n_total)
+
+
+def add_trend_line(fig, sleep_stat_ind, sleep_stat_dep, trace_type=go.Scatter):
+    """ Draws the least squares line of a scatter plot from the regression table of the sleep data (see
+        utils.trend_line), as a trace joining the two ends of the line
+    Args:
+        fig (go.Figure): the scatter plot
+        sleep_stat_ind (string): the independent variable of the scatter plot
+        sleep_stat_dep (string): the dependent variable of the scatter plot
+        trace_type (class): type of trace drawn (go.Scattergl for plots drawn with WebGL)
+    """
+    line = utils.trend_line(datastore.regression_table(), sleep_stat_ind, sleep_stat_dep)
+    if line is None:
+        return
+
+    hover = ('<b>OLS trendline</b><br>{} = {:.6g} * {} + {:.6g}<br>R<sup>2</sup>={:.6f}<br><br>'
+             '{}=%{{x}}<br>{}=%{{y}} <b>(trend)</b><extra></extra>').format(
+        sleep_stat_dep, line['slope'], sleep_stat_ind, line['intercept'], line['r2'], sleep_stat_ind, sleep_stat_dep)
+    fig.add_trace(trace_type(x=line['x'], y=line['y'], mode='lines', showlegend=False, hovertemplate=hover,
+                             line_color=fig.data[0].marker.color))
+
+
 def make_sleep_scatter(show_trend_line, sleep_stat_ind, sleep_stat_dep):
     """ Creates a scatter plot showing the relationship between two sleep statistics
+
+    The trend line comes from the regression table of the sleep data (see datastore.regression_table), so no model is
+    fitted per request. Past LOD_ROWS rows, only a random sample of SCATTER_POINT_BUDGET rows is drawn (with WebGL),
+    while the trend line still accounts for every row
+
     Args:
         show_trend_line (string): a string indicating whether a trend line should appear on the scatter plot
         sleep_stat_ind (string): the independent variable of the scatter plot
@@ -548,98 +604,135 @@ def make_sleep_scatter(show_trend_line, sleep_stat_ind, sleep_stat_dep):
         fig (px.scatter): the scatter plot itself
         html.H2: the title of the scatter plot, which changes based on the user's input for the represented variables
     """
-    # initialize the trend-line as None
-    trend_line = None
+    efficiency = datastore.efficiency()
+
+    # plot the relationship between the user-specified independent sleep statistic and user-specified dependent sleep
+    # statistic on a scatter plot (only drawing a sample of the rows with WebGL for large data sets)
+    if len(efficiency) > LOD_ROWS:
+        positions, n_total = utils.sample_rows(efficiency, [sleep_stat_ind, sleep_stat_dep], SCATTER_POINT_BUDGET,
+                                               name='make_sleep_scatter')
+        fig = px.scatter(efficiency.iloc[positions], x=sleep_stat_ind, y=sleep_stat_dep, render_mode='webgl',
+                         template='plotly_dark', labels={'x': sleep_stat_ind, 'index': sleep_stat_dep})
+        fig.update_layout(title_text=sample_title(len(positions), n_total))
+        trace_type = go.Scattergl
+    else:
+        fig = px.scatter(efficiency, x=sleep_stat_ind, y=sleep_stat_dep, template='plotly_dark',
+                         labels={'x': sleep_stat_ind, 'index': sleep_stat_dep})
+        trace_type = go.Scatter
 
     # show a trend line or not based on the user's input
     if 'Show Trend Line' in show_trend_line:
-        trend_line = 'ols'
+        add_trend_line(fig, sleep_stat_ind, sleep_stat_dep, trace_type)
 
-    # plot the relationship between the user-specified independent sleep statistic and user-specified dependent sleep
-    # statistic on a scatter plot
-    fig = px.scatter(EFFICIENCY, x=sleep_stat_ind, y=sleep_stat_dep, trendline=trend_line, template='plotly_dark',
-                     labels={'x': sleep_stat_ind, 'index': sleep_stat_dep})
     return fig, html.H2('How ' + sleep_stat_ind + ' Affects ' + sleep_stat_dep, style={'textAlign': 'center'})
 
 
-@app.callback(
-    Output('violin-gender', 'figure'),
-    Output('gender-plots-title', 'children'),
-    Input('gender-options', 'value'),
-    Input('sleep-stat-dep', 'value')
-)
+def shown_genders(genders, sleep_stat):
+    """ Retrieves the distribution summaries of a sleep statistic for the genders to be portrayed
+    Args:
+        genders (list of str): list of genders to be portrayed
+        sleep_stat (str): the statistic of interest
+    Returns:
+        edges (np.array): edges of the bins of the statistic's histogram
+        summaries (dict): maps each gender to be portrayed (in order of first appearance in the data) to the summary of
+                          its distribution (see utils.distribution_summary)
+    """
+    distribution = datastore.distributions()[sleep_stat]
+    summaries = {gender: summary for gender, summary in distribution['groups'].items()
+                 if gender in genders and summary is not None}
+
+    return distribution['edges'], summaries
+
+
 def show_sleep_gender_violin_plot(genders, sleep_stat):
     """ Shows a violin plot that represents distributions of a sleep statistic per gender
     Args:
         genders (list of str): list of genders to be portrayed on the violin plot
         sleep_stat (str): The statistic to be portrayed on the violin plot
     Returns:
-        fig (px.violin): the violin plot
+        fig (go.Figure): the violin plot
         html.H2: the title for the gender plot section, which changes based on the user's input for the represented
                  variables
     """
     # saving column names into constants
     GENDER_COL = 'Gender'
 
-    # filter the data based on the chosen genders
-    sleep_gender = EFFICIENCY[EFFICIENCY.Gender.isin(genders)]
+    # retrieve the precomputed density curves and quartiles of the chosen genders, so that the figure has the same size
+    # whatever the number of test subjects, and their means and variances from the data cube
+    summaries = shown_genders(genders, sleep_stat)[1]
+    moments = datastore.data_cube().stats(sleep_stat, by=GENDER_COL)
 
-    # plot the violin chart
-    fig = px.violin(sleep_gender, x=GENDER_COL, y=sleep_stat, color=GENDER_COL, template='plotly_dark',
-                    color_discrete_map={'Female': 'sienna', 'Male': 'blue'})
+    # plot each violin as its density curve mirrored around the gender's position (every violin has the same width),
+    # with a box showing the quartiles, mean and standard deviation inside it
+    fig = go.Figure()
+    for position, (gender, summary) in enumerate(summaries.items()):
+        half_widths = 0.4 * summary['kde_y'] / summary['kde_y'].max()
+        fig.add_trace(go.Scatter(x=np.concatenate([position - half_widths, (position + half_widths)[::-1]]),
+                                 y=np.concatenate([summary['kde_x'], summary['kde_x'][::-1]]), fill='toself',
+                                 mode='lines', line_color=GENDER_COLORS[gender], name=gender, legendgroup=gender,
+                                 hoverinfo='skip'))
+        fig.add_trace(go.Box(x=[position], q1=[summary['q1']], median=[summary['median']], q3=[summary['q3']],
+                             lowerfence=[summary['lowerfence']], upperfence=[summary['upperfence']],
+                             mean=[moments[gender]['mean']], sd=[np.sqrt(moments[gender]['var'])], boxmean='sd',
+                             width=0.08, marker_color=GENDER_COLORS[gender], name=gender, legendgroup=gender,
+                             showlegend=False))
+
+    fig.update_layout(template='plotly_dark', legend_title_text=GENDER_COL, yaxis_title=sleep_stat,
+                      xaxis=dict(title=GENDER_COL, tickvals=list(range(len(summaries))), ticktext=list(summaries)))
 
     return fig, html.H2(sleep_stat + ' distribution across genders', style={'textAlign': 'center'})
 
 
-@app.callback(
-    Output('hist-gender', 'figure'),
-    Input('gender-options', 'value'),
-    Input('sleep-stat-dep', 'value')
-)
 def show_sleep_gender_histogram(genders, sleep_stat):
     """ Shows a histogram that represents distributions of a sleep statistic per gender
     Args:
         genders (list of str): list of genders to be portrayed on the histogram
         sleep_stat (str): The statistic to be portrayed on the histogram
     Returns:
-        fig (px.histogram): the histogram itself
+        fig (go.Figure): the histogram itself
     """
     # saving column names into constants
     GENDER_COL = 'Gender'
 
-    # filter the data based on the chosen genders
-    sleep_gender = EFFICIENCY[EFFICIENCY.Gender.isin(genders)]
+    # retrieve the precomputed bin counts of the chosen genders (the genders share the same bins), and their number of
+    # values from the data cube
+    edges, summaries = shown_genders(genders, sleep_stat)
+    moments = datastore.data_cube().stats(sleep_stat, by=GENDER_COL)
 
     # plot the histogram
-    # show a grouped histogram color coded by biological gender if both the "male" and "female" checkboxes are ticked
-    fig = px.histogram(sleep_gender, x=sleep_stat, color=GENDER_COL, template='plotly_dark',
-                       color_discrete_map={'Female': 'sienna', 'Male': 'blue'})
+    # show a stacked histogram color coded by biological gender if both the "male" and "female" checkboxes are ticked
+    fig = go.Figure()
+    for gender, summary in summaries.items():
+        fig.add_trace(go.Bar(x=(edges[1:] + edges[:-1]) / 2, y=summary['counts'], width=np.diff(edges),
+                             customdata=np.column_stack([edges[:-1], edges[1:]]), marker_color=GENDER_COLORS[gender],
+                             name=gender, hovertemplate=GENDER_COL + '=' + gender + '<br>' + sleep_stat +
+                             '=%{customdata[0]:.4g} - %{customdata[1]:.4g}<br>count=%{y} of ' +
+                             str(moments[gender]['count']) + '<extra></extra>'))
+
+    fig.update_layout(template='plotly_dark', barmode='relative', bargap=0, legend_title_text=GENDER_COL,
+                      xaxis_title=sleep_stat, yaxis_title='count')
 
     return fig
 
 
-@app.callback(
-    Output('efficiency-contour', 'figure'),
-    Output('mult-feat-eff', 'children'),
-    Input('density-stat1', 'value'),
-    Input('density-stat2', 'value'),
-    Input('efficiency-slider', 'value')
-)
-def show_efficiency_contour(sleep_stat1, sleep_stat2, slider_values):
-    """ Shows a density contour plot that plots the relationship between two variables and average sleep efficiency
+def _contour_rows(sleep_stat1, sleep_stat2):
+    """ Prepares the rows and the grid of the density contour plot (the grid only depends on the rows within the bounds
+        of the efficiency slider, so that it stays put while the slider is dragged)
     Args:
         sleep_stat1 (str): One statistic to be portrayed on the density contour plot
         sleep_stat2 (str): Another statistic to be portrayed on the density contour plot
-        slider_values (list of two floats): a range of average sleep efficiencies to be represented on the plot
     Returns:
-        fig (px.density_contour): the density contour plot
-        html.H2: the contour plot's title, which changes based on the user's input for the represented variables
+        df_sleep (pd.DataFrame): the sleep data, with gender and smoking status encoded if needed
+        sleep_stat1 (str): the statistic along the x-axis
+        sleep_stat2 (str): the statistic along the y-axis (changed if it was the same as the first one)
+        x_edges (np.array): edges of the bins along the x-axis
+        y_edges (np.array): edges of the bins along the y-axis
     """
     # saving the sleep efficiency column into a constant
     SLEEP_EFFICIENCY_COL = 'Sleep efficiency'
 
     # performing one hot encoding if gender or smoking status needs to be represented on the plot
-    df_sleep = utils.encode(sleep_stat1, sleep_stat2, EFFICIENCY)
+    df_sleep = utils.encode(sleep_stat1, sleep_stat2, datastore.efficiency())
 
     # change the second independent variable if it's the same with the first
     if sleep_stat1 == sleep_stat2:
@@ -648,26 +741,93 @@ def show_efficiency_contour(sleep_stat1, sleep_stat2, slider_values):
         else:
             sleep_stat2 = 'Caffeine consumption 24 hrs before sleeping (mg)'
 
-    # filter out appropriate values
-    cols = ['ID', sleep_stat1, sleep_stat2, SLEEP_EFFICIENCY_COL]
-    filt_efficiency = utils.filt_vals(df_sleep, slider_values, SLEEP_EFFICIENCY_COL, cols)
+    # bin both variables over every row the slider can select
+    cols = [sleep_stat1, sleep_stat2, SLEEP_EFFICIENCY_COL]
+    all_rows = utils.filt_vals(df_sleep, EFFICIENCY_SLIDER_RANGE, SLEEP_EFFICIENCY_COL, cols, datastore.range_index())
+    x_edges = utils.grid_edges(all_rows[sleep_stat1].values.astype(float))
+    y_edges = utils.grid_edges(all_rows[sleep_stat2].values.astype(float))
 
-    # plot the sleep statistics on a density contour plot
-    fig = px.density_contour(filt_efficiency, x=sleep_stat1, y=sleep_stat2, z=SLEEP_EFFICIENCY_COL, histfunc='avg',
-                             template='plotly_dark')
-    fig.update_traces(contours_coloring='fill', contours_showlabels=True)
+    return df_sleep, sleep_stat1, sleep_stat2, x_edges, y_edges
+
+
+def contour_figure(x_edges, y_edges, means, sleep_stat1, sleep_stat2):
+    """ Draws a grid of average sleep efficiencies as a contour plot
+    Args:
+        x_edges (np.array): edges of the bins along the x-axis
+        y_edges (np.array): edges of the bins along the y-axis
+        means (np.array): average sleep efficiency in each cell, indexed by y bin then x bin (NaN for empty cells)
+        sleep_stat1 (str): the statistic along the x-axis
+        sleep_stat2 (str): the statistic along the y-axis
+    Returns:
+        fig (go.Figure): the contour plot
+    """
+    fig = go.Figure(go.Contour(
+        x=(x_edges[1:] + x_edges[:-1]) / 2, y=(y_edges[1:] + y_edges[:-1]) / 2, z=means,
+        contours_coloring='fill', contours_showlabels=True, colorbar_title='avg of Sleep efficiency',
+        hovertemplate=sleep_stat1 + '=%{x}<br>' + sleep_stat2 + '=%{y}<br>avg of Sleep efficiency=%{z}<extra></extra>'))
 
     # update the x and y-axis labels
-    fig.update_layout(xaxis_title=sleep_stat1, yaxis_title=sleep_stat2)
+    fig.update_layout(template='plotly_dark', xaxis_title=sleep_stat1, yaxis_title=sleep_stat2)
 
-    return fig, html.H2('How ' + sleep_stat1 + ' and ' + sleep_stat2 + ' Affect Sleep Efficiency',
-                        style={'textAlign': 'center'})
+    return fig
+
+
+def show_efficiency_contour(sleep_stat1, sleep_stat2, slider_values):
+    """ Shows a density contour plot that plots the relationship between two variables and average sleep efficiency
+
+    The average sleep efficiencies are binned on the server into a grid of at most utils.GRID_BINS by utils.GRID_BINS
+    cells, so the size of the figure does not grow with the number of rows
+
+    Args:
+        sleep_stat1 (str): One statistic to be portrayed on the density contour plot
+        sleep_stat2 (str): Another statistic to be portrayed on the density contour plot
+        slider_values (list of two floats): a range of average sleep efficiencies to be represented on the plot
+    Returns:
+        fig (go.Figure): the density contour plot
+        html.H2: the contour plot's title, which changes based on the user's input for the represented variables
+    """
+    fig, title = _contour_plot(sleep_stat1, sleep_stat2, slider_values)[:2]
+
+    return fig, title
+
+
+def _contour_plot(sleep_stat1, sleep_stat2, slider_values):
+    """ Builds the density contour plot (see show_efficiency_contour), along with the rows and grid behind it
+    Args:
+        sleep_stat1 (str): One statistic to be portrayed on the density contour plot
+        sleep_stat2 (str): Another statistic to be portrayed on the density contour plot
+        slider_values (list of two floats): a range of average sleep efficiencies to be represented on the plot
+    Returns:
+        fig (go.Figure): the density contour plot
+        html.H2: the contour plot's title
+        filt_efficiency (pd.DataFrame): the rows within the range, with the statistics along both axes
+        sleep_stat1 (str): the statistic along the x-axis
+        sleep_stat2 (str): the statistic along the y-axis (changed if it was the same as the first one)
+        x_edges (np.array): edges of the bins along the x-axis
+        y_edges (np.array): edges of the bins along the y-axis
+    """
+    # saving the sleep efficiency column into a constant
+    SLEEP_EFFICIENCY_COL = 'Sleep efficiency'
+
+    df_sleep, sleep_stat1, sleep_stat2, x_edges, y_edges = _contour_rows(sleep_stat1, sleep_stat2)
+
+    # filter out appropriate values
+    cols = [sleep_stat1, sleep_stat2, SLEEP_EFFICIENCY_COL]
+    filt_efficiency = utils.filt_vals(df_sleep, slider_values, SLEEP_EFFICIENCY_COL, cols, datastore.range_index())
+
+    # average the sleep efficiencies in each cell of the grid
+    counts, sums = utils.binned_sums(filt_efficiency[sleep_stat1].values.astype(float),
+                                     filt_efficiency[sleep_stat2].values.astype(float),
+                                     filt_efficiency[SLEEP_EFFICIENCY_COL].values, x_edges, y_edges)
+
+    # plot the sleep statistics on a density contour plot
+    fig = contour_figure(x_edges, y_edges, utils.grid_means(counts, sums), sleep_stat1, sleep_stat2)
+    title = html.H2('How ' + sleep_stat1 + ' and ' + sleep_stat2 + ' Affect Sleep Efficiency',
+                    style={'textAlign': 'center'})
+
+    return fig, title, filt_efficiency, sleep_stat1, sleep_stat2, x_edges, y_edges
 
 
-@app.callback(
-    Output('smoke-vs-sleep', 'figure'),
-    Input('efficiency-slider', 'value')
-)
 def show_sleep_strip(smoker_slider):
     """ Shows a strip chart that presents the relationship between sleep efficiency and smoking status
     Args:
@@ -681,20 +841,31 @@ def show_sleep_strip(smoker_slider):
 
     # filter the data based on the user-specified sleep efficiency range
     cols = ['ID', SMOKING_COL, SLEEP_EFFICIENCY_COL]
-    sleep_smoking = utils.filt_vals(EFFICIENCY, smoker_slider, SLEEP_EFFICIENCY_COL, cols)
+    sleep_smoking = utils.filt_vals(datastore.efficiency(), smoker_slider, SLEEP_EFFICIENCY_COL, cols,
+                                    datastore.range_index())
 
     # plot the strip chart showing the relationship between smoking statuses and sleep efficiency
     fig = px.strip(sleep_smoking, x=SLEEP_EFFICIENCY_COL, y=SMOKING_COL, color=SMOKING_COL,
                    color_discrete_map={'Yes': 'forestgreen', 'No': 'red'}, template='plotly_dark')
 
+    # mark the mean sleep efficiency of each smoking status within the range, with its standard deviation, from the data
+    # cube (the browser updates the marks from the points it keeps when filtering the chart, see assets/clientside.js)
+    moments = datastore.data_cube().stats(SLEEP_EFFICIENCY_COL, filters={SLEEP_EFFICIENCY_COL: smoker_slider},
+                                          by=SMOKING_COL)
+    for status, stats in moments.items():
+        if stats['count']:
+            sd = np.sqrt(stats['var'])
+            fig.add_trace(go.Scatter(x=[stats['mean']], y=[status], error_x=dict(type='data', array=[sd]),
+                                     mode='markers', marker=dict(symbol='line-ns-open', size=24, color='white'),
+                                     customdata=[[stats['count'], sd]], meta={'mean_of': status}, name='mean ' + status,
+                                     showlegend=False,
+                                     hovertemplate=SMOKING_COL + '=%{y}<br>mean ' + SLEEP_EFFICIENCY_COL +
+                                     '=%{x:.1f}<br>standard deviation=%{customdata[1]:.1f}<br>rows=%{customdata[0]}'
+                                     '<extra></extra>'))
+
     return fig
 
 
-@app.callback(
-    Output('feature-importance', 'figure'),
-    Output('feature-importance-title', 'children'),
-    Input('feature', 'value')
-)
 def plot_eff_forest(focus_col):
     """ Plot the feature importance graph for a y-variable of interest (sleep efficiency, REM sleep percentage, or deep
         sleep percentage)
@@ -704,30 +875,14 @@ def plot_eff_forest(focus_col):
         fig (px.bar): a bar chart containing the feature importance values for the random forest regressor
         html.H2: the bar plot's title, which changes based on the user's input for the y variable of interest
     """
-    # Establish the theme of the visualization
-    sns.set()
-
-    # retrieve the columns containing the data used by the random forest regressor to make predictions
-    df_sleep, x_feat_list = utils.get_x_feat(EFFICIENCY)
-
-    # Builds the random forest regressor model that predicts the user-specified y-variable for a user
-    random_forest_reg = rf.forest_reg(focus_col, EFFICIENCY)
-
-    # plots the importance of features in determining the user-specified y variable for a person by the random forest
-    # regressor
-    fig = rf.plot_feat_import_rf_reg(x_feat_list, random_forest_reg.feature_importances_)
+    # retrieve the precomputed bar chart showing the importance of features in determining the user-specified y
+    # variable for a person by the random forest regressor
+    fig = datastore.feature_importance_figures()[focus_col]
 
     return fig, html.H2('Which variables are most important in determining your ' + focus_col + '?',
                         style={'textAlign': 'center'})
 
 
-@app.callback(
-    Output('sleep-hygiene', 'figure'),
-    Input('hygiene-awakening', 'value'),
-    Input('hygiene-caffeine', 'value'),
-    Input('hygiene-alcohol', 'value'),
-    Input('hygiene-exercise', 'value')
-)
 def plot_sleep_hygiene(awakenings, caffeine, alcohol, exercise):
     """ Makes a radar graph of sleep hygiene
     Args:
@@ -738,44 +893,33 @@ def plot_sleep_hygiene(awakenings, caffeine, alcohol, exercise):
     Returns:
         fig: the radar graph itself
     """
-    # saving the sleep efficiency data frame into a variable
-    df_sleep = EFFICIENCY.copy()
-
-    # saving columns as constants
-    AWAKENINGS_COL = 'Awakenings'
-    CAFFEINE_COL = 'Caffeine consumption 24 hrs before sleeping (mg)'
-    ALCOHOL_COL = 'Alcohol consumption 24 hrs before sleeping (oz)'
-    EXERCISE_COL = 'Exercise frequency (in days per week)'
-
-    # Getting the necessary columns for measuring hygiene
-    hygiene = df_sleep[[AWAKENINGS_COL, CAFFEINE_COL, ALCOHOL_COL, EXERCISE_COL]]
-    hygiene[CAFFEINE_COL] = np.log(hygiene[CAFFEINE_COL] + 1)
-
-    # getting average values of all columns
-    average_hygiene = hygiene.mean()
-    avg_values = average_hygiene.values.tolist()
+    # retrieve the population's average of each dimension and its sorted values, computed once from the sleep data
+    hygiene = datastore.hygiene_index()
 
     # creating the figure
     fig = go.Figure()
 
     # adding a plot to the graph - graph of the average test subject's hygiene
     fig.add_trace(go.Scatterpolar(
-        r=avg_values,
-        theta=list(hygiene.columns),
+        r=hygiene['mean'],
+        theta=utils.HYGIENE_COLS,
         fill='toself',
         name='Average Test Subject'
     ))
 
-    # Getting the user's input values
-    caffeine = np.log(caffeine + 1)
-    user_values = [awakenings, caffeine, alcohol, exercise]
+    # Getting the user's input values and where they sit within the population
+    user_values = utils.hygiene_values(awakenings, caffeine, alcohol, exercise)
+    percentiles = utils.hygiene_percentiles(hygiene, user_values)
 
     # adding a plot to the graph - graph of the user's hygiene
     fig.add_trace(go.Scatterpolar(
         r=user_values,
-        theta=list(hygiene.columns),
+        theta=utils.HYGIENE_COLS,
         fill='toself',
-        name='Your hygiene'
+        name='Your hygiene',
+        customdata=percentiles,
+        hovertemplate='%{theta}: %{r:.3g}<br>higher than %{customdata:.0f}% of test subjects<extra>%{fullData.name}'
+                      '</extra>'
     ))
 
     # update the layout of the radar graph
@@ -794,13 +938,6 @@ def plot_sleep_hygiene(awakenings, caffeine, alcohol, exercise):
     return fig
 
 
-@app.callback(
-    Output('three-dim-plot', 'figure'),
-    Output('three-dim-title', 'children'),
-    Input('independent-3D-feat1', 'value'),
-    Input('independent-3D-feat2', 'value'),
-    Input('independent-3D-feat3', 'value')
-)
 def plot_three_dim_scatter(sleep_stat_x, sleep_stat_y, sleep_stat_z):
     """ Plot a 3D scatter plot showing the relationship between 3 sleep variables
     Args:
@@ -813,30 +950,31 @@ def plot_three_dim_scatter(sleep_stat_x, sleep_stat_y, sleep_stat_z):
                  variables
     """
     # performing one hot encoding if gender and/or smoking status needs to be shown on the plot
-    df_sleep = utils.encode(sleep_stat_x, sleep_stat_y, EFFICIENCY)
+    efficiency = datastore.efficiency()
+    df_sleep = utils.encode(sleep_stat_x, sleep_stat_y, efficiency)
+
+    # past LOD_ROWS rows, only draw a sample of the rows in which each gender keeps its share (3D scatter plots are
+    # always drawn with WebGL)
+    sampled = len(df_sleep) > LOD_ROWS
+    if sampled:
+        positions, n_total = utils.sample_rows(efficiency, [sleep_stat_x, sleep_stat_y, sleep_stat_z, 'Gender'],
+                                               SCATTER_3D_POINT_BUDGET, strata_col='Gender',
+                                               name='plot_three_dim_scatter')
+        df_sleep = df_sleep.iloc[positions]
 
     # plot the 3D scatter plot
     fig = px.scatter_3d(df_sleep, x=sleep_stat_x, y=sleep_stat_y, z=sleep_stat_z, color='Gender',
                         template='plotly_dark', width=633, height=499)
+    if sampled:
+        fig.update_layout(title_text=sample_title(len(positions), n_total))
 
     return fig, html.H2('3D View of ' + sleep_stat_x + ' vs ' + sleep_stat_y + ' vs ' + sleep_stat_z,
                         style={'textAlign': 'center'})
 
 
-@app.callback(
-    Output('sleep-eff', 'children'),
-    Input('sleep-age', 'value'),
-    Input('sleep-bedtime', 'value'),
-    Input('sleep-wakeuptime', 'value'),
-    Input('sleep-awakenings', 'value'),
-    Input('sleep-caffeine', 'value'),
-    Input('sleep-alcohol', 'value'),
-    Input('sleep-exercise', 'value'),
-    Input('sleep-gender', 'value'),
-    Input('sleep-smoke', 'value')
-)
-def calc_eff_reg(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke):
-    """ Allow users to get their predicted sleep efficiency given information about them
+def calc_sleep_reg(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke):
+    """ Allow users to get their predicted sleep efficiency, REM sleep percentage and deep sleep percentage given
+        information about them
     Args:
         age (int): the age of the user
         bedtime (float): user's bedtime based on hours into the day (military time)
@@ -849,89 +987,21 @@ def calc_eff_reg(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exerci
         smoke (str): whether the user smokes
     Returns:
         a message containing the user's predicted sleep efficiency
-    """
-    # predict sleep efficiency based on user inputs from the dropdown and sliders
-    y_pred = utils.predict_sleep_quality('Sleep efficiency', EFFICIENCY, age, bedtime, wakeuptime, awakenings, caffeine,
-                                         alcohol, exercise, gender, smoke)
-
-    # display the user's predicted sleep efficiency
-    return 'Your predicted sleep efficiency (expressed in %) is \n{}'.format(round(float(y_pred), 2))
-
-
-@app.callback(
-    Output('sleep-rem', 'children'),
-    Input('sleep-age', 'value'),
-    Input('sleep-bedtime', 'value'),
-    Input('sleep-wakeuptime', 'value'),
-    Input('sleep-awakenings', 'value'),
-    Input('sleep-caffeine', 'value'),
-    Input('sleep-alcohol', 'value'),
-    Input('sleep-exercise', 'value'),
-    Input('sleep-gender', 'value'),
-    Input('sleep-smoke', 'value')
-)
-def calc_rem_reg(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke):
-    """ Allow users to get their predicted REM sleep percentage given information about them
-    Args:
-        age (int): the age of the user
-        bedtime (float): user's bedtime based on hours into the day (military time)
-        wakeuptime (float): user's wakeup time based on hours into the day (military time)
-        awakenings (int): number of awakenings a user has on a given night
-        caffeine (int): amount of caffeine a user consumes in the 24 hours prior to bedtime (in mg)
-        alcohol (int): amount of alcohol a user consumes in the 24 hours prior to bedtime (in oz)
-        exercise (int): how many times the user exercises in a week
-        gender (str): biological gender of the user
-        smoke (str): whether the user smokes
-    Returns:
         a message with the user's predicted REM sleep percentage
-    """
-    # predict REM sleep percentage based on user inputs from the dropdown and sliders
-    y_pred = utils.predict_sleep_quality('REM sleep percentage', EFFICIENCY, age, bedtime, wakeuptime, awakenings,
-                                         caffeine, alcohol, exercise, gender, smoke)
-
-    # display the user's predicted REM sleep percentage
-    return 'Your predicted REM sleep percentage is \n{}'.format(round(float(y_pred), 2))
-
-
-@app.callback(
-    Output('sleep-deep', 'children'),
-    Input('sleep-age', 'value'),
-    Input('sleep-bedtime', 'value'),
-    Input('sleep-wakeuptime', 'value'),
-    Input('sleep-awakenings', 'value'),
-    Input('sleep-caffeine', 'value'),
-    Input('sleep-alcohol', 'value'),
-    Input('sleep-exercise', 'value'),
-    Input('sleep-gender', 'value'),
-    Input('sleep-smoke', 'value')
-)
-def calc_deep_reg(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke):
-    """ Allow users to get their predicted deep sleep percentage given information about them
-    Args:
-        age (int): the age of the user
-        bedtime (float): user's bedtime based on hours into the day (military time)
-        wakeuptime (float): user's wakeup time based on hours into the day (military time)
-        awakenings (int): number of awakenings a user has on a given night
-        caffeine (int): amount of caffeine a user consumes in the 24 hours prior to bedtime (in mg)
-        alcohol (int): amount of alcohol a user consumes in the 24 hours prior to bedtime (in oz)
-        exercise (int): how many times the user exercises in a week
-        gender (str): biological gender of the user
-        smoke (str): whether the user smokes
-    Returns:
         a message with the user's predicted deep sleep percentage
     """
-    # predict deep sleep percentage based on user inputs from the dropdown and sliders
-    y_pred = utils.predict_sleep_quality('Deep sleep percentage', EFFICIENCY, age, bedtime, wakeuptime, awakenings,
-                                         caffeine, alcohol, exercise, gender, smoke)
+    # predict sleep efficiency, REM sleep percentage and deep sleep percentage at once based on user inputs from the
+    # dropdown and sliders
+    y_pred = utils.predict_sleep_quality(rf.TARGET_COLS, datastore.efficiency(), age, bedtime, wakeuptime,
+                                         awakenings, caffeine, alcohol, exercise, gender, smoke)
+    eff_pred, rem_pred, deep_pred = y_pred[0]
 
-    # display the user's predicted deep sleep percentage
-    return 'Your predicted deep sleep percentage is \n{}'.format(round(float(y_pred), 2))
+    # display the user's predicted sleep efficiency, REM sleep percentage and deep sleep percentage
+    return 'Your predicted sleep efficiency (expressed in %) is \n{}'.format(round(float(eff_pred), 2)), \
+           'Your predicted REM sleep percentage is \n{}'.format(round(float(rem_pred), 2)), \
+           'Your predicted deep sleep percentage is \n{}'.format(round(float(deep_pred), 2))
 
 
-@app.callback(
-    Output('helper-div', 'children'),
-    Input('help-options', 'value')
-)
 def show_help(query):
     """ Shows helpful hints in the 'Need Help?' tab based on the dropdown selection
     Args:
@@ -1046,7 +1116,8 @@ def show_help(query):
                        'based on where the colors overlap. If the red diamond, which represents you, '
                        'closely aligns with the blue diamond, which represents the average test subject for the study '
                        'that provided the data for this dashboard, then the chart indicates that your habits '
-                       'generally align with the average participant in the study.'),
+                       'generally align with the average participant in the study. Hovering over a corner of the red '
+                       'diamond shows the percentage of test subjects whose habit is lower than yours.'),
 
                 # a video that helps the user to navigate through the radar chart
                 html.Video(
@@ -1093,9 +1164,252 @@ def show_help(query):
                 )]
 
 
+def contour_figure_data(sleep_stat1, sleep_stat2):
+    """ Builds the density contour plot for every row within the bounds of the efficiency slider, along with the counts
+        and sums of each cell of its grid split by sleep efficiency, so that the browser can average the cells over any
+        range of the slider (see assets/clientside.js)
+
+    The rows are split by the half step of their sleep efficiency (see utils.half_steps), so that summing the slices
+    between 2 * lo and 2 * hi selects exactly the rows utils.filt_vals would select for the range [lo, hi]
+
+    Args:
+        sleep_stat1 (str): One statistic to be portrayed on the density contour plot
+        sleep_stat2 (str): Another statistic to be portrayed on the density contour plot
+    Returns:
+        data (dict): the figure, its half steps and the flattened counts and sums of the cells of each of them
+        html.H2: the contour plot's title
+    """
+    # saving the sleep efficiency column into a constant
+    SLEEP_EFFICIENCY_COL = 'Sleep efficiency'
+
+    # bin and filter the rows once, for both the figure and the slices of its grid
+    fig, title, all_rows, sleep_stat1, sleep_stat2, x_edges, y_edges = _contour_plot(sleep_stat1, sleep_stat2,
+                                                                                     EFFICIENCY_SLIDER_RANGE)
+
+    # count and sum the sleep efficiencies in each cell of the grid, for each half step of sleep efficiency
+    steps = utils.half_steps(all_rows[SLEEP_EFFICIENCY_COL].values)
+    step_edges = np.arange(2 * EFFICIENCY_SLIDER_RANGE[0], 2 * EFFICIENCY_SLIDER_RANGE[1] + 2) - 0.5
+    sample = np.column_stack([steps, all_rows[sleep_stat2].values.astype(float),
+                              all_rows[sleep_stat1].values.astype(float)])
+    counts = np.histogramdd(sample, bins=[step_edges, y_edges, x_edges])[0]
+    sums = np.histogramdd(sample, bins=[step_edges, y_edges, x_edges],
+                          weights=all_rows[SLEEP_EFFICIENCY_COL].values)[0]
+
+    # only send the half steps that hold rows
+    filled = np.flatnonzero(counts.sum(axis=(1, 2)))
+    data = {'figure': fig, 'shape': [len(y_edges) - 1, len(x_edges) - 1],
+            'steps': (2 * EFFICIENCY_SLIDER_RANGE[0] + filled).tolist(),
+            'counts': counts[filled].reshape(len(filled), -1).tolist(),
+            'sums': sums[filled].reshape(len(filled), -1).tolist()}
+
+    return data, title
+
+
+def strip_figure_data(store_id):
+    """ Builds the strip chart from every row within the bounds of the efficiency slider, for the browser to filter
+        (see assets/clientside.js)
+    Args:
+        store_id (str): id of the store receiving the strip chart (only there to fire the callback once per page load)
+    Returns:
+        the strip chart, serialized
+    """
+    return figure_cache.memoize(show_sleep_strip)(EFFICIENCY_SLIDER_RANGE)
+
+
+def prewarm_calls():
+    """ Lists the most common inputs of the memoized figure callbacks: the defaults of the layout, and every variable
+        of the shared dependent variable dropdown with both genders ticked
+    Returns:
+        calls (list of tuples): the callbacks and argument tuples of interest
+    """
+    dep_stats = ['Sleep duration', 'Sleep efficiency', 'REM sleep percentage', 'Deep sleep percentage',
+                 'Light sleep percentage', 'Awakenings', 'Caffeine consumption 24 hrs before sleeping (mg)',
+                 'Alcohol consumption 24 hrs before sleeping (oz)', 'Exercise frequency (in days per week)', 'Age',
+                 'Wakeup time', 'Bedtime']
+
+    calls = [(show_efficiency_contour, ('Awakenings', 'Light sleep percentage', EFFICIENCY_SLIDER_RANGE)),
+             (show_sleep_strip, (EFFICIENCY_SLIDER_RANGE,)),
+             (plot_three_dim_scatter, ('Age', 'Awakenings', 'Sleep efficiency'))]
+    for sleep_stat in dep_stats:
+        calls += [(make_sleep_scatter, (['Show Trend Line'], 'Age', sleep_stat)),
+                  (show_sleep_gender_violin_plot, (['Male', 'Female'], sleep_stat)),
+                  (show_sleep_gender_histogram, (['Male', 'Female'], sleep_stat))]
+
+    return calls
+
+
+def register_callbacks(app, clientside=False):
+    """ Registers every callback of the dashboard on a Dash app (the figures of the Sleep Statistics tab are memoized)
+    Args:
+        app (Dash): the Dash app of interest
+        clientside (bool): whether the efficiency slider filters the strip chart and density contour plot in the
+                           browser (the layout must then include the stores in CLIENTSIDE_STORES)
+    """
+    app.callback(
+        Output('sleep-scatter', 'figure'),
+        Output('sleep-qual-title', 'children'),
+        Input('scatter-trend-line', 'value'),
+        Input('sleep-stat-ind', 'value'),
+        Input('sleep-stat-dep', 'value')
+    )(figure_cache.memoize(make_sleep_scatter))
+
+    app.callback(
+        Output('violin-gender', 'figure'),
+        Output('gender-plots-title', 'children'),
+        Input('gender-options', 'value'),
+        Input('sleep-stat-dep', 'value')
+    )(figure_cache.memoize(show_sleep_gender_violin_plot))
+
+    app.callback(
+        Output('hist-gender', 'figure'),
+        Input('gender-options', 'value'),
+        Input('sleep-stat-dep', 'value')
+    )(figure_cache.memoize(show_sleep_gender_histogram))
+
+    if clientside:
+        # the server only builds the figures from every row within the bounds of the slider, and the browser filters
+        # them whenever the slider moves
+        app.callback(
+            Output('contour-figure', 'data'),
+            Output('mult-feat-eff', 'children'),
+            Input('density-stat1', 'value'),
+            Input('density-stat2', 'value')
+        )(figure_cache.memoize(contour_figure_data))
+
+        app.callback(
+            Output('strip-figure', 'data'),
+            Input('strip-figure', 'id')
+        )(strip_figure_data)
+
+        app.clientside_callback(
+            ClientsideFunction(namespace='sleep', function_name='filter_contour'),
+            Output('efficiency-contour', 'figure'),
+            Input('contour-figure', 'data'),
+            Input('efficiency-slider', 'value')
+        )
+
+        app.clientside_callback(
+            ClientsideFunction(namespace='sleep', function_name='filter_strip'),
+            Output('smoke-vs-sleep', 'figure'),
+            Input('strip-figure', 'data'),
+            Input('efficiency-slider', 'value')
+        )
+    else:
+        app.callback(
+            Output('efficiency-contour', 'figure'),
+            Output('mult-feat-eff', 'children'),
+            Input('density-stat1', 'value'),
+            Input('density-stat2', 'value'),
+            Input('efficiency-slider', 'value')
+        )(figure_cache.memoize(show_efficiency_contour))
+
+        app.callback(
+            Output('smoke-vs-sleep', 'figure'),
+            Input('efficiency-slider', 'value')
+        )(figure_cache.memoize(show_sleep_strip))
+
+    app.callback(
+        Output('feature-importance', 'figure'),
+        Output('feature-importance-title', 'children'),
+        Input('feature', 'value')
+    )(plot_eff_forest)
+
+    app.callback(
+        Output('sleep-hygiene', 'figure'),
+        Input('hygiene-awakening', 'value'),
+        Input('hygiene-caffeine', 'value'),
+        Input('hygiene-alcohol', 'value'),
+        Input('hygiene-exercise', 'value')
+    )(plot_sleep_hygiene)
+
+    app.callback(
+        Output('three-dim-plot', 'figure'),
+        Output('three-dim-title', 'children'),
+        Input('independent-3D-feat1', 'value'),
+        Input('independent-3D-feat2', 'value'),
+        Input('independent-3D-feat3', 'value')
+    )(figure_cache.memoize(plot_three_dim_scatter))
+
+    app.callback(
+        Output('sleep-eff', 'children'),
+        Output('sleep-rem', 'children'),
+        Output('sleep-deep', 'children'),
+        Input('sleep-age', 'value'),
+        Input('sleep-bedtime', 'value'),
+        Input('sleep-wakeuptime', 'value'),
+        Input('sleep-awakenings', 'value'),
+        Input('sleep-caffeine', 'value'),
+        Input('sleep-alcohol', 'value'),
+        Input('sleep-exercise', 'value'),
+        Input('sleep-gender', 'value'),
+        Input('sleep-smoke', 'value')
+    )(calc_sleep_reg)
+
+    app.callback(
+        Output('helper-div', 'children'),
+        Input('help-options', 'value')
+    )(show_help)
+
+
+def create_app(preload=None, prewarm=None, clientside=None, hot_reload=None):
+    """ Builds the dashboard
+    Args:
+        preload (bool): whether the data and models get loaded right away instead of when a callback first needs them
+                        (defaults to whether the SLEEP_PRELOAD environment variable is set to 1)
+        prewarm (bool): whether the figures of the most common inputs get built right away (defaults to whether the
+                        SLEEP_FIGURE_PREWARM environment variable is set to 1)
+        clientside (bool): whether the efficiency slider filters its plots in the browser instead of on the server
+                           (defaults to whether the SLEEP_CLIENTSIDE environment variable is set to 1)
+        hot_reload (bool): whether the data and models get reloaded in the background whenever the data file changes
+                           (defaults to whether the SLEEP_HOT_RELOAD environment variable is set to 1)
+    Returns:
+        app (Dash): the dashboard
+    """
+    app = Dash(__name__)
+
+    # record the latency, exceptions and response sizes of every callback and serve them on /metrics, along with the
+    # statistics of the figure and prediction caches
+    metrics.instrument_app(app)
+    metrics.register_cache('figures', figure_cache.FIGURE_CACHE)
+    metrics.register_cache('predictions', utils.PREDICTION_CACHE)
+    metrics.register_cache('samples', utils.SAMPLE_CACHE)
+
+    # lay out the dashboard and connect its components
+    if clientside is None:
+        clientside = os.environ.get('SLEEP_CLIENTSIDE', '0') == '1'
+    app.layout = html.Div([LAYOUT] + CLIENTSIDE_STORES) if clientside else LAYOUT
+    register_callbacks(app, clientside)
+
+    # read a single version of the data during each request, and watch the data file for new versions if requested
+    if hot_reload is None:
+        hot_reload = os.environ.get('SLEEP_HOT_RELOAD', '0') == '1'
+    datastore.pin_requests(app.server, watch_file=hot_reload)
+
+    # load the data and models once up front if requested
+    if preload is None:
+        preload = os.environ.get('SLEEP_PRELOAD', '0') == '1'
+    if preload:
+        datastore.preload()
+
+    # build the most common figures up front if requested
+    if prewarm is None:
+        prewarm = os.environ.get('SLEEP_FIGURE_PREWARM', '0') == '1'
+    if prewarm:
+        figure_cache.prewarm(prewarm_calls())
+
+    return app
+
+
+# the dashboard and the WSGI server behind it
+app = create_app()
+server = app.server
+
+
 def main():
-    # run app
+    # log the reloads of the data, then run app
+    logging.basicConfig(level=logging.INFO)
     app.run_server(debug=True)
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -19,9 +19,16 @@ REM sleep percentage, and 0.35 for predicting deep sleep percentage.
 
 It appears that just using the top 3 important features to make predictions actually makes the random forest
 regressors worse (lower cross-validated r^2). Therefore, we used all the variables in the random forest regressors when
-we made the sleep predictor in sleep.py and random_forest_assets.py"""
+we made the sleep predictor in sleep.py and random_forest_assets.py
+
+A single multi-output random forest regressor that predicts all three values at once scores within a few hundredths of
+the regressors that predict one value each (sometimes higher, sometimes lower, depending on the folds), so the sleep
+predictor in sleep.py trains and queries one multi-output regressor instead of three separate ones"""
 
 # Import statements
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from sklearn.model_selection import KFold
 from copy import copy
@@ -65,58 +72,222 @@ def map_feature_import_vals(feat_list, feat_import, sort=True, limit=None):
     return feature_rank
 
 
-def random_forest(x_feat_list, df, y_feat):
+def _fit_fold(x, y, train_idx, test_idx, random_state):
+    """ Fit a random forest regressor on one training fold and predict the matching test fold (a top-level function
+        so that folds can be sent to worker processes)
+    Args:
+        x (np.array): x-variables of every subject
+        y (np.array): y-variable of every subject
+        train_idx (np.array): positions of the subjects in the training fold
+        test_idx (np.array): positions of the subjects in the test fold
+        random_state (int): seed of the random forest regressor
+    Return:
+        y_pred (np.array): predictions for the test fold
+        feature_importances (np.array): feature importance values of the fitted regressor
+    """
+    # initialize a seeded random forest regressor and give it the training data
+    random_forest_reg = RandomForestRegressor(random_state=random_state)
+    random_forest_reg.fit(x[train_idx, :], y[train_idx])
+
+    # estimate the value of each test subject
+    y_pred = random_forest_reg.predict(x[test_idx, :])
+
+    return y_pred, random_forest_reg.feature_importances_
+
+
+def _split_folds(x_feat_list, df, y_feat, random_state):
+    """ Extract the data of interest and split it into the cross-validation folds
+    Args:
+        x_feat_list (list): list of x-variables of interest (basis of training data)
+        df (Pandas dataframe): a data frame containing data used to help the random forest regressor make predictions
+        y_feat (str): y-variable of interest (the testing value)
+        random_state (int): seed of the fold shuffling
+    Return:
+        x (np.array): x-variables of every subject
+        y (np.array): y-variable of every subject
+        folds (list): (training positions, test positions) of each fold
+    """
+    # extract data from dataframe
+    x = df.loc[:, x_feat_list].values
+    y = df.loc[:, y_feat].values
+
+    # Cross-validation:
+    # construction of (non-stratified) kfold object
+    kfold = KFold(n_splits=10, shuffle=True, random_state=random_state)
+    folds = list(kfold.split(x, y))
+
+    return x, y, folds
+
+
+def _score_folds(x_feat_list, y_true, folds, fold_results):
+    """ Combine the predictions made for each test fold into a cross-validated r^2 score
+    Args:
+        x_feat_list (list): list of x-variables of interest (basis of training data)
+        y_true (np.array): y-variable of every subject
+        folds (list): (training positions, test positions) of each fold
+        fold_results (list): (predictions, feature importance values) of each fold (see _fit_fold)
+    Return:
+        r_squared (float): cross-validated r^2 score of the model
+        importance_metrics (list): has tuples that map certain features to their feature importance values
+    """
+    # allocate an empty array to store predictions in
+    y_pred = np.empty(len(y_true))
+    for (train_idx, test_idx), (fold_pred, feature_importances) in zip(folds, fold_results):
+        y_pred[test_idx] = fold_pred
+
+    # computing cross-validated R2 from sklearn
+    r_squared = r2_score(y_true=y_true, y_pred=y_pred)
+
+    # creates a list of tuples that map features to their importance value (from the regressor of the last fold)
+    importance_metrics = map_feature_import_vals(x_feat_list, fold_results[-1][1])
+
+    return r_squared, importance_metrics
+
+
+def random_forest(x_feat_list, df, y_feat, random_state=0):
     """ Build a random forest regressor by training and testing it and compute its cross-validated r^2 score
     Args:
         x_feat_list (list): list of x-variables of interest (basis of training data)
         df (Pandas dataframe): a data frame containing data used to help the random forest regressor make predictions
         y_feat (str): y-variable of interest (the testing value)
+        random_state (int): seed of the fold shuffling and of the regressors (makes the results reproducible)
     Return:
         r_squared (float): cross-validated r^2 score of the model
         importance_metrics (list): has tuples that map certain features to their feature importance (mean MSE reduce)
                                    values
     """
-    # define the testing value
-    y_feat = y_feat
+    # split the data into the cross-validation folds
+    x, y_true, folds = _split_folds(x_feat_list, df, y_feat, random_state)
+
+    # fit a regressor on each training fold and estimate the value of each test subject, one fold after another
+    fold_results = [_fit_fold(x, y_true, train_idx, test_idx, random_state) for train_idx, test_idx in folds]
+
+    return _score_folds(x_feat_list, y_true, folds, fold_results)
+
 
+def oob_forest(x_feat_list, df, y_feat, random_state=0):
+    """ Build a random forest regressor and compute its out-of-bag r^2 score, which estimates the same thing as a
+        cross-validated r^2 score with a single fit (each subject is only predicted by the trees that never saw it)
+    Args:
+        x_feat_list (list): list of x-variables of interest (basis of training data)
+        df (Pandas dataframe): a data frame containing data used to help the random forest regressor make predictions
+        y_feat (str): y-variable of interest (the testing value)
+        random_state (int): seed of the regressor (makes the results reproducible)
+    Return:
+        r_squared (float): out-of-bag r^2 score of the model
+        importance_metrics (list): has tuples that map certain features to their feature importance (mean MSE reduce)
+                                   values
+    """
     # extract data from dataframe
     x = df.loc[:, x_feat_list].values
     y = df.loc[:, y_feat].values
 
+    # fit a single regressor that keeps track of its out-of-bag predictions
+    random_forest_reg = RandomForestRegressor(oob_score=True, random_state=random_state)
+    random_forest_reg.fit(x, y)
+
+    # creates a list of tuples that map features to their importance value
+    importance_metrics = map_feature_import_vals(x_feat_list, random_forest_reg.feature_importances_)
+
+    return random_forest_reg.oob_score_, importance_metrics
+
+
+def parallel_random_forests(evaluations, df, workers=None, random_state=0):
+    """ Compute the cross-validated r^2 scores of several random forest regressors at once by spreading every fold of
+        every regressor across a pool of processes (the results match those of random_forest with the same seed)
+    Args:
+        evaluations (list): (x-variables, y-variable) of each regressor of interest
+        df (Pandas dataframe): a data frame containing data used to help the random forest regressors make predictions
+        workers (int): number of processes (defaults to the number of CPUs)
+        random_state (int): seed of the fold shuffling and of the regressors (makes the results reproducible)
+    Return:
+        results (list): (cross-validated r^2 score, importance metrics) of each regressor, in the order of evaluations
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # submit the folds of every regressor before waiting on any of them so that all the processes stay busy
+        submitted = []
+        for x_feat_list, y_feat in evaluations:
+            x, y_true, folds = _split_folds(x_feat_list, df, y_feat, random_state)
+            futures = [executor.submit(_fit_fold, x, y_true, train_idx, test_idx, random_state)
+                       for train_idx, test_idx in folds]
+            submitted.append((x_feat_list, y_true, folds, futures))
+
+        # combine the folds of each regressor into its scores
+        results = [_score_folds(x_feat_list, y_true, folds, [future.result() for future in futures])
+                   for x_feat_list, y_true, folds, futures in submitted]
+
+    return results
+
+
+def multi_output_forest(x_feat_list, df, y_feats, random_state=0):
+    """ Build a single random forest regressor that predicts several y-variables at once and compute its
+        cross-validated r^2 score for each of them
+    Args:
+        x_feat_list (list): list of x-variables of interest (basis of training data)
+        df (Pandas dataframe): a data frame containing data used to help the random forest regressor make predictions
+        y_feats (list): y-variables of interest (the testing values)
+        random_state (int): seed of the fold shuffling and of the regressor (makes the results reproducible)
+    Return:
+        r_squared (list of float): cross-validated r^2 score of the model for each y-variable
+    """
+    # extract data from dataframe (one column per y-variable)
+    x = df.loc[:, x_feat_list].values
+    y_true = df.loc[:, y_feats].values
+
     # initialize a random forest regressor
-    random_forest_reg = RandomForestRegressor()
-    y_true = y
+    random_forest_reg = RandomForestRegressor(random_state=random_state)
 
     # Cross-validation:
-    # construction of (non-stratified) kfold object
-    kfold = KFold(n_splits=10, shuffle=True)
+    # construction of (non-stratified) kfold object (the same folds as random_forest)
+    kfold = KFold(n_splits=10, shuffle=True, random_state=random_state)
 
     # allocate an empty array to store predictions in
-    y_pred = copy(y_true)
+    y_pred = copy(y_true).astype(float)
 
     for train_idx, test_idx in kfold.split(x, y_true):
-        # build arrays which correspond to x, y train /test
-        x_test = x[test_idx, :]
-        x_train = x[train_idx, :]
-        y_true_train = y_true[train_idx]
+        # fit one regressor on all the y-variables of the training fold at once
+        random_forest_reg.fit(x[train_idx, :], y_true[train_idx])
 
-        # fit happens "inplace", we modify the internal state of random_forest_reg to remember all the training samples;
-        # gives the regressor the training data
-        random_forest_reg.fit(x_train, y_true_train)
+        # every y-variable of the test fold is estimated with a single pass through the trees
+        y_pred[test_idx] = random_forest_reg.predict(x[test_idx, :])
 
-        # estimate the class of each test value
-        y_pred[test_idx] = random_forest_reg.predict(x_test)
+    # computing cross-validated R2 for each y-variable from sklearn
+    r_squared = [r2_score(y_true=y_true[:, i], y_pred=y_pred[:, i]) for i in range(len(y_feats))]
 
-    # computing cross-validated R2 from sklearn
-    r_squared = r2_score(y_true=y_true, y_pred=y_pred)
+    return r_squared
 
-    # creates a list of tuples that map features to their importance value
-    importance_metrics = map_feature_import_vals(x_feat_list, random_forest_reg.feature_importances_)
 
-    return r_squared, importance_metrics
+def evaluate(evaluations, df, mode, workers=None):
+    """ Score random forest regressors with one of the evaluation modes
+    Args:
+        evaluations (list): (x-variables, y-variable) of each regressor of interest
+        df (Pandas dataframe): a data frame containing data used to help the random forest regressors make predictions
+        mode (str): 'cv' (serial 10-fold cross-validation), 'parallel' (10-fold cross-validation spread across
+                    processes) or 'oob' (out-of-bag score of a single fit)
+        workers (int): number of processes used by the parallel mode (defaults to the number of CPUs)
+    Return:
+        results (list): (r^2 score, importance metrics) of each regressor, in the order of evaluations
+        duration (float): wall-clock time taken by the evaluation (in seconds)
+    """
+    start = time.perf_counter()
+    if mode == 'parallel':
+        results = parallel_random_forests(evaluations, df, workers)
+    elif mode == 'oob':
+        results = [oob_forest(x_feat_list, df, y_feat) for x_feat_list, y_feat in evaluations]
+    else:
+        results = [random_forest(x_feat_list, df, y_feat) for x_feat_list, y_feat in evaluations]
+    duration = time.perf_counter() - start
+
+    return results, duration
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Evaluate random forest regressors predicting sleep quality')
+    parser.add_argument('--mode', choices=['cv', 'parallel', 'oob', 'all'], default='cv',
+                        help='evaluation mode ("all" runs and times every mode)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes used by the parallel mode')
+    args = parser.parse_args()
+
     # read in the sleep efficiency data frame, which contains information about the sleep quality of multiple subjects
     EFFICIENCY = utils.read_file('data/Sleep_Efficiency.csv')
 
@@ -127,41 +298,53 @@ def main():
     # deep sleep percentage
     df_sleep, x_feat_list = utils.get_x_feat(EFFICIENCY)
 
-    # retrieve the r^2 values and the feature importance values associated with the random forest regressors and their
-    # predictions about sleep efficiency, REM sleep percentage, and deep sleep percentage
-    r2_sleep_eff, importance_eff = random_forest(x_feat_list, df_sleep, 'Sleep efficiency')
-    r2_rem_sleep, importance_rem = random_forest(x_feat_list, df_sleep, 'REM sleep percentage')
-    r2_deep_sleep, importance_deep = random_forest(x_feat_list, df_sleep, 'Deep sleep percentage')
-
-    # print the cross-validated r^2 values and feature importance metrics
-    print('The cross-validated r2 for predicting sleep efficiency is', r2_sleep_eff, 'and the feature importance '
-                                                                                     'values of the x-variables in '
-                                                                                     'descending order is',
-          importance_eff)
-    print('The cross-validated r2 for predicting REM sleep percentage is', r2_rem_sleep, 'and the feature importance '
-                                                                                         'values of the x-variables in '
-                                                                                         'descending order is',
-          importance_rem)
-    print('The cross-validated r2 for predicting deep sleep percentage is', r2_deep_sleep, 'and the feature importance '
-                                                                                           'values of the x-variables '
-                                                                                           'in descending order is',
-          importance_deep)
-
-    # random forest regressor using the top 3 features from each initial model to predict sleep efficiency, REM sleep
-    # percentage, and deep sleep percentage
-    i_r2_sleep_eff, i_importance_eff = random_forest(['Awakenings', 'Age', 'Alcohol consumption 24 hrs before'
-                                                      ' sleeping (oz)'], df_sleep, 'Sleep efficiency')
-    i_r2_rem_sleep, i_importance_rem = random_forest(['Age', 'Wakeup time', 'Bedtime'], df_sleep,
-                                                     'REM sleep percentage')
-    i_r2_deep_sleep, i_importance_deep = random_forest(['Alcohol consumption 24 hrs before sleeping (oz)', 'Age',
-                                                        'Awakenings'], df_sleep, 'Deep sleep percentage')
-
-    # print the cross-validated r^2 values for the models just using the critical features
-    print('The cross-validated r2 for predicting sleep efficiency with just the critical features is', i_r2_sleep_eff)
-    print('The cross-validated r2 for predicting REM sleep percentage with just the critical features is',
-          i_r2_rem_sleep)
-    print('The cross-validated r2 for predicting deep sleep percentage with just the critical features is',
-          i_r2_deep_sleep)
+    # the regressors using every feature, followed by the regressors using the top 3 features from each initial model,
+    # predicting sleep efficiency, REM sleep percentage, and deep sleep percentage
+    evaluations = [(x_feat_list, 'Sleep efficiency'), (x_feat_list, 'REM sleep percentage'),
+                   (x_feat_list, 'Deep sleep percentage'),
+                   (['Awakenings', 'Age', 'Alcohol consumption 24 hrs before sleeping (oz)'], 'Sleep efficiency'),
+                   (['Age', 'Wakeup time', 'Bedtime'], 'REM sleep percentage'),
+                   (['Alcohol consumption 24 hrs before sleeping (oz)', 'Age', 'Awakenings'],
+                    'Deep sleep percentage')]
+
+    modes = ['cv', 'parallel', 'oob'] if args.mode == 'all' else [args.mode]
+    cv_r2 = None
+    for mode in modes:
+        # retrieve the r^2 values and the feature importance values associated with the random forest regressors
+        results, duration = evaluate(evaluations, df_sleep, mode, args.workers)
+        (r2_sleep_eff, importance_eff), (r2_rem_sleep, importance_rem), (r2_deep_sleep, importance_deep), \
+            (i_r2_sleep_eff, _), (i_r2_rem_sleep, _), (i_r2_deep_sleep, _) = results
+        score = 'out-of-bag' if mode == 'oob' else 'cross-validated'
+        print('Evaluation mode:', mode, '({:.2f} seconds of wall-clock time)'.format(duration))
+
+        # print the r^2 values and feature importance metrics
+        print('The', score, 'r2 for predicting sleep efficiency is', r2_sleep_eff, 'and the feature importance values '
+              'of the x-variables in descending order is', importance_eff)
+        print('The', score, 'r2 for predicting REM sleep percentage is', r2_rem_sleep, 'and the feature importance '
+              'values of the x-variables in descending order is', importance_rem)
+        print('The', score, 'r2 for predicting deep sleep percentage is', r2_deep_sleep, 'and the feature importance '
+              'values of the x-variables in descending order is', importance_deep)
+
+        # print the r^2 values for the models just using the critical features
+        print('The', score, 'r2 for predicting sleep efficiency with just the critical features is', i_r2_sleep_eff)
+        print('The', score, 'r2 for predicting REM sleep percentage with just the critical features is',
+              i_r2_rem_sleep)
+        print('The', score, 'r2 for predicting deep sleep percentage with just the critical features is',
+              i_r2_deep_sleep)
+
+        # remember the cross-validated r^2 values of the regressors using every feature
+        if mode != 'oob':
+            cv_r2 = [r2_sleep_eff, r2_rem_sleep, r2_deep_sleep]
+
+    # compare the accuracy of the single multi-output regressor used by the sleep predictor with that of the
+    # regressors predicting one y-variable each (only cross-validated r^2 values are comparable)
+    if cv_r2 is None:
+        return
+    y_feats = ['Sleep efficiency', 'REM sleep percentage', 'Deep sleep percentage']
+    multi_r2 = multi_output_forest(x_feat_list, df_sleep, y_feats)
+    for y_feat, single_r2, m_r2 in zip(y_feats, cv_r2, multi_r2):
+        print('The cross-validated r2 for predicting', y_feat, 'with the multi-output regressor is', m_r2,
+              '(a difference of', m_r2 - single_r2, 'from the regressor that only predicts', y_feat + ')')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+"""
+Shared setup of the dashboard's tests: the modules of the dashboard live at the root of the repository, and read the
+sleep data, models and cached data from paths relative to it unless their environment variables say otherwise
+"""
+# import statements
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('SLEEP_DATA_FILE', os.path.join(ROOT, 'data', 'Sleep_Efficiency.csv'))
+os.environ.setdefault('SLEEP_MODEL_DIR', os.path.join(ROOT, 'models'))
+os.environ.setdefault('SLEEP_CACHE_DIR', os.path.join(ROOT, 'cache'))
@@ -0,0 +1,128 @@
+"""
+Checks that filtering the strip chart and density contour plot in the browser (assets/clientside.js) keeps the same
+rows as filtering them on the server (utils.filt_vals): the store figures are built like the clientside callbacks build
+them, the actual JavaScript filters run on them through node, and the results are compared with the server's figures
+"""
+# import statements
+import base64
+import json
+import os
+import shutil
+import subprocess
+import numpy as np
+import plotly
+import pytest
+from conftest import ROOT
+import datastore
+import sleep
+import utils
+
+SLEEP_EFFICIENCY_COL = 'Sleep efficiency'
+SMOKING_COL = 'Smoking status'
+
+# ranges of the efficiency slider of interest (whole steps, half steps, a single value, an empty range, reversed bounds)
+RANGES = [[50, 100], [60, 90], [75.5, 85], [72, 72], [99.5, 100], [90, 60]]
+
+# statistics of the density contour plot of interest (binary, few distinct values, many distinct values, the same one)
+CONTOUR_STATS = [('Gender', 'Age'), ('Awakenings', 'Light sleep percentage'), (SMOKING_COL, 'Bedtime'),
+                 ('Age', 'Age')]
+
+# runs a clientside function of assets/clientside.js on each case read from stdin, writing the results to stdout
+NODE_RUNNER = r'''
+const vm = require('vm'), fs = require('fs');
+const context = {window: {dash_clientside: {no_update: null}}, atob: atob};
+vm.createContext(context);
+vm.runInContext(fs.readFileSync(process.argv[1], 'utf8'), context);
+const functions = context.window.dash_clientside.sleep;
+const cases = JSON.parse(fs.readFileSync(0, 'utf8'));
+process.stdout.write(JSON.stringify(cases.map(c => functions[c.function](c.store, c.range))));
+'''
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None, reason='node is needed to run assets/clientside.js')
+
+
+def to_json(value):
+    """ Serializes a callback response the way Dash sends it to the browser
+    Args:
+        value: the response (e.g. a figure)
+    Returns:
+        the response as plain JSON-compatible objects (numeric arrays encoded in base64 by plotly)
+    """
+    return json.loads(json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def decode(values):
+    """ Turns the values of a trace attribute into a plain list (decoding it if plotly encoded it in base64)
+    Args:
+        values: the values of the attribute
+    Returns:
+        values (list): the values
+    """
+    if isinstance(values, dict) and 'bdata' in values:
+        array = np.frombuffer(base64.b64decode(values['bdata']), dtype=values['dtype'])
+        if 'shape' in values:
+            array = array.reshape([int(size) for size in str(values['shape']).split(',')])
+        return array.tolist()
+
+    return list(values)
+
+
+def run_clientside(function, cases):
+    """ Runs a clientside function of assets/clientside.js through node
+    Args:
+        function (str): name of the function in window.dash_clientside.sleep
+        cases (list of tuples): the store data and slider range passed to each call
+    Returns:
+        results (list): the response of each call
+    """
+    payload = json.dumps([{'function': function, 'store': store, 'range': rng} for store, rng in cases])
+    completed = subprocess.run(['node', '-e', NODE_RUNNER, os.path.join(ROOT, 'assets', 'clientside.js')],
+                               input=payload, capture_output=True, text=True, check=True)
+
+    return json.loads(completed.stdout)
+
+
+def test_strip_keeps_the_rows_of_filt_vals():
+    store = to_json(sleep.show_sleep_strip(sleep.EFFICIENCY_SLIDER_RANGE))
+    results = run_clientside('filter_strip', [(store, rng) for rng in RANGES])
+
+    df_sleep = datastore.efficiency()
+    for rng, figure in zip(RANGES, results):
+        rows = utils.filt_vals(df_sleep, rng, SLEEP_EFFICIENCY_COL, [SMOKING_COL, SLEEP_EFFICIENCY_COL],
+                               datastore.range_index())
+        points = {trace['name']: trace for trace in figure['data'] if not trace.get('meta')}
+        means = {trace['meta']['mean_of']: trace for trace in figure['data'] if trace.get('meta')}
+
+        for status in df_sleep[SMOKING_COL].unique():
+            expected = rows.loc[rows[SMOKING_COL] == status, SLEEP_EFFICIENCY_COL].tolist()
+            assert decode(points[status]['x']) == expected, (rng, status)
+
+            # the mean marks are computed again from the points kept
+            if expected:
+                assert means[status]['x'] == pytest.approx([np.mean(expected)])
+                assert means[status]['customdata'][0][0] == len(expected)
+            else:
+                assert means[status]['x'] == []
+
+        # the server's own figure for the range shows the same points
+        server = to_json(sleep.show_sleep_strip(rng))
+        server_points = {trace['name']: decode(trace['x']) for trace in server['data'] if not trace.get('meta')}
+        for status, values in server_points.items():
+            assert decode(points[status]['x']) == values, (rng, status)
+
+
+@pytest.mark.parametrize('sleep_stat1, sleep_stat2', CONTOUR_STATS)
+def test_contour_averages_the_rows_of_filt_vals(sleep_stat1, sleep_stat2):
+    store = to_json(sleep.contour_figure_data(sleep_stat1, sleep_stat2)[0])
+    results = run_clientside('filter_contour', [(store, rng) for rng in RANGES])
+
+    for rng, figure in zip(RANGES, results):
+        # the server averages the cells over the rows utils.filt_vals keeps (see show_efficiency_contour)
+        server = to_json(sleep.show_efficiency_contour(sleep_stat1, sleep_stat2, rng)[0])
+        expected = np.array(decode(server['data'][0]['z']), dtype=float)
+        actual = np.array(figure['data'][0]['z'], dtype=float)
+
+        assert actual.shape == expected.shape
+        np.testing.assert_allclose(actual, expected, rtol=1e-12, equal_nan=True, err_msg=str(rng))
+        assert decode(figure['data'][0]['x']) == decode(server['data'][0]['x'])
+        assert decode(figure['data'][0]['y']) == decode(server['data'][0]['y'])
@@ -7,9 +7,98 @@ April 19, 2023
 utils.py: Helper functions for sleep.py
 """
 # import statements
+import hashlib
+import json
+import os
+import re
+import shutil
 import pandas as pd
 import numpy as np
 import random_forest_assets as rf
+import column_store
+from cache import LRUCache
+
+# recent sleep quality predictions, keyed by the regressor's version and the normalized user inputs (the number of
+# predictions kept can be configured through the SLEEP_PREDICTION_CACHE_SIZE environment variable)
+PREDICTION_CACHE = LRUCache(maxsize=int(os.environ.get('SLEEP_PREDICTION_CACHE_SIZE', 4096)))
+
+# samples of rows drawn by the scatter plots of large data sets, keyed by the data's version, the plot, its variables
+# and its point budget
+SAMPLE_CACHE = LRUCache(maxsize=256)
+
+# clearer names given to some columns of the sleep data when it is read in
+RENAMED_COLS = {'Exercise frequency': 'Exercise frequency (in days per week)',
+                'Caffeine consumption': 'Caffeine consumption 24 hrs before sleeping (mg)',
+                'Alcohol consumption': 'Alcohol consumption 24 hrs before sleeping (oz)'}
+
+# columns holding the original timestamps of the bedtime and wakeup time columns once they are parsed
+TIMESTAMP_COLS = {'Bedtime': 'Bedtime timestamp', 'Wakeup time': 'Wakeup timestamp'}
+
+# integer-coded (0/1) columns added next to the binary categorical columns of the sleep data by encode_frame
+ENCODED_COLS = {'Gender': 'Gender_Male', 'Smoking status': 'Smoking status_Yes'}
+
+# x features of the random forest regressors, in the order expected by the regressors (see build_features)
+FEATURE_COLS = ['Age', 'Bedtime', 'Wakeup time', 'Sleep duration', 'Awakenings',
+                'Caffeine consumption 24 hrs before sleeping (mg)', 'Alcohol consumption 24 hrs before sleeping (oz)',
+                'Exercise frequency (in days per week)', 'Gender_Male', 'Smoking status_Yes']
+
+# dimensions of the sleep hygiene radar chart (caffeine consumption is shown on a log scale, see hygiene_values)
+HYGIENE_COLS = ['Awakenings', 'Caffeine consumption 24 hrs before sleeping (mg)',
+                'Alcohol consumption 24 hrs before sleeping (oz)', 'Exercise frequency (in days per week)']
+
+# numeric columns whose range filters are answered by the range index (see range_index)
+RANGE_INDEX_COLS = ['Sleep efficiency']
+
+# categorical columns whose values get a precomputed mask of their rows in the range index
+PARTITION_COLS = ['Gender', 'Smoking status']
+
+# number of bins along each axis of the grids of binned averages (e.g. the density contour plot)
+GRID_BINS = 25
+
+# number of points at which the kernel density curves of the violin plots are evaluated
+KDE_POINTS = 100
+
+# largest number of bins of the histograms of the sleep statistics
+HISTOGRAM_BINS = 30
+
+# number of nanoseconds in a day, an hour and a minute
+NS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+NS_PER_HOUR = 60 * 60 * 10 ** 9
+NS_PER_MINUTE = 60 * 10 ** 9
+
+# directory holding the column stores of the cleaned sleep data, so that later processes memory-map the cleaned data
+# instead of parsing the CSV file again (it can be configured through the SLEEP_CACHE_DIR environment variable)
+CACHE_DIR = os.environ.get('SLEEP_CACHE_DIR', 'cache')
+
+# number of rows of the CSV file read at once when its cleaned data frame gets cached (it can be configured through the
+# SLEEP_INGEST_CHUNKSIZE environment variable)
+INGEST_CHUNKSIZE = int(os.environ.get('SLEEP_INGEST_CHUNKSIZE', 100000))
+
+# version of the cleaning done by read_file and parse_times, part of the key of the cached data frames (bump it whenever
+# the cleaning changes so that data frames cleaned the old way are not reused)
+CLEANING_VERSION = 2
+
+# granularity of the bedtime and wakeup time sliders of the sleep quality predictor (in hours)
+TIME_STEP = 0.25
+
+
+def clean_frame(df_sleep):
+    """ Does the basic cleaning of the sleep data (on the whole file or on one chunk of it)
+    Args:
+        df_sleep (Pandas data frame): raw rows of the sleep data
+    Returns:
+        file_copy (Pandas data frame): cleaned version of the rows
+    """
+    # drop rows with NA values
+    file_copy = df_sleep.dropna()
+
+    # multiply sleep efficiencies by 100 to represent them as percentages
+    file_copy.loc[:, 'Sleep efficiency'] = file_copy['Sleep efficiency'] * 100
+
+    # renaming columns to clarify metrics
+    file_copy = file_copy.rename(columns=RENAMED_COLS)
+
+    return file_copy
 
 
 def read_file(filename):
@@ -19,56 +108,290 @@ def read_file(filename):
     Returns:
         file_copy (Pandas data frame): cleaned dataframe containing the file's data
     """
-    # read the CSV files into dataframes
-    file = pd.read_csv(filename)
+    # read the CSV files into dataframes and clean them (dropna already returns a new data frame, so the raw data does
+    # not need to be copied first)
+    return clean_frame(pd.read_csv(filename))
 
-    # make a copy of the file
-    file_copy = file.copy()
 
-    # drop rows with NA values
-    file_copy = file_copy.dropna()
+def ingest_file(filename, store_dir, chunksize=INGEST_CHUNKSIZE, extra_meta=None, progress=None):
+    """ Reads in a file one chunk of rows at a time, cleans each chunk like read_file and parse_times and appends it to
+        a column store, so that memory use is bounded by the size of a chunk rather than the size of the file
+    Args:
+        filename (str): name of file of interest
+        store_dir (str): directory of the column store the cleaned rows are written to
+        chunksize (int): number of rows read at once
+        extra_meta (dict): additional information saved along with the description of the store
+        progress (function): called after each chunk with the running counts (see Returns)
+    Returns:
+        counts (dict): number of rows read, kept and dropped (because of NA values)
+    """
+    counts = {'rows_read': 0, 'rows_kept': 0, 'rows_dropped': 0}
+    writer = column_store.ColumnStoreWriter(store_dir)
 
-    # multiply sleep efficiencies by 100 to represent them as percentages
-    file_copy.loc[:, 'Sleep efficiency'] = file_copy['Sleep efficiency'] * 100
+    for chunk in pd.read_csv(filename, chunksize=chunksize):
+        cleaned = parse_times(clean_frame(chunk))
+        writer.append(cleaned)
 
-    # renaming columns to clarify metrics
-    file_copy = file_copy.rename(columns={'Exercise frequency': 'Exercise frequency (in days per week)'})
-    file_copy = file_copy.rename(columns={'Caffeine consumption': 'Caffeine consumption 24 hrs before sleeping (mg)'})
-    file_copy = file_copy.rename(columns={'Alcohol consumption': 'Alcohol consumption 24 hrs before sleeping (oz)'})
+        counts['rows_read'] += len(chunk)
+        counts['rows_kept'] += len(cleaned)
+        counts['rows_dropped'] += len(chunk) - len(cleaned)
+        if progress is not None:
+            progress(dict(counts))
 
-    return file_copy
+    writer.close(dict(extra_meta or {}, **counts))
+
+    return counts
+
+
+def _decimal_hours(timestamps):
+    """ Converts timestamps to hours into the day (military time), keeping only their hour and minute
+    Args:
+        timestamps (pd.Series): datetime column of interest
+    Returns:
+        hours (np.array): hours into the day of each timestamp (NaN for missing timestamps)
+    """
+    # nanoseconds since midnight, using integer arithmetic so that no precision is lost
+    nanoseconds = timestamps.to_numpy(dtype='datetime64[ns]')
+    missing = np.isnat(nanoseconds)
+    of_day = nanoseconds.view(np.int64) % NS_PER_DAY
+
+    # combine the whole hours and minutes exactly like "HH" and "MM" parsed as floats would be
+    hours = (of_day // NS_PER_HOUR).astype(float) + (of_day // NS_PER_MINUTE % 60).astype(float) / 60
+    hours[missing] = np.nan
+
+    return hours
 
 
 def parse_times(df_sleep):
     """ Parses the bedtime and wakeup time columns in the sleep data frame so they contain decimals that represent times
+        (the original timestamps are kept in the columns listed in TIMESTAMP_COLS)
     Args:
         df_sleep (Pandas data frame): a data frame containing sleep statistics for test subjects
     Returns:
         df_sleep (Pandas data frame): a newer version of the data frame with the parsed times
     """
-    # parse the bedtime columns to only include hours into the day (military time)
-    df_sleep['Bedtime'] = df_sleep['Bedtime'].astype(str)
-    df_sleep['Bedtime'] = df_sleep['Bedtime'].str.split().str[1]
-    df_sleep['Bedtime'] = df_sleep['Bedtime'].str[:2].astype(float) + df_sleep['Bedtime'].str[3:5].astype(float) / 60
+    for col, timestamp_col in TIMESTAMP_COLS.items():
+        # parse the column straight into datetimes and keep them for later use
+        df_sleep[timestamp_col] = pd.to_datetime(df_sleep[col], format='ISO8601')
+
+        # only include hours into the day (military time)
+        df_sleep[col] = _decimal_hours(df_sleep[timestamp_col])
 
-    # parse the wakeup time columns to only include hours into the day (military time)
-    df_sleep['Wakeup time'] = df_sleep['Wakeup time'].astype(str)
-    df_sleep['Wakeup time'] = df_sleep['Wakeup time'].str.split().str[1]
-    df_sleep['Wakeup time'] = df_sleep['Wakeup time'].str[:2].astype(float) + \
-                              df_sleep['Wakeup time'].str[3:5].astype(float) / 60
     return df_sleep
 
 
-def filt_vals(df, vals, col, lcols):
+def content_hash(filename, block_size=2 ** 20):
+    """ Hashes the contents of a file, one block at a time so that large files do not need to fit in memory
+    Args:
+        filename (str): name of file of interest
+        block_size (int): number of bytes read at once
+    Returns:
+        digest (str): hexadecimal SHA-256 digest of the file's contents
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def _write_json(path, data):
+    """ Writes a JSON file atomically (readers either see the old contents or the new ones)
+    Args:
+        path (str): name of the JSON file
+        data (dict): contents of the file
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        json.dump(data, outfile)
+    os.replace(tmp_path, path)
+
+
+def read_clean_file(filename, cache_dir=CACHE_DIR, chunksize=INGEST_CHUNKSIZE):
+    """ Reads in a file and cleans it like read_file and parse_times, caching the cleaned data frame in a column store
+        so that later calls memory-map it instead of parsing the file again
+
+    The cached data frame is keyed by the file's path, size, modification time and content hash, and by
+    CLEANING_VERSION. A file whose size and modification time did not change is trusted without being read; otherwise
+    its contents are hashed, and only a file whose contents changed gets parsed again.
+
+    Args:
+        filename (str): name of file of interest
+        cache_dir (str): directory holding the column stores (None turns the cache off)
+        chunksize (int): number of rows read at once when the file gets parsed (see ingest_file)
+    Returns:
+        df_sleep (Pandas data frame): cleaned dataframe containing the file's data, with the times parsed
+    """
+    if cache_dir is None:
+        return parse_times(read_file(filename))
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # key the cache on the file's path, so that files with the same name in different directories keep their own cache
+    path_digest = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()[:8]
+    name = '{}-{}'.format(os.path.splitext(os.path.basename(filename))[0], path_digest)
+
+    # the fingerprint of the file the cached data frame was built from
+    fingerprint_path = os.path.join(cache_dir, name + '.json')
+    fingerprint = {}
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as infile:
+            fingerprint = json.load(infile)
+
+    # fast path: the file was not touched since the cached data frame was built
+    stat = os.stat(filename)
+    if fingerprint.get('size') == stat.st_size and fingerprint.get('mtime_ns') == stat.st_mtime_ns:
+        digest = fingerprint['sha256']
+    else:
+        digest = content_hash(filename)
+
+    store_dir = os.path.join(cache_dir, '{}-{}-v{}'.format(name, digest[:16], CLEANING_VERSION))
+    if column_store.read_meta(store_dir) is None:
+        # the contents changed (or were never cached): stream the file once into a fresh store, which only becomes
+        # visible once it is complete
+        tmp_dir = '{}.{}.tmp'.format(store_dir, os.getpid())
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        ingest_file(filename, tmp_dir, chunksize, extra_meta={'source': os.path.abspath(filename), 'sha256': digest})
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # another process finished the same store first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # remove the stores built from older contents of the file (and only of this file)
+        store_pattern = re.compile(re.escape(name) + r'-[0-9a-f]{16}-v\d+')
+        for entry in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, entry)
+            if store_pattern.fullmatch(entry) and path != store_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+    # remember the file's fingerprint so that the next call can skip hashing it
+    if fingerprint != {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}:
+        _write_json(fingerprint_path, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest})
+
+    return column_store.read_store(store_dir)
+
+
+def range_index(df_sleep, cols=RANGE_INDEX_COLS, partition_cols=PARTITION_COLS):
+    """ Builds an index answering range filters without scanning the rows: the positions of the rows sorted by each
+        column of interest, along with the sorted values, and a mask of the rows of each value of the partition columns
+    Args:
+        df_sleep (Pandas data frame): data frame of interest
+        cols (list of str): numeric columns of interest
+        partition_cols (list of str): categorical columns of interest
+    Returns:
+        index (dict): the number of 'rows', and the sorted 'positions' and 'values' of each column (rows missing the
+                      column are left out) and the row masks of each value of each partition column ('partitions')
+    """
+    index = {'rows': len(df_sleep), 'positions': {}, 'values': {}, 'partitions': {}}
+    for col in cols:
+        values = df_sleep[col].to_numpy(dtype=float)
+
+        # missing values are sorted last, and never lie within a range
+        positions = np.argsort(values, kind='stable')[:np.count_nonzero(~np.isnan(values))]
+        index['positions'][col] = positions
+        index['values'][col] = values[positions]
+
+    for col in partition_cols:
+        codes, uniques = pd.factorize(df_sleep[col])
+        index['partitions'][col] = {value: codes == code for code, value in enumerate(uniques)}
+
+    return index
+
+
+def range_positions(index, col, vals, partitions=None):
+    """ Finds the rows whose value of a column lies within a range (bounds included) with two binary searches
+    Args:
+        index (dict): range index of the data frame (see range_index)
+        col (str): the column to filter by
+        vals (list of floats): the min and max of the range
+        partitions (dict): maps partition columns to the values whose rows are kept (e.g. {'Gender': ['Female']}), all
+                           rows are kept if None
+    Returns:
+        positions (np.array): positions of the rows, in increasing order of the column
+    """
+    values = index['values'][col]
+    start = np.searchsorted(values, vals[0], side='left')
+    stop = np.searchsorted(values, vals[1], side='right')
+    positions = index['positions'][col][start:stop]
+
+    # only keep the rows of the partitions of interest, looking up the masks at the positions within the range only
+    for partition_col, partition_values in (partitions or {}).items():
+        masks = index['partitions'][partition_col]
+        keep = np.zeros(len(positions), dtype=bool)
+        for value in partition_values:
+            if value in masks:
+                keep |= masks[value][positions]
+        positions = positions[keep]
+
+    return positions
+
+
+def range_count(index, col, vals, partitions=None):
+    """ Counts the rows whose value of a column lies within a range (bounds included) without selecting them
+    Args:
+        index (dict): range index of the data frame (see range_index)
+        col (str): the column to filter by
+        vals (list of floats): the min and max of the range
+        partitions (dict): maps partition columns to the values whose rows are counted (see range_positions)
+    Returns:
+        count (int): number of rows
+    """
+    if partitions:
+        return len(range_positions(index, col, vals, partitions))
+
+    # an empty range (min above max) holds no rows
+    values = index['values'][col]
+
+    return max(int(np.searchsorted(values, vals[1], side='right') - np.searchsorted(values, vals[0], side='left')), 0)
+
+
+def extend_range_index(index, df_new):
+    """ Adds rows appended to a data frame to its range index, merging them into the sorted positions instead of sorting
+        every row again (the result is the same as range_index on the whole data frame)
+    Args:
+        index (dict): range index of the data frame before the rows were appended (see range_index)
+        df_new (Pandas data frame): rows appended to the data frame
+    Returns:
+        index (dict): range index of the whole data frame
+    """
+    offset = index['rows']
+    new = range_index(df_new, list(index['positions']), list(index['partitions']))
+
+    extended = {'rows': offset + new['rows'], 'positions': {}, 'values': {}, 'partitions': {}}
+    for col, values in index['values'].items():
+        # the appended rows come after the rows holding the same value, like a stable sort of every row would put them
+        at = np.searchsorted(values, new['values'][col], side='right')
+        extended['positions'][col] = np.insert(index['positions'][col], at, new['positions'][col] + offset)
+        extended['values'][col] = np.insert(values, at, new['values'][col])
+
+    for col, masks in index['partitions'].items():
+        new_masks = new['partitions'][col]
+        extended['partitions'][col] = {
+            value: np.concatenate([masks.get(value, np.zeros(offset, dtype=bool)),
+                                   new_masks.get(value, np.zeros(new['rows'], dtype=bool))])
+            for value in list(masks) + [value for value in new_masks if value not in masks]}
+
+    return extended
+
+
+def filt_vals(df, vals, col, lcols, index=None):
     """ Filter a dataframe by user-selected values
     Args:
         df: (Pandas dataframe) a dataframe with the values we are seeking and additional attributes
         vals (list of floats): two user-defined values, a min and max for "col"
         col (str): the column to filter by
         lcols (list of str): a list of column names to return
+        index (dict): range index of the dataframe (see range_index), used instead of scanning "col" if it covers it
     Returns:
         df_updated (dataframe): the dataframe filtered, with just the values for "col" within the user specified range
     """
+    # look the range up in the index, keeping the rows in their original order and only copying the columns returned
+    if index is not None and col in index['positions']:
+        positions = np.sort(range_positions(index, col, vals))
+        return df.iloc[positions, df.columns.get_indexer(lcols)]
+
     # identify the beginning and end of the user-specified range for "col"
     least = vals[0]
     most = vals[1]
@@ -80,58 +403,540 @@ def filt_vals(df, vals, col, lcols):
     return df_updated
 
 
+def encode_frame(df_sleep):
+    """ Adds integer-coded versions of the binary categorical columns to the sleep data frame (keeping the original
+        columns), so that the data frame can be used by the regressors and plots without being encoded again
+    Args:
+        df_sleep (Pandas data frame): a data frame containing sleep statistics for test subjects
+    Returns:
+        df_sleep (Pandas data frame): a newer version of the data frame with the columns in ENCODED_COLS
+    """
+    gender_value, smoke_value = convert(df_sleep['Gender'].values, df_sleep['Smoking status'].values)
+
+    return df_sleep.assign(**{ENCODED_COLS['Gender']: gender_value, ENCODED_COLS['Smoking status']: smoke_value})
+
+
+def clean_rows(df_raw):
+    """ Cleans raw rows of the sleep data exactly like read_sleep_data cleans the rows of the file (e.g. rows appended
+        to the sleep data after it was read in)
+    Args:
+        df_raw (Pandas data frame): raw rows, with the columns and formats of the CSV file
+    Returns:
+        df_sleep (Pandas data frame): the cleaned rows, with the times parsed and the binary categorical columns encoded
+    """
+    return encode_frame(parse_times(clean_frame(df_raw)))
+
+
+def read_sleep_data(filename, cache_dir=CACHE_DIR):
+    """ Reads in the sleep data the way the dashboard uses it: cleaned (and cached, see read_clean_file), with the times
+        parsed and the binary categorical columns encoded
+    Args:
+        filename (str): name of file of interest
+        cache_dir (str): directory holding the column stores (None turns the cache off)
+    Returns:
+        df_sleep (Pandas data frame): the encoded sleep data
+    """
+    return encode_frame(read_clean_file(filename, cache_dir))
+
+
+def grid_edges(values, bins=GRID_BINS):
+    """ Splits the range of a variable into the bins of a grid: one bin centered on each value if the variable takes
+        few distinct values (e.g. awakenings or an encoded gender), equal-width bins otherwise
+    Args:
+        values (np.array): values of the variable
+        bins (int): largest number of bins
+    Returns:
+        edges (np.array): edges of the bins, in increasing order
+    """
+    uniques = np.unique(values[np.isfinite(values)])
+
+    # a variable without values (or with a single one) still gets one bin
+    if len(uniques) <= 1:
+        center = uniques[0] if len(uniques) else 0.0
+        return np.array([center - 0.5, center + 0.5])
+
+    if len(uniques) > bins:
+        return np.histogram_bin_edges(uniques, bins=bins, range=(uniques[0], uniques[-1]))
+
+    # put the edges halfway between consecutive values
+    midpoints = (uniques[1:] + uniques[:-1]) / 2
+    edges = np.concatenate([[uniques[0] - (midpoints[0] - uniques[0])], midpoints,
+                            [uniques[-1] + (uniques[-1] - midpoints[-1])]])
+
+    return edges
+
+
+def binned_sums(x, y, z, x_edges, y_edges):
+    """ Counts the rows falling in each cell of a grid and sums a variable over them
+    Args:
+        x (np.array): values of the variable along the x-axis of the grid
+        y (np.array): values of the variable along the y-axis of the grid
+        z (np.array): values of the variable summed in each cell
+        x_edges (np.array): edges of the bins along the x-axis
+        y_edges (np.array): edges of the bins along the y-axis
+    Returns:
+        counts (np.array): number of rows in each cell, indexed by y bin then x bin
+        sums (np.array): sum of z over the rows in each cell, indexed by y bin then x bin
+    """
+    counts = np.histogram2d(x, y, bins=[x_edges, y_edges])[0].T
+    sums = np.histogram2d(x, y, bins=[x_edges, y_edges], weights=z)[0].T
+
+    return counts, sums
+
+
+def grid_means(counts, sums):
+    """ Averages the summed variable over the rows in each cell of a grid
+    Args:
+        counts (np.array): number of rows in each cell
+        sums (np.array): sum of the variable over the rows in each cell
+    Returns:
+        means (np.array): average of the variable in each cell (NaN for empty cells)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+
+    return means
+
+
+def kernel_density(values, points=KDE_POINTS):
+    """ Estimates the density of a variable the way plotly's violin plots do (a gaussian kernel with Silverman's
+        bandwidth, evaluated from two bandwidths below the smallest value to two above the largest). The values are
+        first spread over the points of evaluation (linear binning), so the cost grows with the number of values plus
+        the square of the number of points instead of their product
+    Args:
+        values (np.array): values of the variable (without missing values)
+        points (int): number of points at which the density is evaluated
+    Returns:
+        grid (np.array): the points of evaluation, in increasing order
+        density (np.array): the estimated density at each point
+    """
+    lo, hi = values.min(), values.max()
+    if lo == hi:
+        return np.array([lo]), np.array([1.0])
+
+    q1, q3 = np.percentile(values, [25, 75])
+    spread = min(values.std(ddof=1), (q3 - q1) / 1.349)
+    bandwidth = max(1.059 * spread * len(values) ** -0.2, (hi - lo) / 100)
+    grid = np.linspace(lo - 2 * bandwidth, hi + 2 * bandwidth, points)
+
+    # share each value between the two points of evaluation around it, in proportion to how close it is to each
+    positions = (values - grid[0]) / (grid[1] - grid[0])
+    left = np.floor(positions).astype(np.int64)
+    right_share = positions - left
+    weights = (np.bincount(left, weights=1 - right_share, minlength=points + 1) +
+               np.bincount(left + 1, weights=right_share, minlength=points + 1))[:points]
+
+    kernel = np.exp(-0.5 * ((grid[:, None] - grid[None, :]) / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+
+    return grid, kernel @ weights / len(values)
+
+
+def distribution_summary(values, edges):
+    """ Summarizes the distribution of a variable with a fixed number of numbers, enough to draw its violin plot and
+        histogram whatever the number of values
+    Args:
+        values (np.array): values of the variable
+        edges (np.array): edges of the bins of the histogram
+    Returns:
+        summary (dict): the number of values ('n'), their quartiles ('q1', 'median', 'q3'), the most extreme
+                        values within 1.5 interquartile ranges of the box ('lowerfence' and 'upperfence'), their kernel
+                        density curve ('kde_x' and 'kde_y') and the number of values in each bin of the histogram
+                        ('counts'), or None if the variable has no values
+    """
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    kde_x, kde_y = kernel_density(values)
+
+    return {'n': len(values), 'q1': q1, 'median': median, 'q3': q3,
+            'lowerfence': values[values >= q1 - 1.5 * iqr].min(), 'upperfence': values[values <= q3 + 1.5 * iqr].max(),
+            'kde_x': kde_x, 'kde_y': kde_y, 'counts': np.histogram(values, bins=edges)[0]}
+
+
+def distribution_summaries(df_sleep, group_col, cols=None, bins=HISTOGRAM_BINS):
+    """ Summarizes the distribution of every numeric column within each group of rows (see distribution_summary)
+    Args:
+        df_sleep (Pandas data frame): data frame of interest
+        group_col (str): column whose values split the rows into groups (e.g. the gender)
+        cols (list of str): columns of interest (defaults to every numeric column)
+        bins (int): largest number of bins of the histograms
+    Returns:
+        summaries (dict): maps each column to the 'edges' of its histogram's bins (shared by the groups) and the
+                          summary of each group ('groups', in order of first appearance in the data)
+    """
+    if cols is None:
+        cols = list(df_sleep.select_dtypes(include='number').columns)
+
+    codes, groups = pd.factorize(df_sleep[group_col])
+
+    summaries = {}
+    for col in cols:
+        values = df_sleep[col].to_numpy(dtype=float)
+        edges = grid_edges(values, bins)
+        summaries[col] = {'edges': edges,
+                          'groups': {group: distribution_summary(values[codes == code], edges)
+                                     for code, group in enumerate(groups)}}
+
+    return summaries
+
+
+def half_steps(values):
+    """ Maps values to half steps, so that a value lies within the range [lo, hi] of whole numbers exactly when its half
+        step lies within [2 * lo, 2 * hi] (whole values map to even half steps, the others to the odd half step between
+        the whole numbers around them)
+    Args:
+        values (np.array): values of interest
+    Returns:
+        steps (np.array): half step of each value
+    """
+    floors = np.floor(values)
+
+    return (2 * floors + (values != floors)).astype(np.int64)
+
+
+def stratified_sample(strata, budget, seed=0):
+    """ Draws a random sample of rows in which each stratum keeps its share of the rows
+    Args:
+        strata (np.array): stratum of each row (e.g. the gender of each user)
+        budget (int): number of rows drawn (all rows are kept if there are not more than that)
+        seed (int): seed of the random number generator, so that the same rows are drawn every time
+    Returns:
+        positions (np.array): positions of the rows drawn, in increasing order
+    """
+    if len(strata) <= budget:
+        return np.arange(len(strata))
+
+    codes = pd.factorize(strata, use_na_sentinel=False)[0]
+    sizes = np.bincount(codes)
+
+    # give each stratum its share of the budget, handing the rows left over to the largest remainders
+    shares = sizes * budget / len(strata)
+    quotas = np.floor(shares).astype(int)
+    quotas[np.argsort(quotas - shares)[:budget - quotas.sum()]] += 1
+
+    rng = np.random.default_rng(seed)
+    positions = np.concatenate([rng.choice(np.flatnonzero(codes == stratum), quota, replace=False)
+                                for stratum, quota in enumerate(quotas)])
+
+    return np.sort(positions)
+
+
+def sample_rows(df_sleep, cols, budget, strata_col=None, name=None):
+    """ Picks the rows a plot of a large data frame draws: a stratified sample of the rows that have a value for every
+        plotted column (drawn once per plot and combination of columns, then served from SAMPLE_CACHE)
+    Args:
+        df_sleep (Pandas data frame): data frame of interest
+        cols (list of str): columns drawn by the plot
+        budget (int): number of rows the plot draws at most
+        strata_col (str): column whose values each keep their share of the sample (None for a plain random sample)
+        name (str): name of the plot
+    Returns:
+        positions (np.array): positions of the rows drawn, in increasing order
+        total (int): number of rows that could have been drawn
+    """
+    key = (rf.dataset_hash(df_sleep), name, tuple(cols), strata_col, budget)
+    sample = SAMPLE_CACHE.get(key)
+    if sample is None:
+        valid = np.flatnonzero(df_sleep[list(dict.fromkeys(cols))].notna().all(axis=1).values)
+        strata = df_sleep[strata_col].values[valid] if strata_col is not None else np.zeros(len(valid), dtype=int)
+        sample = (valid[stratified_sample(strata, budget)], len(valid))
+        SAMPLE_CACHE.put(key, sample)
+
+    return sample
+
+
+def regression_table(df_sleep, cols=None):
+    """ Summarizes every pair of numeric columns in one pass, so that the least squares line between any two of them can
+        be computed without going over the rows again (see trend_line)
+    Args:
+        df_sleep (Pandas data frame): data frame of interest
+        cols (list of str): columns of interest (defaults to every numeric column)
+    Returns:
+        table (dict): the columns, the number of rows with a value in every column ('n'), the mean, minimum and maximum
+                      of each column, and the co-moment matrix (the sums of the products of the deviations from the
+                      means) of the columns
+    """
+    if cols is None:
+        cols = list(df_sleep.select_dtypes(include='number').columns)
+
+    # only rows with a value for every column are summarized
+    values = df_sleep[cols].dropna().values.astype(float)
+    means = values.mean(axis=0) if len(values) else np.full(len(cols), np.nan)
+    deviations = values - means
+
+    table = {'cols': cols, 'n': len(values), 'mean': means, 'comoment': deviations.T @ deviations,
+             'min': values.min(axis=0) if len(values) else means, 'max': values.max(axis=0) if len(values) else means}
+
+    return table
+
+
+def merge_regression_tables(table, other):
+    """ Combines the regression tables of two sets of rows into the table of all of them, without going over the rows
+        again (pairwise update of the means and co-moments, as in Chan et al.)
+    Args:
+        table (dict): regression table of the first rows (see regression_table)
+        other (dict): regression table of the other rows, over the same columns
+    Returns:
+        table (dict): regression table of every row
+    """
+    if not other['n']:
+        return table
+    if not table['n']:
+        return other
+
+    n = table['n'] + other['n']
+    delta = other['mean'] - table['mean']
+
+    return {'cols': table['cols'], 'n': n, 'mean': table['mean'] + delta * other['n'] / n,
+            'comoment': table['comoment'] + other['comoment'] + np.outer(delta, delta) * table['n'] * other['n'] / n,
+            'min': np.minimum(table['min'], other['min']), 'max': np.maximum(table['max'], other['max'])}
+
+
+def mean_shift(table, other):
+    """ Measures how far the rows of one regression table drifted from the rows of another: the largest difference
+        between the means of a column, in standard deviations of the column within the first rows
+    Args:
+        table (dict): regression table of the reference rows (see regression_table)
+        other (dict): regression table of the rows of interest, over the same columns
+    Returns:
+        shift (float): the largest standardized difference of means (0 if either table has too few rows)
+    """
+    if table['n'] < 2 or not other['n']:
+        return 0.0
+
+    sds = np.sqrt(np.diag(table['comoment']) / (table['n'] - 1))
+    varying = sds > 0
+    if not varying.any():
+        return 0.0
+
+    return float(np.max(np.abs(other['mean'] - table['mean'])[varying] / sds[varying]))
+
+
+def trend_line(table, x_col, y_col):
+    """ Fits the least squares line of one column against another from their regression table
+    Args:
+        table (dict): regression table of the columns (see regression_table)
+        x_col (str): the independent variable
+        y_col (str): the dependent variable
+    Returns:
+        line (dict): the 'slope', 'intercept' and 'r2' of the line, and the two points ('x' and 'y') at the ends of the
+                     range of the independent variable (None if the independent variable does not vary)
+    """
+    i = table['cols'].index(x_col)
+    j = table['cols'].index(y_col)
+    sxx, sxy, syy = table['comoment'][i, i], table['comoment'][i, j], table['comoment'][j, j]
+    if table['n'] < 2 or sxx <= 0:
+        return None
+
+    slope = sxy / sxx
+    intercept = table['mean'][j] - slope * table['mean'][i]
+    r2 = sxy ** 2 / (sxx * syy) if syy > 0 else 1.0
+    x = np.array([table['min'][i], table['max'][i]])
+
+    return {'slope': slope, 'intercept': intercept, 'r2': r2, 'x': x, 'y': intercept + slope * x}
+
+
+def hygiene_values(awakenings, caffeine, alcohol, exercise):
+    """ Puts sleep hygiene habits on the scale of the radar chart (the log of one plus the caffeine consumption, so that
+        it fits next to the other dimensions)
+    Args:
+        awakenings (int or np.array): how many times the person wakes up during sleep
+        caffeine (int or np.array): the amount of caffeine taken in the 24 hrs prior to bedtime (in mg)
+        alcohol (int or np.array): the amount of alcohol drunk in the 24 hrs prior to bedtime (in oz)
+        exercise (int or np.array): the number of times the person exercises per week (days)
+    Returns:
+        values (list): the habits in the order of HYGIENE_COLS
+    """
+    return [awakenings, np.log(caffeine + 1), alcohol, exercise]
+
+
+def hygiene_index(df_sleep):
+    """ Summarizes the sleep hygiene of the population once: the average of each dimension of the radar chart and its
+        values in sorted order, so that a person's percentile can be looked up by binary search (see
+        hygiene_percentiles)
+    Args:
+        df_sleep (Pandas data frame): data frame of interest
+    Returns:
+        index (dict): the 'mean' of each dimension and its 'sorted' values, in the order of HYGIENE_COLS
+    """
+    columns = hygiene_values(*(df_sleep[col].to_numpy(dtype=float) for col in HYGIENE_COLS))
+
+    return {'mean': [float(np.nanmean(values)) if len(values) else np.nan for values in columns],
+            'sorted': [np.sort(values[~np.isnan(values)]) for values in columns]}
+
+
+def extend_hygiene_index(index, df_new):
+    """ Adds new rows to a hygiene index, updating the averages from the number of values behind them and merging the
+        new values into the sorted ones instead of sorting every value again
+    Args:
+        index (dict): hygiene index of the rows seen so far (see hygiene_index)
+        df_new (Pandas data frame): new rows
+    Returns:
+        index (dict): hygiene index of every row
+    """
+    new = hygiene_index(df_new)
+
+    means = []
+    for mean, new_mean, values, new_values in zip(index['mean'], new['mean'], index['sorted'], new['sorted']):
+        total = len(values) + len(new_values)
+        means.append((np.nan_to_num(mean) * len(values) + np.nan_to_num(new_mean) * len(new_values)) / total
+                     if total else np.nan)
+
+    return {'mean': means, 'sorted': [np.insert(values, np.searchsorted(values, new_values), new_values)
+                                      for values, new_values in zip(index['sorted'], new['sorted'])]}
+
+
+def hygiene_percentiles(index, values):
+    """ Finds where a person's sleep hygiene sits within the population
+    Args:
+        index (dict): hygiene index of the population (see hygiene_index)
+        values (list): the person's habits, on the scale of the radar chart (see hygiene_values)
+    Returns:
+        percentiles (list): percentage of the population below each habit, counting ties as half below (None for a
+                            dimension without values)
+    """
+    percentiles = []
+    for population, value in zip(index['sorted'], values):
+        if not len(population):
+            percentiles.append(None)
+            continue
+
+        below = np.searchsorted(population, value, side='left')
+        below_or_tied = np.searchsorted(population, value, side='right')
+        percentiles.append(100 * (below + below_or_tied) / (2 * len(population)))
+
+    return percentiles
+
+
 def get_x_feat(df_sleep):
     """ Get desired x-features as a list - remove all other irrelevant; encode categorical variables and return new df
     Args:
-        df_sleep (Pandas data frame): a data frame containing sleep statistics for test subjects
+        df_sleep (Pandas data frame): a data frame containing sleep statistics for test subjects (data frames that were
+                                      already encoded by encode_frame are used as is)
     Returns:
         df_sleep (pd.Dataframe): dataframe with categorical data encoded
         x_feat_list (list of str): list of desired x-variables
     """
-    # Establish the features not used by the random forest regressor
-    unwanted_feats = ['ID', 'Sleep efficiency', 'REM sleep percentage', 'Deep sleep percentage',
-                      'Light sleep percentage']
-
-    # we can represent binary categorical variables in single indicator tags via one-hot encoding
-    df_sleep = pd.get_dummies(data=df_sleep, columns=['Gender', 'Smoking status'], drop_first=True)
+    # we can represent binary categorical variables in single indicator tags
+    if not set(ENCODED_COLS.values()).issubset(df_sleep.columns):
+        df_sleep = encode_frame(df_sleep)
 
     # the x features for the regressor should be quantitative
-    x_feat_list = list(df_sleep.columns)
-    for feat in unwanted_feats:
-        x_feat_list.remove(feat)
+    x_feat_list = list(FEATURE_COLS)
 
     return df_sleep, x_feat_list
 
 
 def convert(gender, smoke):
     """ Encode passed-in variables to match the encoding of the random forest regressor
+
+    Whole columns of genders and smoking statuses (e.g. from a batch of users) can be passed in as well, in which case
+    arrays of encoded values are returned. Genders may be spelled like in the sleep predictor ('Biological Male') or
+    like in the data set ('Male')
+
     Args:
-        gender (str): indicates whether the user is a biological male or biological female
-        smoke (str): indicates whether the user smokes or not
+        gender (str or array of str): indicates whether the user is a biological male or biological female
+        smoke (str or array of str): indicates whether the user smokes or not
     Returns:
-        gender_value (int): encoded variable representing the biological gender of the user
-        smoke_value (int): encoded variable representing whether the user smokes
+        gender_value (int or np.array): encoded variable representing the biological gender of the user
+        smoke_value (int or np.array): encoded variable representing whether the user smokes
     """
     # encode the passed-in variable indicating a user's biological gender
-    if gender == 'Biological Male':
-        gender_value = 1
-    else:
-        gender_value = 0
+    gender_value = np.isin(gender, ['Biological Male', 'Male']).astype(int)
 
     # encode the passed-in variable indicating a user's smoking status
-    if smoke == 'Yes':
-        smoke_value = 1
-    else:
-        smoke_value = 0
+    smoke_value = np.isin(smoke, ['Yes']).astype(int)
+
+    # return plain integers when a single user was passed in
+    if gender_value.ndim == 0:
+        return int(gender_value), int(smoke_value)
 
     return gender_value, smoke_value
 
 
+def sleep_duration(bedtime, wakeuptime):
+    """ Calculates how long users sleep based on their bedtime and wakeup time (waking up "earlier" than the bedtime
+        means waking up the next day)
+    Args:
+        bedtime (float or np.array): bedtime(s) based on hours into the day (military time)
+        wakeuptime (float or np.array): wakeup time(s) based on hours into the day (military time)
+    Returns:
+        duration (float or np.array): sleep duration(s) in hours
+    """
+    duration = np.where(np.less(wakeuptime, bedtime), np.add(wakeuptime, 24) - bedtime,
+                        np.subtract(wakeuptime, bedtime))
+
+    # return a plain float when a single user was passed in
+    if duration.ndim == 0:
+        return float(duration)
+
+    return duration
+
+
+def build_features(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke):
+    """ Arranges information about one or many users into the x features expected by the random forest regressors
+    Args:
+        age (int or array): the age of the user(s)
+        bedtime (float or array): bedtime(s) based on hours into the day (military time)
+        wakeuptime (float or array): wakeup time(s) based on hours into the day (military time)
+        awakenings (int or array): number of awakenings on a given night
+        caffeine (int or array): amount of caffeine consumed in the 24 hours prior to bedtime (in mg)
+        alcohol (int or array): amount of alcohol consumed in the 24 hours prior to bedtime (in oz)
+        exercise (int or array): how many times the user(s) exercise in a week
+        gender (str or array of str): biological gender of the user(s)
+        smoke (str or array of str): whether the user(s) smoke
+    Returns:
+        data (np.array): one row of x features per user
+    """
+    # Encode the passed-in values for gender and smoking status to match the encoding of the random forest regressor
+    gender_value, smoke_value = convert(gender, smoke)
+
+    # calculate the sleep duration based on the bedtime and wakeup time
+    duration = sleep_duration(bedtime, wakeuptime)
+
+    # store the information into a numpy array with one row per user
+    data = np.column_stack([age, bedtime, wakeuptime, duration, awakenings, caffeine, alcohol, exercise,
+                            gender_value, smoke_value]).astype(float)
+
+    return data
+
+
+def normalize_inputs(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke):
+    """ Snaps the inputs of the sleep quality predictor to the steps of its sliders and dropdowns so that equivalent
+        queries (e.g. 23 and 23.0 for the bedtime) look exactly the same
+    Args:
+        age (int): the age of the user
+        bedtime (float): user's bedtime based on hours into the day (military time)
+        wakeuptime (float): user's wakeup time based on hours into the day (military time)
+        awakenings (int): number of awakenings a user has on a given night
+        caffeine (int): amount of caffeine a user consumes in the 24 hours prior to their bedtime (in mg)
+        alcohol (int): amount of alcohol a user consumes in the 24 hours prior to their bedtime (in oz)
+        exercise (int): how many times the user exercises in a week
+        gender (str): biological gender of the user
+        smoke (str): whether the user smokes
+    Returns:
+        inputs (tuple): the normalized inputs, in the same order as the arguments
+    """
+    # the age, awakenings, caffeine, alcohol and exercise inputs move in steps of 1
+    age, awakenings, caffeine, alcohol, exercise = [int(round(value)) for value in
+                                                    (age, awakenings, caffeine, alcohol, exercise)]
+
+    # the bedtime and wakeup time inputs move in steps of TIME_STEP hours
+    bedtime = round(bedtime / TIME_STEP) * TIME_STEP
+    wakeuptime = round(wakeuptime / TIME_STEP) * TIME_STEP
+
+    return age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, str(gender), str(smoke)
+
+
 def predict_sleep_quality(sleep_quality_stat, df_sleep, age, bedtime, wakeuptime, awakenings, caffeine, alcohol,
                           exercise, gender, smoke):
     """ Allow users to get their predicted sleep quality given information about them
     Args:
-        sleep_quality_stat (str): the sleep statistic to be predicted for the user
+        sleep_quality_stat (str or list of str): the sleep statistic(s) to be predicted for the user (passing a list
+                                                 predicts all of them at once with a multi-output regressor)
         df_sleep (Pandas df): data frame containing information about the sleep quality of multiple individuals
         age (int): the age of the user
         bedtime (float): user's bedtime based on hours into the day (military time)
@@ -143,34 +948,40 @@ def predict_sleep_quality(sleep_quality_stat, df_sleep, age, bedtime, wakeuptime
         gender (str): biological gender of the user
         smoke (str): whether the user smokes
     Returns:
-        y_pred (float): predicted sleep efficiency/REM sleep percentage/deep sleep percentage
+        y_pred (np.array): predicted sleep efficiency/REM sleep percentage/deep sleep percentage (one row, with one
+                           column per statistic if a list of statistics was passed)
     """
-    # Builds the random forest regressor model that predicts a user's sleep efficiency, REM sleep percentage, or deep
-    # sleep percentage
-    random_forest_reg = rf.forest_reg(sleep_quality_stat, df_sleep)
-
-    # Encode the passed-in values for gender and smoking status to match the encoding of the random forest regressor
-    gender_value, smoke_value = convert(gender, smoke)
-
-    # calculate the sleep duration of a user based on their inputted bedtime and wakeup time
-    if wakeuptime < bedtime:
-        duration = wakeuptime + 24 - bedtime
-    else:
-        duration = wakeuptime - bedtime
+    # normalize the user's inputs so that equivalent queries share the same cached prediction
+    inputs = normalize_inputs(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke)
+    age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke = inputs
+
+    # return the cached prediction if the same query was already answered by the same version of the regressor (the
+    # model key changes whenever the data or hyperparameters behind the regressor change)
+    version = rf.model_key(sleep_quality_stat, df_sleep)
+    cache_key = (version, inputs)
+    y_pred = PREDICTION_CACHE.get(cache_key)
+    if y_pred is not None:
+        return y_pred.copy()
+
+    # Retrieves the flattened random forest regressor model that predicts a user's sleep efficiency, REM sleep
+    # percentage, or deep sleep percentage (it is only trained the first time it is needed)
+    flat_forest = rf.get_flat_model(sleep_quality_stat, df_sleep)
 
     # store information about the user into a numpy array
-    data = np.array([[age, bedtime, wakeuptime, duration, awakenings, caffeine, alcohol, exercise,
-                      gender_value, smoke_value]])
+    data = build_features(age, bedtime, wakeuptime, awakenings, caffeine, alcohol, exercise, gender, smoke)
 
     # predict sleep efficiency, REM sleep percentage, or deep sleep percentage based on user inputs from the dropdowns
     # and sliders
-    y_pred = random_forest_reg.predict(data)
+    y_pred = rf.predict_flat(flat_forest, data)
+
+    # remember the prediction for the next time the same query comes in
+    PREDICTION_CACHE.put(cache_key, y_pred)
 
-    return y_pred
+    return y_pred.copy()
 
 
 def encode(var1, var2, df_sleep):
-    """ Encodes quantitative binary variables as qualitative variables via one-hot encoding
+    """ Shows binary qualitative variables as quantitative ones, by swapping in their columns encoded by encode_frame
 
     Args:
         var1 (str): one variable for a column that may contain binary data in a dataframe
@@ -180,20 +991,15 @@ def encode(var1, var2, df_sleep):
     Returns:
         df_sleep (Pandas df): a new version of the sleep data frame that contains any newly encoded columns
     """
-    # saving column names into constants
-    GENDER_COL = 'Gender'
-    SMOKING_COL = 'Smoking status'
-
-    # performing one hot encoding on the gender column (a binary variable) to make it quantitative instead of
-    # qualitative if needed
-    if var1 == GENDER_COL or var2 == GENDER_COL:
-        df_sleep = pd.get_dummies(data=df_sleep, columns=[GENDER_COL], drop_first=True)
-        df_sleep = df_sleep.rename(columns={'Gender_Male': 'Gender'})
-
-    # performing one hot encoding on the smoking status column (a binary variable) to make it quantitative instead of
-    # qualitative if needed
-    if var1 == SMOKING_COL or var2 == SMOKING_COL:
-        df_sleep = pd.get_dummies(data=df_sleep, columns=[SMOKING_COL], drop_first=True)
-        df_sleep = df_sleep.rename(columns={'Smoking status_Yes': 'Smoking status'})
+    # encode the data frame if it was not encoded when it was loaded
+    if not set(ENCODED_COLS.values()).issubset(df_sleep.columns):
+        df_sleep = encode_frame(df_sleep)
+
+    # show the gender and/or smoking status columns (binary variables) as their codes if needed, as booleans like the
+    # one-hot encoded columns of pd.get_dummies (so that a plot coloring by them keeps a discrete legend)
+    swapped = {col: df_sleep[encoded_col].astype(bool) for col, encoded_col in ENCODED_COLS.items()
+               if col in (var1, var2)}
+    if swapped:
+        df_sleep = df_sleep.assign(**swapped)
 
     return df_sleep